@@ -0,0 +1,98 @@
+"""Time to build the sales frame and compute each analytics metric, on synthetic orders.
+
+No database is needed; the orders are generated in memory in the shape the
+aggregation cursor yields them:
+
+    cd backend && python benchmarks/bench_analytics.py --orders 200000
+
+"build" is the column building done by load_sales_frame once the documents have
+arrived (the MongoDB round trips are not included). The other rows are the
+pandas computations behind /admin/analytics/summary and /admin/analytics/revenue
+over a --days long range, best of --repeat runs.
+
+Importing server needs MONGO_URL/DB_NAME, but no database connection is made.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "bench")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import numpy as np  # noqa: E402
+import pandas as pd  # noqa: E402
+
+import server  # noqa: E402
+
+
+def synthetic_orders(count, start, end):
+    span = (end - start).total_seconds()
+    rng = random.Random(42)
+    for _ in range(count):
+        yield {
+            "created_at": start + timedelta(seconds=rng.random() * span),
+            "total_amount": round(rng.uniform(500, 20000), 2),
+            "payment_method": rng.choice(["mpesa", "mpesa", "pay_on_delivery"]),
+            "delivery_method": rng.choice(["delivery", "pickup"]),
+            "units": rng.randint(1, 5),
+        }
+
+
+def build_frame(orders):
+    """The column building of load_sales_frame, minus the cursor"""
+    created_at, amounts, units, payment_methods, delivery_methods = [], [], [], [], []
+    for order in orders:
+        created_at.append(order["created_at"])
+        amounts.append(order["total_amount"])
+        units.append(order.get("units") or 0)
+        payment_methods.append(order.get("payment_method") or "mpesa")
+        delivery_methods.append(order.get("delivery_method") or "delivery")
+    return pd.DataFrame({
+        "created_at": pd.to_datetime(created_at, utc=True),
+        "total_amount": np.asarray(amounts, dtype="float64"),
+        "units": np.asarray(units, dtype="int64"),
+        "payment_method": pd.Categorical(payment_methods),
+        "delivery_method": pd.Categorical(delivery_methods),
+    })
+
+
+def best_of(repeat, fn):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - started)
+    return min(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--orders", type=int, default=200000)
+    parser.add_argument("--days", type=int, default=365, help="length of the analysed range")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    end = datetime(2026, 1, 1, tzinfo=timezone.utc)
+    start = end - timedelta(days=args.days)
+    # Summaries load the previous period as well
+    documents = list(synthetic_orders(args.orders, start - (end - start), end))
+
+    elapsed, frame = best_of(args.repeat, lambda: build_frame(documents))
+    print(f"{'build':<16} {elapsed * 1000:8.1f}ms  ({len(frame)} orders)")
+
+    elapsed, _ = best_of(args.repeat, lambda: server.sales_summary(frame, start, end))
+    print(f"{'summary':<16} {elapsed * 1000:8.1f}ms")
+
+    current = frame[frame["created_at"] >= pd.Timestamp(start)]
+    for granularity in server.AnalyticsGranularity:
+        elapsed, points = best_of(args.repeat, lambda: server.sales_series(current, start, end, granularity))
+        print(f"{'revenue/' + granularity.value:<16} {elapsed * 1000:8.1f}ms  ({len(points)} periods)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""Latency of an unrelated endpoint while the API is hit by a login storm.
+
+Runs against a live server, like backend_test.py:
+
+    cd backend && python benchmarks/bench_login_storm.py \
+        --base-url http://localhost:8001 --email admin@wacka.co.ke --password admin123
+
+First measures GET /api/categories on its own, then again while --concurrency
+clients log in back to back. With bcrypt on the event loop, p99 of the probe
+grows with every queued login; with the password pool it stays near baseline.
+
+All logins come from one address for one account, so the login rate limit turns
+almost all of them into cheap 429s and no bcrypt load builds up. Start the server
+with rate limiting off for this benchmark:
+
+    cd backend && RATE_LIMIT_ENABLED=false uvicorn server:app --port 8001
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+import httpx
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def report(label, samples):
+    ms = [s * 1000 for s in samples]
+    print(
+        f"{label:<16} n={len(ms):<5} p50={percentile(ms, 50):7.1f}ms "
+        f"p95={percentile(ms, 95):7.1f}ms p99={percentile(ms, 99):7.1f}ms "
+        f"mean={statistics.mean(ms):7.1f}ms"
+    )
+
+
+async def probe(client, path, stop_at, samples):
+    while time.monotonic() < stop_at:
+        started = time.monotonic()
+        response = await client.get(path)
+        response.raise_for_status()
+        samples.append(time.monotonic() - started)
+        await asyncio.sleep(0.02)
+
+
+async def login_loop(client, email, password, stop_at, counts):
+    while time.monotonic() < stop_at:
+        response = await client.post("/api/auth/login", json={"email": email, "password": password})
+        counts[response.status_code] = counts.get(response.status_code, 0) + 1
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--base-url", default="http://localhost:8001")
+    parser.add_argument("--email", required=True)
+    parser.add_argument("--password", required=True)
+    parser.add_argument("--concurrency", type=int, default=50, help="concurrent login clients")
+    parser.add_argument("--duration", type=float, default=15.0, help="seconds per phase")
+    parser.add_argument("--probe", default="/api/categories", help="unrelated endpoint to time")
+    args = parser.parse_args()
+
+    limits = httpx.Limits(max_connections=args.concurrency + 10)
+    async with httpx.AsyncClient(base_url=args.base_url, limits=limits, timeout=60.0) as client:
+        baseline = []
+        await probe(client, args.probe, time.monotonic() + args.duration, baseline)
+        report("baseline", baseline)
+
+        storm, counts = [], {}
+        stop_at = time.monotonic() + args.duration
+        await asyncio.gather(
+            probe(client, args.probe, stop_at, storm),
+            *[login_loop(client, args.email, args.password, stop_at, counts) for _ in range(args.concurrency)]
+        )
+        report("login storm", storm)
+        print(f"login responses: {dict(sorted(counts.items()))} "
+              f"({sum(counts.values()) / args.duration:.1f}/s)")
+        if counts.get(429):
+            print("warning: logins were rate limited, so the storm skipped bcrypt; "
+                  "rerun against a server started with RATE_LIMIT_ENABLED=false")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,131 @@
+"""Latency per STK push with the pooled client and cached token, against the Daraja simulator.
+
+Start the simulator with some network latency, then run the benchmark:
+
+    cd backend && SIM_LATENCY_MS=20 uvicorn mpesa_simulator:app --port 8090
+    cd backend && python benchmarks/bench_mpesa_client.py --base-url http://localhost:8090
+
+The "per-call" phase does what MpesaService did before the pooled client: a new
+httpx.AsyncClient for the OAuth request and another for the STK push, so every
+payment pays for two connection setups and a token round trip. The "pooled" phase
+uses MpesaService itself, with its keep-alive client and cached token.
+
+Importing server needs MONGO_URL/DB_NAME, but no database connection is made.
+"""
+import argparse
+import asyncio
+import base64
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "bench")
+# The simulator rejects pushes without a callback URL; the callbacks it fires are not needed
+os.environ.setdefault("MPESA_CALLBACK_URL", "http://127.0.0.1:9/unused")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import httpx  # noqa: E402
+
+import server  # noqa: E402
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def report(label, samples):
+    ms = [s * 1000 for s in samples]
+    print(
+        f"{label:<10} n={len(ms):<5} p50={percentile(ms, 50):7.1f}ms "
+        f"p95={percentile(ms, 95):7.1f}ms p99={percentile(ms, 99):7.1f}ms "
+        f"mean={statistics.mean(ms):7.1f}ms"
+    )
+
+
+def stk_payload(password, timestamp):
+    return {
+        "BusinessShortCode": server.MPESA_SHORTCODE,
+        "Password": password,
+        "Timestamp": timestamp,
+        "TransactionType": "CustomerPayBillOnline",
+        "Amount": 100,
+        "PartyA": "254712345678",
+        "PartyB": server.MPESA_SHORTCODE,
+        "PhoneNumber": "254712345678",
+        "CallBackURL": server.MPESA_CALLBACK_URL,
+        "AccountReference": "BENCH",
+        "TransactionDesc": "Benchmark",
+    }
+
+
+async def push_per_call(base_url, service):
+    auth = base64.b64encode(f"{server.MPESA_CONSUMER_KEY}:{server.MPESA_CONSUMER_SECRET}".encode()).decode()
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        response = await client.get(
+            "/oauth/v1/generate", params={"grant_type": "client_credentials"}, headers={"Authorization": f"Basic {auth}"}
+        )
+        token = response.json()["access_token"]
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        response = await client.post(
+            "/mpesa/stkpush/v1/processrequest",
+            json=stk_payload(*service.generate_password()),
+            headers={"Authorization": f"Bearer {token}"},
+        )
+        response.raise_for_status()
+
+
+async def push_pooled(service):
+    result = await service.initiate_stk_push("254712345678", 100, "BENCH", "Benchmark")
+    if result.get("ResponseCode") != "0":
+        raise RuntimeError(f"STK push failed: {result}")
+
+
+async def run_phase(push, payments, concurrency):
+    samples = []
+    pending = iter(range(payments))
+
+    async def client_loop():
+        for _ in pending:
+            started = time.monotonic()
+            await push()
+            samples.append(time.monotonic() - started)
+
+    started = time.monotonic()
+    await asyncio.gather(*[client_loop() for _ in range(concurrency)])
+    return samples, time.monotonic() - started
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--base-url", default="http://localhost:8090")
+    parser.add_argument("--payments", type=int, default=200, help="STK pushes per phase")
+    parser.add_argument("--concurrency", type=int, default=1, help="concurrent payers")
+    args = parser.parse_args()
+
+    service = server.MpesaService(args.base_url)
+    await service.start()
+    try:
+        # One push each so neither phase pays for first-use setup
+        await push_per_call(args.base_url, service)
+        await push_pooled(service)
+
+        per_call, per_call_elapsed = await run_phase(
+            lambda: push_per_call(args.base_url, service), args.payments, args.concurrency
+        )
+        report("per-call", per_call)
+        pooled, pooled_elapsed = await run_phase(lambda: push_pooled(service), args.payments, args.concurrency)
+        report("pooled", pooled)
+    finally:
+        await service.close()
+
+    saved = statistics.mean(per_call) - statistics.mean(pooled)
+    print(f"saved {saved * 1000:.1f}ms per payment on average; "
+          f"throughput {args.payments / per_call_elapsed:.0f}/s -> {args.payments / pooled_elapsed:.0f}/s")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,94 @@
+"""Render cost per message for the email and invoice templates.
+
+    cd backend && python benchmarks/bench_templates.py [--items 5] [--number 2000]
+
+Importing server needs MONGO_URL/DB_NAME, but no database connection is made.
+"""
+import argparse
+import os
+import sys
+import timeit
+from pathlib import Path
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "bench")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import server  # noqa: E402
+
+
+def sample_order(items: int) -> dict:
+    return {
+        "id": "3f2b9c1e-5d4a-4b8f-9e6c-1a2b3c4d5e6f",
+        "status": "paid",
+        "payment_method": "mpesa",
+        "delivery_method": "delivery",
+        "total_amount": 1250.0 * items,
+        "created_at": "2025-06-01T10:00:00+00:00",
+        "updated_at": "2025-06-01T10:05:00+00:00",
+        "phone_number": "254712345678",
+        "address_snapshot": {"address_line": "Moi Avenue", "city": "Nairobi", "country": "Kenya"},
+        "items": [
+            {"product_name": f"Leather Strap <{i}>", "quantity": 1 + i % 3, "price": 1250.0}
+            for i in range(items)
+        ],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--items", type=int, default=5, help="line items per order")
+    parser.add_argument("--number", type=int, default=2000, help="renders per measurement")
+    args = parser.parse_args()
+
+    renderer = server.template_renderer
+    order = sample_order(args.items)
+    rows = [{"product_name": f"Product {i}", "quantity": i, "threshold": 5} for i in range(args.items)]
+    context = {
+        "order_ref": order["id"][:8].upper(),
+        "status": "Paid",
+        "delivery_method": "Delivery",
+        "total": f"{order['total_amount']:,.0f}",
+    }
+
+    def invoice_uncached():
+        return renderer.render(
+            "invoices/invoice.html",
+            invoice_ref=context["order_ref"], store_name="Wacka Accessories", date="June 01, 2025",
+            status="Paid", phone=order["phone_number"], address="Moi Avenue, Nairobi, Kenya",
+            items=renderer.render_rows("partials/invoice_item_row.html", [
+                {"product_name": i["product_name"], "quantity": i["quantity"],
+                 "price": f"{i['price']:,.0f}", "subtotal": f"{i['price'] * i['quantity']:,.0f}"}
+                for i in order["items"]
+            ]),
+            total=context["total"],
+        )
+
+    cache = server.RenderCache(16)
+    cache_key = ("invoices/invoice.html", order["id"], order["updated_at"], "Wacka Accessories")
+
+    cases = {
+        "compile all templates": lambda: server.TemplateRenderer(server.TEMPLATE_DIR),
+        "order_confirmation": lambda: renderer.render(
+            "emails/order_confirmation.html", items=server.order_items_html(order), support_email="shop@example.com", **context),
+        "admin_new_order": lambda: renderer.render(
+            "emails/admin_new_order.html", items=server.order_items_html(order), customer_email="c@example.com",
+            payment_method="Mpesa", **context),
+        "payment_success": lambda: renderer.render(
+            "emails/payment_success.html", receipt="SGH7K2L9QX", total=context["total"], order_ref=context["order_ref"]),
+        "low_stock_alert": lambda: renderer.render(
+            "emails/low_stock_alert.html", items=renderer.render_rows("partials/low_stock_row.html", rows)),
+        "password_reset": lambda: renderer.render("emails/password_reset.html", token="a1B2c3D4e5F6g7H8"),
+        "invoice (uncached)": invoice_uncached,
+        "invoice (cached)": lambda: cache.get_or_render(cache_key, invoice_uncached),
+    }
+
+    print(f"{'template':<24} {'per render':>12}")
+    for name, fn in cases.items():
+        number = 50 if name.startswith("compile") else args.number
+        seconds = min(timeit.repeat(fn, number=number, repeat=5)) / number
+        print(f"{name:<24} {seconds * 1e6:>9.1f} µs")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,409 @@
+"""Maintenance commands for the store database.
+
+Run from the backend directory with the same environment as the API:
+
+    cd backend && python manage.py backfill-sales
+    cd backend && python manage.py migrate-dates [collection ...]
+    cd backend && python manage.py build-cohorts [--full]
+    cd backend && python manage.py forecast-stock
+
+backfill-sales
+    Adds every paid, processing, shipped or completed order that is not yet counted
+    to the sales_daily rollup. Orders are streamed in batches and counted through
+    the same atomic flag as live status changes, so it is safe to run while the API
+    is serving, and safe to re-run after an interruption. --rebuild clears the
+    rollup and all counted flags first; stop the API before using it.
+    It then repairs orders whose rollup update was interrupted between the flag
+    flip and the sales_daily write (rollup_pending still set after
+    --pending-grace-minutes): each of their days is rebuilt from the orders
+    counted on it. The rebuild replaces that day's document, so run it when no
+    orders from those days are changing status.
+
+migrate-dates
+    Rewrites timestamp fields stored as ISO strings (created_at, updated_at,
+    expires_at, timestamp, ...) as native dates, collection by collection in _id
+    order. Progress is saved to the migrations collection after every batch, so an
+    interrupted run resumes where it stopped; --restart scans from the beginning.
+    Each update only applies if the field still holds the string that was read, so
+    it is safe to run while the API is serving.
+
+build-cohorts
+    Groups customers into monthly acquisition cohorts by their first paid order
+    and writes, per cohort, the number of distinct customers and the revenue for
+    each month since acquisition to analytics_cohorts (read by
+    GET /api/admin/analytics/cohorts). Runs after the first only recompute the
+    cohorts of customers whose orders changed since the previous run; --full
+    rebuilds everything. Meant to run from cron, e.g. hourly.
+
+forecast-stock
+    Estimates each product's daily sales velocity as an exponentially weighted
+    average of the sale movements in inventory_logs over the last --window-days
+    complete UTC days (today is left out), and writes velocity, days_of_cover
+    (capped at --max-cover-days), reorder_point and forecast_at to its inventory
+    document, re-evaluating is_low_stock against the new reorder point. The
+    reorder point covers expected demand over --lead-time-days plus safety stock
+    for --service-z standard deviations of daily demand. GET /api/admin/low-stock
+    ranks by days_of_cover. Meant to run from cron, e.g. every 15 minutes.
+"""
+import argparse
+import asyncio
+import time
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+from pymongo import DeleteOne, ReplaceOne, UpdateOne
+
+from server import (
+    db, LOW_STOCK_FLAG_STAGE, PAID_ORDER_STATUSES, StockMovementReason, apply_order_to_rollup, date_range,
+    month_index, month_key, parse_datetime, product_categories, sales_day, sync_order_rollup
+)
+
+DATE_FIELDS = [
+    "created_at", "updated_at", "expires_at", "timestamp", "completed_at",
+    "received_at", "viewed_at", "used_at", "added_at", "start_date", "end_date"
+]
+
+
+async def backfill_sales(args):
+    if args.rebuild:
+        await db.sales_daily.delete_many({})
+        result = await db.orders.update_many({"counted_in_rollup": True}, {"$set": {"counted_in_rollup": False}})
+        print(f"Cleared sales_daily and reset {result.modified_count} orders")
+
+    query = {"status": {"$in": PAID_ORDER_STATUSES}, "counted_in_rollup": {"$ne": True}}
+    total = await db.orders.count_documents(query)
+    print(f"{total} orders to add")
+
+    # Only orders placed before items carried their category need this
+    categories = await product_categories(await db.products.distinct("id"))
+
+    added = 0
+    started = time.monotonic()
+    cursor = db.orders.find(query, {"_id": 0, "id": 1}).batch_size(args.batch_size)
+    batch = []
+    async for order in cursor:
+        batch.append(order["id"])
+        if len(batch) >= args.batch_size:
+            results = await asyncio.gather(*[sync_order_rollup(order_id, categories) for order_id in batch])
+            added += sum(1 for r in results if r == 1)
+            batch.clear()
+            print(f"  {added}/{total} ({added / max(time.monotonic() - started, 1e-6):.0f}/s)")
+    if batch:
+        results = await asyncio.gather(*[sync_order_rollup(order_id, categories) for order_id in batch])
+        added += sum(1 for r in results if r == 1)
+
+    days = await db.sales_daily.count_documents({})
+    print(f"Added {added} orders in {time.monotonic() - started:.1f}s; sales_daily has {days} days")
+
+    repaired = await repair_pending_days(categories, args.pending_grace_minutes)
+    if repaired:
+        print(f"Rebuilt {len(repaired)} days with interrupted rollup updates: {', '.join(repaired)}")
+
+
+async def repair_pending_days(categories, grace_minutes):
+    """Rebuild the sales_daily days of orders whose rollup update never finished"""
+    cutoff = datetime.now(timezone.utc) - timedelta(minutes=grace_minutes)
+    pending = await db.orders.find(
+        {"rollup_pending_at": {"$lt": cutoff}}, {"_id": 0, "id": 1, "created_at": 1}
+    ).to_list(None)
+    if not pending:
+        return []
+
+    await db.orders.update_many(
+        {"id": {"$in": [o["id"] for o in pending]}, "rollup_pending_at": {"$lt": cutoff}},
+        {"$unset": {"rollup_pending": "", "rollup_pending_at": ""}}
+    )
+    days = sorted({sales_day(o["created_at"]) for o in pending})
+    fields = {"_id": 0, "created_at": 1, "total_amount": 1, "items": 1}
+    for day in days:
+        start = datetime.strptime(day, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+        await db.sales_daily.delete_one({"_id": day})
+        query = {"$and": [date_range("created_at", start, start + timedelta(days=1)), {"counted_in_rollup": True}]}
+        async for order in db.orders.find(query, fields):
+            await apply_order_to_rollup(order, 1, categories)
+    return days
+
+
+def converted_dates(doc):
+    """New values for the fields of doc that still hold ISO strings, and the strings they replace"""
+    new, old = {}, {}
+    for field in DATE_FIELDS:
+        value = doc.get(field)
+        if not isinstance(value, str):
+            continue
+        try:
+            new[field] = parse_datetime(value)
+        except ValueError:
+            continue
+        old[field] = value
+    return new, old
+
+
+async def migrate_collection(name, args):
+    state_id = f"dates:{name}"
+    if args.restart:
+        await db.migrations.delete_one({"_id": state_id})
+    state = await db.migrations.find_one({"_id": state_id}) or {}
+    if state.get("done"):
+        print(f"{name}: already migrated")
+        return
+
+    has_strings = {"$or": [{field: {"$type": "string"}} for field in DATE_FIELDS]}
+    remaining = await db[name].count_documents(has_strings)
+    if not remaining:
+        await db.migrations.update_one({"_id": state_id}, {"$set": {"done": True}}, upsert=True)
+        return
+    print(f"{name}: {remaining} documents with string dates")
+    if args.dry_run:
+        return
+
+    converted = state.get("converted", 0)
+    total = converted + remaining
+    last_id = state.get("last_id")
+    started = time.monotonic()
+    while True:
+        query = dict(has_strings)
+        if last_id is not None:
+            query["_id"] = {"$gt": last_id}
+        batch = await db[name].find(query, {field: 1 for field in DATE_FIELDS}).sort("_id", 1).limit(args.batch_size).to_list(args.batch_size)
+        if not batch:
+            break
+
+        updates = []
+        for doc in batch:
+            new, old = converted_dates(doc)
+            if new:
+                updates.append(UpdateOne({"_id": doc["_id"], **old}, {"$set": new}))
+        if updates:
+            result = await db[name].bulk_write(updates, ordered=False)
+            converted += result.modified_count
+        last_id = batch[-1]["_id"]
+        await db.migrations.update_one(
+            {"_id": state_id},
+            {"$set": {"last_id": last_id, "converted": converted}},
+            upsert=True
+        )
+        print(f"  {name}: {converted}/{total} ({converted / max(time.monotonic() - started, 1e-6):.0f}/s)")
+
+    await db.migrations.update_one({"_id": state_id}, {"$set": {"done": True}}, upsert=True)
+    print(f"{name}: converted {converted} documents")
+
+
+async def migrate_dates(args):
+    names = args.collections or sorted(
+        n for n in await db.list_collection_names() if not n.startswith("system.") and n != "migrations"
+    )
+    for name in names:
+        await migrate_collection(name, args)
+
+
+async def load_paid_orders(user_ids=None, chunk_size=5000):
+    """User id, month index and amount arrays for paid orders, optionally only those of user_ids"""
+    if user_ids is None:
+        matches = [{}]
+    else:
+        user_ids = list(user_ids)
+        matches = [{"user_id": {"$in": user_ids[i:i + chunk_size]}} for i in range(0, len(user_ids), chunk_size)]
+
+    users, months, amounts = [], [], []
+    for match in matches:
+        pipeline = [
+            {"$match": {**match, "status": {"$in": PAID_ORDER_STATUSES}}},
+            {"$project": {"_id": 0, "user_id": 1, "created_at": 1, "total_amount": 1}}
+        ]
+        async for order in db.orders.aggregate(pipeline, batchSize=5000):
+            users.append(order["user_id"])
+            months.append(month_index(parse_datetime(order["created_at"])))
+            amounts.append(order["total_amount"])
+    return np.asarray(users, dtype=object), np.asarray(months, dtype=np.int64), np.asarray(amounts, dtype=np.float64)
+
+
+def cohort_matrices(users, months, amounts):
+    """Returns ({user_id: cohort}, {cohort: document}) for complete order histories of some customers.
+
+    A customer's cohort is the month of their first paid order. customers[k] counts the
+    cohort's distinct customers with a paid order k months after acquisition and
+    revenue[k] their spend in that month.
+    """
+    if not len(users):
+        return {}, {}
+    user_ids, user_pos = np.unique(users, return_inverse=True)
+    first = np.full(len(user_ids), np.iinfo(np.int64).max)
+    np.minimum.at(first, user_pos, months)
+    offsets = months - first[user_pos]
+    cohorts, cohort_pos = np.unique(first, return_inverse=True)
+    width = int(months.max() - cohorts.min() + 1)
+
+    revenue = np.zeros((len(cohorts), width))
+    np.add.at(revenue, (cohort_pos[user_pos], offsets), amounts)
+    # A customer counts once per month however many orders they placed
+    active = np.unique(np.stack([user_pos, offsets]), axis=1)
+    customers = np.zeros((len(cohorts), width), dtype=np.int64)
+    np.add.at(customers, (cohort_pos[active[0]], active[1]), 1)
+
+    now = datetime.now(timezone.utc)
+    documents = {}
+    for i, cohort in enumerate(cohorts):
+        key = month_key(int(cohort))
+        span = int(months.max() - cohort + 1)
+        documents[key] = {
+            "_id": key,
+            "cohort": key,
+            "size": int(customers[i, 0]),
+            "customers": customers[i, :span].tolist(),
+            "revenue": revenue[i, :span].round(2).tolist(),
+            "updated_at": now
+        }
+    members = {user_id: month_key(int(cohort)) for user_id, cohort in zip(user_ids, first)}
+    return members, documents
+
+
+async def build_cohorts(args):
+    started_at = datetime.now(timezone.utc)
+    state = await db.analytics_jobs.find_one({"_id": "cohorts"})
+
+    if args.full or not state:
+        users, months, amounts = await load_paid_orders()
+        members, cohorts = cohort_matrices(users, months, amounts)
+        await db.analytics_cohort_members.delete_many({})
+        docs = [{"_id": user_id, "cohort": cohort} for user_id, cohort in members.items()]
+        for i in range(0, len(docs), 5000):
+            await db.analytics_cohort_members.insert_many(docs[i:i + 5000])
+        await db.analytics_cohorts.delete_many({})
+        if cohorts:
+            await db.analytics_cohorts.insert_many(list(cohorts.values()))
+        print(f"Built {len(cohorts)} cohorts from {len(users)} orders of {len(members)} customers")
+    else:
+        # Anything written while the previous run was reading is picked up again
+        since = state["last_run_at"] - timedelta(minutes=1)
+        changed = await db.orders.distinct("user_id", date_range("updated_at", since))
+        previous = {
+            m["_id"]: m["cohort"]
+            async for m in db.analytics_cohort_members.find({"_id": {"$in": changed}})
+        }
+        current, _ = cohort_matrices(*await load_paid_orders(changed))
+        touched = set(previous.values()) | set(current.values())
+
+        updates = [
+            UpdateOne({"_id": user_id}, {"$set": {"cohort": current[user_id]}}, upsert=True) if user_id in current
+            else DeleteOne({"_id": user_id})
+            for user_id in changed if user_id in current or user_id in previous
+        ]
+        if updates:
+            await db.analytics_cohort_members.bulk_write(updates, ordered=False)
+
+        # Recompute touched cohorts from the full order history of all their members
+        member_ids = [
+            m["_id"] async for m in db.analytics_cohort_members.find({"cohort": {"$in": list(touched)}}, {"_id": 1})
+        ]
+        _, cohorts = cohort_matrices(*await load_paid_orders(member_ids))
+        writes = [ReplaceOne({"_id": key}, cohorts[key], upsert=True) if key in cohorts else DeleteOne({"_id": key}) for key in touched]
+        if writes:
+            await db.analytics_cohorts.bulk_write(writes, ordered=False)
+        print(f"{len(changed)} customers with changed orders; recomputed cohorts: {', '.join(sorted(touched)) or 'none'}")
+
+    await db.analytics_jobs.update_one(
+        {"_id": "cohorts"},
+        {"$set": {"last_run_at": started_at, "duration_seconds": (datetime.now(timezone.utc) - started_at).total_seconds()}},
+        upsert=True
+    )
+
+
+def demand_forecast(product_pos, day, units, n_products, n_days, span, lead_time_days, service_z):
+    """Velocity, daily demand standard deviation and reorder point per product, from (product, day, units) sales"""
+    demand = np.zeros((n_products, n_days))
+    np.add.at(demand, (product_pos, day), units)
+
+    # Weights of an exponentially weighted mean with the most recent day weighted highest
+    alpha = 2 / (span + 1)
+    weights = (1 - alpha) ** np.arange(n_days - 1, -1, -1)
+    velocity = demand @ weights / weights.sum()
+    std = demand.std(axis=1)
+    reorder_point = np.ceil(velocity * lead_time_days + service_z * std * np.sqrt(lead_time_days))
+    return velocity, std, reorder_point
+
+
+async def forecast_stock(args):
+    now = datetime.now(timezone.utc)
+    # Only whole days: today's partial sales would read as a drop in demand
+    end = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    start = end - timedelta(days=args.window_days)
+    n_days = args.window_days
+
+    inventory = await db.inventory.find({}, {"_id": 0, "product_id": 1, "quantity": 1}).to_list(None)
+    position = {inv["product_id"]: i for i, inv in enumerate(inventory)}
+    quantity = np.asarray([max(inv.get("quantity", 0), 0) for inv in inventory], dtype=np.float64)
+
+    product_pos, day, units = [], [], []
+    query = {"reason": StockMovementReason.SALE, **date_range("created_at", start, end)}
+    async for log in db.inventory_logs.find(query, {"_id": 0, "product_id": 1, "change": 1, "created_at": 1}).batch_size(5000):
+        pos = position.get(log["product_id"])
+        if pos is None:
+            continue
+        product_pos.append(pos)
+        day.append((parse_datetime(log["created_at"]) - start).days)
+        units.append(-log["change"])
+
+    velocity, std, reorder_point = demand_forecast(
+        np.asarray(product_pos, dtype=np.int64), np.clip(np.asarray(day, dtype=np.int64), 0, n_days - 1),
+        np.asarray(units, dtype=np.float64), len(inventory), n_days,
+        args.span_days, args.lead_time_days, args.service_z
+    )
+    cover = np.divide(quantity, velocity, out=np.full_like(quantity, float(args.max_cover_days)), where=velocity > 0)
+    cover = np.minimum(cover, args.max_cover_days)
+
+    # A new reorder point can move a row in or out of low stock
+    updates = [
+        UpdateOne({"product_id": inv["product_id"]}, [{"$set": {
+            "velocity": round(float(velocity[i]), 4),
+            "demand_std": round(float(std[i]), 4),
+            "days_of_cover": round(float(cover[i]), 1),
+            "reorder_point": int(reorder_point[i]),
+            "forecast_at": now
+        }}, LOW_STOCK_FLAG_STAGE])
+        for i, inv in enumerate(inventory)
+    ]
+    for i in range(0, len(updates), 1000):
+        await db.inventory.bulk_write(updates[i:i + 1000], ordered=False)
+
+    urgent = int(((quantity <= reorder_point) & (velocity > 0)).sum())
+    print(f"Forecast {len(inventory)} products from {len(units)} sale movements over {n_days} days; "
+          f"{urgent} at or below their reorder point")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    backfill = commands.add_parser("backfill-sales", help="add historical orders to the sales_daily rollup")
+    backfill.add_argument("--batch-size", type=int, default=200)
+    backfill.add_argument("--rebuild", action="store_true", help="clear the rollup first (stop the API before using this)")
+    backfill.add_argument("--pending-grace-minutes", type=float, default=10,
+                          help="only repair rollup updates left pending for longer than this")
+    backfill.set_defaults(handler=backfill_sales)
+
+    migrate = commands.add_parser("migrate-dates", help="convert ISO string timestamps to native dates")
+    migrate.add_argument("collections", nargs="*", help="collections to migrate (default: all)")
+    migrate.add_argument("--batch-size", type=int, default=500)
+    migrate.add_argument("--restart", action="store_true", help="ignore saved progress")
+    migrate.add_argument("--dry-run", action="store_true", help="only count documents that need converting")
+    migrate.set_defaults(handler=migrate_dates)
+
+    cohorts = commands.add_parser("build-cohorts", help="update the customer cohort and retention matrices")
+    cohorts.add_argument("--full", action="store_true", help="rebuild all cohorts instead of only changed ones")
+    cohorts.set_defaults(handler=build_cohorts)
+
+    forecast = commands.add_parser("forecast-stock", help="update sales velocity, days of cover and reorder points")
+    forecast.add_argument("--window-days", type=int, default=90, help="complete days of sales history to read")
+    forecast.add_argument("--span-days", type=float, default=14, help="EWMA span; smaller reacts faster")
+    forecast.add_argument("--lead-time-days", type=float, default=7, help="days between reordering and restock")
+    forecast.add_argument("--service-z", type=float, default=1.65, help="safety stock in standard deviations (1.65 ~ 95%%)")
+    forecast.add_argument("--max-cover-days", type=float, default=365)
+    forecast.set_defaults(handler=forecast_stock)
+
+    args = parser.parse_args()
+    asyncio.run(args.handler(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+"""Local Daraja (M-Pesa) simulator for load and integration testing.
+
+Implements the OAuth, STK push and STK query endpoints used by MpesaService and
+fires STK callbacks back at the store, so the full payment flow can run offline.
+
+Run it next to the API:
+
+    uvicorn mpesa_simulator:app --port 8090
+
+and point the backend at it in backend/.env:
+
+    MPESA_BASE_URL="http://localhost:8090"
+    MPESA_CALLBACK_URL="http://localhost:8001/api/payments/mpesa/callback"
+
+Behaviour is configured with SIM_* environment variables and can be changed at
+runtime with PUT /simulator/config.
+"""
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+import os
+import asyncio
+import logging
+import random
+import secrets
+import string
+import time
+import uuid
+import httpx
+from datetime import datetime
+from typing import Dict, Optional
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger("mpesa_simulator")
+
+config = {
+    # Probability that the customer completes the payment
+    "success_rate": float(os.environ.get('SIM_SUCCESS_RATE', '0.9')),
+    # Seconds between the STK push and its callback
+    "callback_delay_min": float(os.environ.get('SIM_CALLBACK_DELAY_MIN', '2')),
+    "callback_delay_max": float(os.environ.get('SIM_CALLBACK_DELAY_MAX', '5')),
+    # Extra latency (milliseconds) added to every API response
+    "latency_ms": float(os.environ.get('SIM_LATENCY_MS', '0')),
+    "latency_jitter_ms": float(os.environ.get('SIM_LATENCY_JITTER_MS', '0')),
+    # Probability that an API call fails with a 500
+    "error_rate": float(os.environ.get('SIM_ERROR_RATE', '0')),
+    # Probability that a callback is never sent (exercises the reconciler)
+    "drop_rate": float(os.environ.get('SIM_DROP_RATE', '0')),
+    # Probability that a callback is delivered twice, concurrently
+    "duplicate_rate": float(os.environ.get('SIM_DUPLICATE_RATE', '0')),
+    # Overrides the CallBackURL sent in the STK push payload
+    "callback_url": os.environ.get('SIM_CALLBACK_URL', ''),
+    "token_ttl": int(os.environ.get('SIM_TOKEN_TTL', '3599')),
+}
+
+FAILURE_RESULTS = [
+    (1032, "Request cancelled by user"),
+    (1, "The balance is insufficient for the transaction"),
+    (2001, "The initiator information is invalid"),
+    (1037, "DS timeout user cannot be reached"),
+]
+
+app = FastAPI(title="Daraja Simulator", version="1.0.0")
+
+tokens: Dict[str, float] = {}
+transactions: Dict[str, dict] = {}
+stats = {"tokens_issued": 0, "stk_pushes": 0, "queries": 0, "callbacks_sent": 0, "callbacks_failed": 0, "callbacks_dropped": 0, "errors_injected": 0}
+http_client: Optional[httpx.AsyncClient] = None
+_callback_tasks = set()
+
+def daraja_error(status_code: int, error_code: str, message: str) -> JSONResponse:
+    return JSONResponse(
+        status_code=status_code,
+        content={"requestId": uuid.uuid4().hex, "errorCode": error_code, "errorMessage": message}
+    )
+
+async def simulate_network():
+    """Apply the configured latency; returns an error response if one is injected"""
+    delay = config["latency_ms"] + random.uniform(-1, 1) * config["latency_jitter_ms"]
+    if delay > 0:
+        await asyncio.sleep(delay / 1000)
+    if random.random() < config["error_rate"]:
+        stats["errors_injected"] += 1
+        return daraja_error(500, "500.003.02", "System is busy. Please try again in few minutes.")
+    return None
+
+def check_bearer(request: Request) -> bool:
+    auth = request.headers.get("Authorization", "")
+    token = auth[len("Bearer "):] if auth.startswith("Bearer ") else None
+    expires = tokens.get(token) if token else None
+    return expires is not None and expires > time.monotonic()
+
+def generate_receipt() -> str:
+    return "S" + "".join(secrets.choice(string.ascii_uppercase + string.digits) for _ in range(9))
+
+def build_callback(transaction: dict) -> dict:
+    stk_callback = {
+        "MerchantRequestID": transaction["merchant_request_id"],
+        "CheckoutRequestID": transaction["checkout_request_id"],
+        "ResultCode": transaction["result_code"],
+        "ResultDesc": transaction["result_desc"]
+    }
+    if transaction["result_code"] == 0:
+        stk_callback["CallbackMetadata"] = {"Item": [
+            {"Name": "Amount", "Value": transaction["amount"]},
+            {"Name": "MpesaReceiptNumber", "Value": transaction["receipt"]},
+            {"Name": "TransactionDate", "Value": int(datetime.now().strftime("%Y%m%d%H%M%S"))},
+            {"Name": "PhoneNumber", "Value": int(transaction["phone"])}
+        ]}
+    return {"Body": {"stkCallback": stk_callback}}
+
+async def send_callback(url: str, payload: dict):
+    try:
+        response = await http_client.post(url, json=payload)
+        response.raise_for_status()
+        stats["callbacks_sent"] += 1
+    except Exception as e:
+        stats["callbacks_failed"] += 1
+        logger.warning(f"Callback to {url} failed: {str(e)}")
+
+async def complete_transaction(checkout_request_id: str):
+    transaction = transactions[checkout_request_id]
+    await asyncio.sleep(random.uniform(config["callback_delay_min"], config["callback_delay_max"]))
+
+    if random.random() < config["success_rate"]:
+        transaction.update({"result_code": 0, "result_desc": "The service request is processed successfully.", "receipt": generate_receipt()})
+    else:
+        result_code, result_desc = random.choice(FAILURE_RESULTS)
+        transaction.update({"result_code": result_code, "result_desc": result_desc})
+    transaction["status"] = "completed"
+
+    url = config["callback_url"] or transaction["callback_url"]
+    if not url or random.random() < config["drop_rate"]:
+        stats["callbacks_dropped"] += 1
+        return
+
+    payload = build_callback(transaction)
+    copies = 2 if random.random() < config["duplicate_rate"] else 1
+    await asyncio.gather(*[send_callback(url, payload) for _ in range(copies)])
+
+@app.on_event("startup")
+async def startup():
+    global http_client
+    http_client = httpx.AsyncClient(timeout=httpx.Timeout(10.0))
+
+@app.on_event("shutdown")
+async def shutdown():
+    for task in _callback_tasks:
+        task.cancel()
+    await http_client.aclose()
+
+@app.get("/oauth/v1/generate")
+async def generate_token(request: Request, grant_type: str = ""):
+    error = await simulate_network()
+    if error:
+        return error
+    if grant_type != "client_credentials" or not request.headers.get("Authorization", "").startswith("Basic "):
+        return daraja_error(400, "400.008.01", "Invalid Authentication passed")
+
+    token = secrets.token_urlsafe(24)
+    tokens[token] = time.monotonic() + config["token_ttl"]
+    stats["tokens_issued"] += 1
+    return {"access_token": token, "expires_in": str(config["token_ttl"])}
+
+@app.post("/mpesa/stkpush/v1/processrequest")
+async def stk_push(request: Request):
+    error = await simulate_network()
+    if error:
+        return error
+    if not check_bearer(request):
+        return daraja_error(401, "404.001.03", "Invalid Access Token")
+
+    payload = await request.json()
+    missing = [f for f in ("BusinessShortCode", "Password", "Timestamp", "Amount", "PhoneNumber", "CallBackURL") if not payload.get(f)]
+    if missing:
+        return daraja_error(400, "400.002.02", f"Bad Request - Invalid {missing[0]}")
+
+    checkout_request_id = f"ws_CO_{datetime.now().strftime('%d%m%Y%H%M%S')}{uuid.uuid4().hex[:10]}"
+    merchant_request_id = f"{random.randint(10000, 99999)}-{random.randint(1000000, 9999999)}-1"
+    transactions[checkout_request_id] = {
+        "checkout_request_id": checkout_request_id,
+        "merchant_request_id": merchant_request_id,
+        "amount": payload["Amount"],
+        "phone": str(payload["PhoneNumber"]),
+        "callback_url": payload["CallBackURL"],
+        "status": "pending"
+    }
+    stats["stk_pushes"] += 1
+
+    task = asyncio.create_task(complete_transaction(checkout_request_id))
+    _callback_tasks.add(task)
+    task.add_done_callback(_callback_tasks.discard)
+
+    return {
+        "MerchantRequestID": merchant_request_id,
+        "CheckoutRequestID": checkout_request_id,
+        "ResponseCode": "0",
+        "ResponseDescription": "Success. Request accepted for processing",
+        "CustomerMessage": "Success. Request accepted for processing"
+    }
+
+@app.post("/mpesa/stkpushquery/v1/query")
+async def stk_query(request: Request):
+    error = await simulate_network()
+    if error:
+        return error
+    if not check_bearer(request):
+        return daraja_error(401, "404.001.03", "Invalid Access Token")
+
+    payload = await request.json()
+    stats["queries"] += 1
+    transaction = transactions.get(payload.get("CheckoutRequestID"))
+    if not transaction:
+        return daraja_error(400, "400.002.02", "Bad Request - Invalid CheckoutRequestID")
+    if transaction["status"] == "pending":
+        return daraja_error(500, "500.001.1001", "The transaction is being processed")
+
+    return {
+        "ResponseCode": "0",
+        "ResponseDescription": "The service request has been accepted successsfully",
+        "MerchantRequestID": transaction["merchant_request_id"],
+        "CheckoutRequestID": transaction["checkout_request_id"],
+        "ResultCode": str(transaction["result_code"]),
+        "ResultDesc": transaction["result_desc"]
+    }
+
+@app.get("/simulator/config")
+async def get_config():
+    return config
+
+@app.put("/simulator/config")
+async def update_config(update: dict):
+    unknown = [k for k in update if k not in config]
+    if unknown:
+        return JSONResponse(status_code=400, content={"detail": f"Unknown settings: {', '.join(unknown)}"})
+    for key, value in update.items():
+        config[key] = type(config[key])(value)
+    return config
+
+@app.get("/simulator/stats")
+async def get_stats():
+    pending = sum(1 for t in transactions.values() if t["status"] == "pending")
+    return {**stats, "transactions": len(transactions), "pending": pending}
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host="0.0.0.0", port=int(os.environ.get('SIM_PORT', '8090')))
@@ -1,30 +1,47 @@
 from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, Request, BackgroundTasks, UploadFile, File, Form
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, StreamingResponse
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
+from fastapi.encoders import jsonable_encoder
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError, BulkWriteError
 import os
+import asyncio
+import csv
+import json
 import logging
+import random
+import time
 import base64
 import httpx
 import smtplib
+import ssl
+import queue
 import shutil
 import io
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from pathlib import Path
 from pydantic import BaseModel, Field, EmailStr, ConfigDict
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Callable, Tuple
 import uuid
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone, timedelta
 from enum import Enum
 import bcrypt
+import numpy as np
+import pandas as pd
 import jwt
 import re
 import secrets
+import hashlib
 import string
+from html import escape as escape_html
+from collections import OrderedDict
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -33,15 +50,37 @@ load_dotenv(ROOT_DIR / '.env')
 UPLOAD_DIR = ROOT_DIR / "uploads"
 UPLOAD_DIR.mkdir(exist_ok=True)
 
+TEMPLATE_DIR = ROOT_DIR / "templates"
+INVOICE_CACHE_SIZE = int(os.environ.get('INVOICE_CACHE_SIZE', '256'))
+
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, tz_aware=True)
 db = client[os.environ['DB_NAME']]
 
 # JWT Configuration
 JWT_SECRET = os.environ.get('JWT_SECRET', 'wacka-accessories-secret-key-2025')
 JWT_ALGORITHM = "HS256"
 JWT_EXPIRATION_HOURS = 24
+# Tokens for EventSource URLs, which end up in access logs and browser history; only
+# checked when a stream connects, so they can be very short-lived
+STREAM_TOKEN_TTL_SECONDS = int(os.environ.get('STREAM_TOKEN_TTL_SECONDS', '60'))
+
+# Password hashing: bcrypt runs on a bounded thread pool, never on the event loop
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', '12'))
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', str(min(4, os.cpu_count() or 1))))
+PASSWORD_HASH_MAX_PENDING = int(os.environ.get('PASSWORD_HASH_MAX_PENDING', '64'))
+# Authenticated users are cached in-process for this many seconds (0 disables the cache)
+USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', '30'))
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', '10000'))
+
+# Rate limiting: "memory" keeps token buckets per process; "mongo" also enforces a
+# counter shared by all workers
+RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'memory')
+RATE_LIMIT_MAX_KEYS = int(os.environ.get('RATE_LIMIT_MAX_KEYS', '100000'))
+# X-Real-IP is only trusted on requests from these addresses (the nginx proxy)
+TRUSTED_PROXIES = set(filter(None, os.environ.get('TRUSTED_PROXIES', '127.0.0.1,::1').split(',')))
 
 # M-Pesa Configuration
 MPESA_CONSUMER_KEY = os.environ.get('MPESA_CONSUMER_KEY', '')
@@ -50,14 +89,93 @@ MPESA_SHORTCODE = os.environ.get('MPESA_SHORTCODE', '174379')
 MPESA_PASSKEY = os.environ.get('MPESA_PASSKEY', 'bfb279f9aa9bdbcf158e97dd71a467cd2e0c893059b10f78e6b72ada1ed2c919')
 MPESA_CALLBACK_URL = os.environ.get('MPESA_CALLBACK_URL', '')
 MPESA_ENVIRONMENT = os.environ.get('MPESA_ENVIRONMENT', 'sandbox')
+# Overrides the Safaricom host, e.g. to point at the local simulator (mpesa_simulator.py)
+MPESA_BASE_URL = os.environ.get('MPESA_BASE_URL', '')
+MPESA_HTTP_TIMEOUT = float(os.environ.get('MPESA_HTTP_TIMEOUT', '15'))
+MPESA_HTTP_CONNECT_TIMEOUT = float(os.environ.get('MPESA_HTTP_CONNECT_TIMEOUT', '10'))
+MPESA_HTTP_MAX_CONNECTIONS = int(os.environ.get('MPESA_HTTP_MAX_CONNECTIONS', '20'))
+MPESA_HTTP_MAX_KEEPALIVE = int(os.environ.get('MPESA_HTTP_MAX_KEEPALIVE', '10'))
+MPESA_HTTP_KEEPALIVE_EXPIRY = float(os.environ.get('MPESA_HTTP_KEEPALIVE_EXPIRY', '60'))
+# Outbound call protection: in-flight cap, circuit breaker and retries for idempotent calls
+MPESA_MAX_IN_FLIGHT = int(os.environ.get('MPESA_MAX_IN_FLIGHT', '20'))
+MPESA_SLOT_TIMEOUT = float(os.environ.get('MPESA_SLOT_TIMEOUT', '2'))
+MPESA_BREAKER_FAILURE_THRESHOLD = int(os.environ.get('MPESA_BREAKER_FAILURE_THRESHOLD', '5'))
+MPESA_BREAKER_RESET_TIMEOUT = float(os.environ.get('MPESA_BREAKER_RESET_TIMEOUT', '30'))
+MPESA_RETRY_ATTEMPTS = int(os.environ.get('MPESA_RETRY_ATTEMPTS', '3'))
+MPESA_RETRY_BASE_DELAY = float(os.environ.get('MPESA_RETRY_BASE_DELAY', '0.5'))
+MPESA_RETRY_MAX_DELAY = float(os.environ.get('MPESA_RETRY_MAX_DELAY', '4'))
+MPESA_TOKEN_REFRESH_MARGIN = float(os.environ.get('MPESA_TOKEN_REFRESH_MARGIN', '120'))
+MPESA_CALLBACK_WORKERS = int(os.environ.get('MPESA_CALLBACK_WORKERS', '4'))
+MPESA_CALLBACK_MAX_ATTEMPTS = int(os.environ.get('MPESA_CALLBACK_MAX_ATTEMPTS', '5'))
+MPESA_CALLBACK_RETRY_DELAY = float(os.environ.get('MPESA_CALLBACK_RETRY_DELAY', '5'))
+MPESA_CALLBACK_LEASE_SECONDS = float(os.environ.get('MPESA_CALLBACK_LEASE_SECONDS', '120'))
+MPESA_CALLBACK_POLL_INTERVAL = float(os.environ.get('MPESA_CALLBACK_POLL_INTERVAL', '5'))
+MPESA_CALLBACK_RETENTION_DAYS = int(os.environ.get('MPESA_CALLBACK_RETENTION_DAYS', '30'))
+MPESA_RECONCILE_INTERVAL = float(os.environ.get('MPESA_RECONCILE_INTERVAL', '300'))
+MPESA_RECONCILE_AFTER_MINUTES = float(os.environ.get('MPESA_RECONCILE_AFTER_MINUTES', '5'))
+MPESA_RECONCILE_CONCURRENCY = int(os.environ.get('MPESA_RECONCILE_CONCURRENCY', '5'))
+MPESA_RECONCILE_PAGE_SIZE = int(os.environ.get('MPESA_RECONCILE_PAGE_SIZE', '100'))
+
+# Payment status push (SSE / long-poll)
+PAYMENT_EVENTS_BACKEND = os.environ.get('PAYMENT_EVENTS_BACKEND', 'memory')  # memory | mongo (change streams, needs a replica set)
+PAYMENT_EVENTS_HEARTBEAT = float(os.environ.get('PAYMENT_EVENTS_HEARTBEAT', '15'))
+PAYMENT_EVENTS_MAX_STREAM_SECONDS = float(os.environ.get('PAYMENT_EVENTS_MAX_STREAM_SECONDS', '300'))
+PAYMENT_EVENTS_MAX_WAIT = float(os.environ.get('PAYMENT_EVENTS_MAX_WAIT', '30'))
+
+# Live admin dashboard stream (SSE)
+ADMIN_EVENTS_BACKEND = os.environ.get('ADMIN_EVENTS_BACKEND', 'memory')  # memory | mongo (change streams, needs a replica set)
+ADMIN_EVENTS_HEARTBEAT = float(os.environ.get('ADMIN_EVENTS_HEARTBEAT', '15'))
+ADMIN_EVENTS_MAX_STREAM_SECONDS = float(os.environ.get('ADMIN_EVENTS_MAX_STREAM_SECONDS', '3600'))
+ADMIN_EVENTS_QUEUE_SIZE = int(os.environ.get('ADMIN_EVENTS_QUEUE_SIZE', '100'))
+ADMIN_EVENTS_BUFFER_SIZE = int(os.environ.get('ADMIN_EVENTS_BUFFER_SIZE', '500'))
+ADMIN_EVENTS_RETENTION_SECONDS = int(os.environ.get('ADMIN_EVENTS_RETENTION_SECONDS', '3600'))
+ADMIN_SNAPSHOT_TTL = float(os.environ.get('ADMIN_SNAPSHOT_TTL', '5'))
+ADMIN_STATS_DEBOUNCE = float(os.environ.get('ADMIN_STATS_DEBOUNCE', '1'))  # seconds to gather events before recomputing stats
 
 # Email Configuration
 SMTP_EMAIL = os.environ.get('SMTP_EMAIL', '')
 SMTP_PASSWORD = os.environ.get('SMTP_PASSWORD', '')
 SMTP_HOST = os.environ.get('SMTP_HOST', 'smtp.gmail.com')
 SMTP_PORT = int(os.environ.get('SMTP_PORT', '587'))
+SMTP_USE_TLS = os.environ.get('SMTP_USE_TLS', 'true').lower() == 'true'
+# Disable for a local debugging server, e.g. `python -m aiosmtpd -n -l localhost:1025`
+SMTP_AUTH = os.environ.get('SMTP_AUTH', 'true').lower() == 'true'
+SMTP_TIMEOUT = float(os.environ.get('SMTP_TIMEOUT', '30'))
+SMTP_POOL_SIZE = int(os.environ.get('SMTP_POOL_SIZE', '3'))
+SMTP_IDLE_TIMEOUT = float(os.environ.get('SMTP_IDLE_TIMEOUT', '60'))
+SMTP_MAX_MESSAGES_PER_CONNECTION = int(os.environ.get('SMTP_MAX_MESSAGES_PER_CONNECTION', '100'))
+
+# Email outbox; the send rate is per server process, so divide it between processes
+EMAIL_OUTBOX_WORKERS = int(os.environ.get('EMAIL_OUTBOX_WORKERS', str(SMTP_POOL_SIZE)))
+EMAIL_RATE_PER_MINUTE = float(os.environ.get('EMAIL_RATE_PER_MINUTE', '60'))
+EMAIL_MAX_ATTEMPTS = int(os.environ.get('EMAIL_MAX_ATTEMPTS', '6'))
+EMAIL_RETRY_DELAY = float(os.environ.get('EMAIL_RETRY_DELAY', '30'))
+EMAIL_LEASE_SECONDS = float(os.environ.get('EMAIL_LEASE_SECONDS', '120'))
+EMAIL_POLL_INTERVAL = float(os.environ.get('EMAIL_POLL_INTERVAL', '5'))
+EMAIL_COALESCE_WINDOW = float(os.environ.get('EMAIL_COALESCE_WINDOW', '60'))
+EMAIL_OUTBOX_RETENTION_DAYS = int(os.environ.get('EMAIL_OUTBOX_RETENTION_DAYS', '14'))
+
+# Bulk email campaigns
+EMAIL_CAMPAIGN_CONCURRENCY = int(os.environ.get('EMAIL_CAMPAIGN_CONCURRENCY', str(SMTP_POOL_SIZE)))
+EMAIL_CAMPAIGN_RATE_PER_MINUTE = float(os.environ.get('EMAIL_CAMPAIGN_RATE_PER_MINUTE', '120'))
+EMAIL_CAMPAIGN_MAX_ATTEMPTS = int(os.environ.get('EMAIL_CAMPAIGN_MAX_ATTEMPTS', '3'))
+EMAIL_CAMPAIGN_BATCH_SIZE = int(os.environ.get('EMAIL_CAMPAIGN_BATCH_SIZE', '200'))
+# A sending campaign is leased to one server process and renewed while it runs; another
+# process only takes it over once the lease has run out
+EMAIL_CAMPAIGN_LEASE_SECONDS = float(os.environ.get('EMAIL_CAMPAIGN_LEASE_SECONDS', '120'))
 ADMIN_EMAIL = os.environ.get('ADMIN_EMAIL', SMTP_EMAIL)
 
+# Low-stock alerts: each product alerts at most once per cooldown, and alerts are
+# emailed as one digest per window
+LOW_STOCK_ALERT_COOLDOWN = float(os.environ.get('LOW_STOCK_ALERT_COOLDOWN', '86400'))
+LOW_STOCK_DIGEST_WINDOW = float(os.environ.get('LOW_STOCK_DIGEST_WINDOW', '900'))
+LOW_STOCK_DIGEST_RETENTION_DAYS = int(os.environ.get('LOW_STOCK_DIGEST_RETENTION_DAYS', '7'))
+
+# Sales analytics results are cached per (metric, range, granularity)
+ANALYTICS_CACHE_TTL = float(os.environ.get('ANALYTICS_CACHE_TTL', '300'))
+ANALYTICS_CACHE_SIZE = int(os.environ.get('ANALYTICS_CACHE_SIZE', '256'))
+ANALYTICS_MAX_DAYS = int(os.environ.get('ANALYTICS_MAX_DAYS', '1830'))
+
 # Create the main app
 app = FastAPI(title="Wacka Accessories API", version="1.0.0")
 api_router = APIRouter(prefix="/api")
@@ -111,268 +229,447 @@ class ProductStatus(str, Enum):
     DRAFT = "draft"
     OUT_OF_STOCK = "out_of_stock"
 
+# ==================== TEMPLATES ====================
+class SafeHTML(str):
+    """Already-rendered markup, inserted into templates without escaping"""
+
+class TemplateRenderer:
+    """HTML templates under backend/templates, compiled once when the module loads.
+    
+    A template can `{{ include path }}` a partial and `{{ extends layout }}`, filling
+    the layout's `{{ slot name }}` placeholders from `{{ block name }}...{{ endblock }}`
+    sections. Includes and layouts are resolved at load time, leaving one
+    string.Template per file; `$name` values are HTML-escaped on render unless they
+    are SafeHTML.
+    """
+    
+    INCLUDE = re.compile(r"\{\{\s*include\s+([\w./-]+)\s*\}\}")
+    EXTENDS = re.compile(r"^\s*\{\{\s*extends\s+([\w./-]+)\s*\}\}")
+    BLOCK = re.compile(r"\{\{\s*block\s+(\w+)\s*\}\}\n?(.*?)\{\{\s*endblock\s*\}\}", re.S)
+    SLOT = re.compile(r"\{\{\s*slot\s+(\w+)\s*\}\}")
+    
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self._compiled: Dict[str, string.Template] = {}
+        self.load()
+    
+    def _source(self, name: str, parents: tuple = ()) -> str:
+        if name in parents:
+            raise ValueError(f"Template cycle: {' -> '.join(parents + (name,))}")
+        text = (self.directory / name).read_text(encoding="utf-8")
+        parents = parents + (name,)
+        
+        extends = self.EXTENDS.match(text)
+        if extends:
+            blocks = dict(self.BLOCK.findall(text))
+            layout = self._source(extends.group(1), parents)
+            text = self.SLOT.sub(lambda m: blocks.get(m.group(1), "").rstrip("\n"), layout)
+        return self.INCLUDE.sub(lambda m: self._source(m.group(1), parents).rstrip("\n"), text)
+    
+    def load(self):
+        compiled = {}
+        for path in sorted(self.directory.rglob("*")):
+            if path.suffix in (".html", ".css"):
+                name = path.relative_to(self.directory).as_posix()
+                compiled[name] = string.Template(self._source(name))
+        self._compiled = compiled
+        logger.info(f"Compiled {len(compiled)} templates")
+    
+    def render(self, name: str, **context) -> SafeHTML:
+        values = {
+            key: value if isinstance(value, SafeHTML) else escape_html(str(value))
+            for key, value in context.items()
+        }
+        return SafeHTML(self._compiled[name].substitute(values))
+    
+    def render_rows(self, name: str, rows: List[dict]) -> SafeHTML:
+        return SafeHTML("".join(self.render(name, **row) for row in rows))
+
+template_renderer = TemplateRenderer(TEMPLATE_DIR)
+
+class RenderCache:
+    """LRU cache of rendered documents, keyed so that any change to the source gives a new key"""
+    
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._entries: "OrderedDict[tuple, str]" = OrderedDict()
+    
+    def get_or_render(self, key: tuple, render: Callable[[], str]) -> str:
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            metrics.inc("render_cache_hits_total", template=key[0])
+            return self._entries[key]
+        metrics.inc("render_cache_misses_total", template=key[0])
+        rendered = render()
+        self._entries[key] = rendered
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return rendered
+
+invoice_cache = RenderCache(INVOICE_CACHE_SIZE)
+
+def order_items_html(order: dict) -> SafeHTML:
+    return template_renderer.render_rows("partials/order_item_row.html", [
+        {"product_name": item["product_name"], "quantity": item["quantity"], "price": f"{item['price']:,.0f}"}
+        for item in order.get("items", [])
+    ])
+
 # ==================== EMAIL SERVICE ====================
+class _SMTPConnection:
+    def __init__(self, smtp: smtplib.SMTP):
+        self.smtp = smtp
+        self.messages_sent = 0
+        self.last_used = time.monotonic()
+    
+    def close(self):
+        try:
+            self.smtp.quit()
+        except Exception:
+            self.smtp.close()
+
+class SMTPConnectionPool:
+    """Reusable authenticated SMTP connections.
+    
+    smtplib is blocking, so every SMTP call runs on a dedicated thread pool; the pool
+    size bounds both concurrent sends and open connections.
+    """
+    
+    def __init__(self, host: str, port: int, username: str, password: str, size: int = SMTP_POOL_SIZE):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.size = size
+        self._idle: "queue.LifoQueue[_SMTPConnection]" = queue.LifoQueue()
+        self._executor: Optional[ThreadPoolExecutor] = None
+    
+    def _connect(self) -> _SMTPConnection:
+        smtp = smtplib.SMTP(self.host, self.port, timeout=SMTP_TIMEOUT)
+        try:
+            if SMTP_USE_TLS:
+                smtp.starttls(context=ssl.create_default_context())
+            if SMTP_AUTH:
+                smtp.login(self.username, self.password)
+        except Exception:
+            smtp.close()
+            raise
+        return _SMTPConnection(smtp)
+    
+    def _acquire(self) -> _SMTPConnection:
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                return self._connect()
+            # Servers drop idle sessions; don't bother reusing one that has sat too long
+            if time.monotonic() - conn.last_used < SMTP_IDLE_TIMEOUT:
+                return conn
+            conn.close()
+    
+    def _release(self, conn: _SMTPConnection):
+        conn.last_used = time.monotonic()
+        if conn.messages_sent >= SMTP_MAX_MESSAGES_PER_CONNECTION:
+            conn.close()
+        else:
+            self._idle.put(conn)
+    
+    def _send_sync(self, from_addr: str, to_addrs: List[str], message: str):
+        conn = self._acquire()
+        try:
+            try:
+                conn.smtp.sendmail(from_addr, to_addrs, message)
+            except smtplib.SMTPServerDisconnected:
+                # A pooled connection went stale; reconnect once
+                conn.close()
+                conn = self._connect()
+                conn.smtp.sendmail(from_addr, to_addrs, message)
+        except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError):
+            # The server rejected this message but the session is still usable
+            try:
+                conn.smtp.rset()
+                self._release(conn)
+            except Exception:
+                conn.close()
+            raise
+        except Exception:
+            conn.close()
+            raise
+        conn.messages_sent += 1
+        self._release(conn)
+    
+    async def send(self, from_addr: str, to_addrs: List[str], message: str):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.size, thread_name_prefix="smtp")
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._send_sync, from_addr, to_addrs, message)
+    
+    def _close_idle(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+    
+    async def close(self):
+        if self._executor is None:
+            return
+        executor, self._executor = self._executor, None
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(executor, self._close_idle)
+        executor.shutdown(wait=False)
+
 class EmailService:
     def __init__(self):
         self.smtp_email = SMTP_EMAIL
         self.smtp_password = SMTP_PASSWORD
         self.smtp_host = SMTP_HOST
         self.smtp_port = SMTP_PORT
+        self.pool = SMTPConnectionPool(SMTP_HOST, SMTP_PORT, SMTP_EMAIL, SMTP_PASSWORD)
     
-    def send_email(self, to_email: str, subject: str, html_content: str):
-        if not self.smtp_email or not self.smtp_password:
-            logger.warning("Email not configured, skipping send")
-            return False
-        
-        try:
-            msg = MIMEMultipart('alternative')
-            msg['Subject'] = subject
-            msg['From'] = f"Wacka Accessories <{self.smtp_email}>"
-            msg['To'] = to_email
-            
-            html_part = MIMEText(html_content, 'html')
-            msg.attach(html_part)
-            
-            with smtplib.SMTP(self.smtp_host, self.smtp_port) as server:
-                server.starttls()
-                server.login(self.smtp_email, self.smtp_password)
-                server.sendmail(self.smtp_email, to_email, msg.as_string())
-            
-            logger.info(f"Email sent to {to_email}")
-            return True
-        except Exception as e:
-            logger.error(f"Failed to send email: {str(e)}")
-            return False
+    @property
+    def is_configured(self) -> bool:
+        return bool(self.smtp_email and (self.smtp_password or not SMTP_AUTH))
     
-    def send_order_confirmation(self, order: dict, customer_email: str):
-        items_html = ""
-        for item in order.get("items", []):
-            items_html += f"""
-            <tr>
-                <td style="padding: 10px; border-bottom: 1px solid #eee;">{item['product_name']}</td>
-                <td style="padding: 10px; border-bottom: 1px solid #eee; text-align: center;">{item['quantity']}</td>
-                <td style="padding: 10px; border-bottom: 1px solid #eee; text-align: right;">KES {item['price']:,.0f}</td>
-            </tr>
-            """
+    def build_message(self, to_email: str, subject: str, html_content: str) -> str:
+        msg = MIMEMultipart('alternative')
+        msg['Subject'] = subject
+        msg['From'] = f"Wacka Accessories <{self.smtp_email}>"
+        msg['To'] = to_email
         
+        html_part = MIMEText(html_content, 'html')
+        msg.attach(html_part)
+        return msg.as_string()
+    
+    async def deliver(self, to_email: str, subject: str, html_content: str):
+        """Send one message right away, raising on failure"""
+        message = self.build_message(to_email, subject, html_content)
+        await self.pool.send(self.smtp_email, [to_email], message)
+        logger.info(f"Email sent to {to_email}")
+    
+    async def queue_email(self, to_email: str, subject: str, html_content: str, kind: str, coalesce_key: Optional[str] = None, delay: float = 0):
+        """Hand a message to the durable outbox; returns the outbox id, or None if email is not configured"""
+        if not self.is_configured:
+            logger.warning("Email not configured, skipping send")
+            return None
+        return await email_outbox.enqueue(to_email, subject, html_content, kind, coalesce_key, delay)
+    
+    async def close(self):
+        await self.pool.close()
+    
+    async def send_order_confirmation(self, order: dict, customer_email: str):
         delivery_method = order.get('delivery_method', 'delivery')
-        delivery_text = "Delivery" if delivery_method == "delivery" else "Store Pickup"
-        
-        html = f"""
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <style>
-                body {{ font-family: Arial, sans-serif; line-height: 1.6; color: #333; }}
-                .container {{ max-width: 600px; margin: 0 auto; padding: 20px; }}
-                .header {{ background: #10B981; color: white; padding: 20px; text-align: center; }}
-                .content {{ padding: 20px; background: #f9f9f9; }}
-                .order-table {{ width: 100%; border-collapse: collapse; margin: 20px 0; }}
-                .order-table th {{ background: #f3f4f6; padding: 10px; text-align: left; }}
-                .total {{ font-size: 18px; font-weight: bold; text-align: right; margin-top: 20px; }}
-                .footer {{ text-align: center; padding: 20px; color: #666; font-size: 12px; }}
-            </style>
-        </head>
-        <body>
-            <div class="container">
-                <div class="header">
-                    <h1>Order Confirmed!</h1>
-                </div>
-                <div class="content">
-                    <p>Thank you for your order at Wacka Accessories!</p>
-                    <p><strong>Order ID:</strong> #{order['id'][:8].upper()}</p>
-                    <p><strong>Status:</strong> {order['status'].replace('_', ' ').title()}</p>
-                    <p><strong>Delivery Method:</strong> {delivery_text}</p>
-                    
-                    <table class="order-table">
-                        <thead>
-                            <tr>
-                                <th>Product</th>
-                                <th style="text-align: center;">Qty</th>
-                                <th style="text-align: right;">Price</th>
-                            </tr>
-                        </thead>
-                        <tbody>
-                            {items_html}
-                        </tbody>
-                    </table>
-                    
-                    <p class="total">Total: KES {order['total_amount']:,.0f}</p>
-                    
-                    <p>We'll notify you when your order ships.</p>
-                </div>
-                <div class="footer">
-                    <p>Wacka Accessories - Premium Accessories for the Modern You</p>
-                    <p>Questions? Contact us at {self.smtp_email}</p>
-                </div>
-            </div>
-        </body>
-        </html>
-        """
+        context = {
+            "order_ref": order['id'][:8].upper(),
+            "status": order['status'].replace('_', ' ').title(),
+            "delivery_method": "Delivery" if delivery_method == "delivery" else "Store Pickup",
+            "items": order_items_html(order),
+            "total": f"{order['total_amount']:,.0f}"
+        }
         
         # Send to customer
-        customer_result = self.send_email(customer_email, f"Order Confirmed - #{order['id'][:8].upper()}", html)
+        html = template_renderer.render("emails/order_confirmation.html", support_email=self.smtp_email, **context)
+        customer_result = await self.queue_email(customer_email, f"Order Confirmed - #{context['order_ref']}", html, kind="order_confirmation")
         
         # Send to admin
         if ADMIN_EMAIL and ADMIN_EMAIL != customer_email:
-            admin_html = f"""
-            <!DOCTYPE html>
-            <html>
-            <head>
-                <style>
-                    body {{ font-family: Arial, sans-serif; line-height: 1.6; color: #333; }}
-                    .container {{ max-width: 600px; margin: 0 auto; padding: 20px; }}
-                    .header {{ background: #3B82F6; color: white; padding: 20px; text-align: center; }}
-                    .content {{ padding: 20px; background: #f9f9f9; }}
-                    .order-table {{ width: 100%; border-collapse: collapse; margin: 20px 0; }}
-                    .order-table th {{ background: #f3f4f6; padding: 10px; text-align: left; }}
-                    .total {{ font-size: 18px; font-weight: bold; text-align: right; margin-top: 20px; }}
-                    .footer {{ text-align: center; padding: 20px; color: #666; font-size: 12px; }}
-                </style>
-            </head>
-            <body>
-                <div class="container">
-                    <div class="header">
-                        <h1>🛍️ New Order Received</h1>
-                    </div>
-                    <div class="content">
-                        <p><strong>Order ID:</strong> #{order['id'][:8].upper()}</p>
-                        <p><strong>Customer Email:</strong> {customer_email}</p>
-                        <p><strong>Status:</strong> {order['status'].replace('_', ' ').title()}</p>
-                        <p><strong>Payment Method:</strong> {order.get('payment_method', 'mpesa').replace('_', ' ').title()}</p>
-                        <p><strong>Delivery Method:</strong> {delivery_text}</p>
-                        
-                        <table class="order-table">
-                            <thead>
-                                <tr>
-                                    <th>Product</th>
-                                    <th style="text-align: center;">Qty</th>
-                                    <th style="text-align: right;">Price</th>
-                                </tr>
-                            </thead>
-                            <tbody>
-                                {items_html}
-                            </tbody>
-                        </table>
-                        
-                        <p class="total">Total: KES {order['total_amount']:,.0f}</p>
-                        
-                        <p>Please process this order promptly.</p>
-                    </div>
-                    <div class="footer">
-                        <p>Wacka Accessories Admin Notification</p>
-                    </div>
-                </div>
-            </body>
-            </html>
-            """
-            self.send_email(ADMIN_EMAIL, f"New Order #{order['id'][:8].upper()}", admin_html)
+            admin_html = template_renderer.render(
+                "emails/admin_new_order.html",
+                customer_email=customer_email,
+                payment_method=order.get('payment_method', 'mpesa').replace('_', ' ').title(),
+                **context
+            )
+            await self.queue_email(ADMIN_EMAIL, f"New Order #{context['order_ref']}", admin_html, kind="admin_new_order")
         
         return customer_result
     
-    def send_payment_success(self, order: dict, customer_email: str, receipt: str):
-        html = f"""
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <style>
-                body {{ font-family: Arial, sans-serif; line-height: 1.6; color: #333; }}
-                .container {{ max-width: 600px; margin: 0 auto; padding: 20px; }}
-                .header {{ background: #10B981; color: white; padding: 20px; text-align: center; }}
-                .content {{ padding: 20px; background: #f9f9f9; }}
-                .success-box {{ background: #d1fae5; border: 1px solid #10B981; padding: 15px; border-radius: 8px; margin: 20px 0; }}
-                .footer {{ text-align: center; padding: 20px; color: #666; font-size: 12px; }}
-            </style>
-        </head>
-        <body>
-            <div class="container">
-                <div class="header">
-                    <h1>Payment Successful!</h1>
-                </div>
-                <div class="content">
-                    <div class="success-box">
-                        <p><strong>M-Pesa Receipt:</strong> {receipt}</p>
-                        <p><strong>Amount:</strong> KES {order['total_amount']:,.0f}</p>
-                    </div>
-                    
-                    <p><strong>Order ID:</strong> #{order['id'][:8].upper()}</p>
-                    <p>Your payment has been received and your order is now being processed.</p>
-                    <p>We'll notify you when your order ships.</p>
-                </div>
-                <div class="footer">
-                    <p>Wacka Accessories - Premium Accessories for the Modern You</p>
-                </div>
-            </div>
-        </body>
-        </html>
-        """
-        
-        return self.send_email(customer_email, f"Payment Received - #{order['id'][:8].upper()}", html)
+    async def send_payment_success(self, order: dict, customer_email: str, receipt: str):
+        html = template_renderer.render(
+            "emails/payment_success.html",
+            receipt=receipt,
+            total=f"{order['total_amount']:,.0f}",
+            order_ref=order['id'][:8].upper()
+        )
+        return await self.queue_email(customer_email, f"Payment Received - #{order['id'][:8].upper()}", html, kind="payment_success")
     
-    def send_low_stock_alert(self, products: list):
+    async def send_low_stock_alert(self, products: list, digest_id: str, delay: float = EMAIL_COALESCE_WINDOW):
         if not ADMIN_EMAIL:
             return False
         
-        items_html = ""
-        for p in products:
-            items_html += f"""
-            <tr>
-                <td style="padding: 10px; border-bottom: 1px solid #eee;">{p['product_name']}</td>
-                <td style="padding: 10px; border-bottom: 1px solid #eee; text-align: center; color: #f59e0b; font-weight: bold;">{p['quantity']}</td>
-                <td style="padding: 10px; border-bottom: 1px solid #eee; text-align: center;">{p['threshold']}</td>
-            </tr>
-            """
-        
-        html = f"""
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <style>
-                body {{ font-family: Arial, sans-serif; line-height: 1.6; color: #333; }}
-                .container {{ max-width: 600px; margin: 0 auto; padding: 20px; }}
-                .header {{ background: #f59e0b; color: white; padding: 20px; text-align: center; }}
-                .content {{ padding: 20px; background: #f9f9f9; }}
-                .alert-table {{ width: 100%; border-collapse: collapse; margin: 20px 0; }}
-                .alert-table th {{ background: #fef3c7; padding: 10px; text-align: left; }}
-                .footer {{ text-align: center; padding: 20px; color: #666; font-size: 12px; }}
-            </style>
-        </head>
-        <body>
-            <div class="container">
-                <div class="header">
-                    <h1>⚠️ Low Stock Alert</h1>
-                </div>
-                <div class="content">
-                    <p>The following products are running low on stock:</p>
-                    
-                    <table class="alert-table">
-                        <thead>
-                            <tr>
-                                <th>Product</th>
-                                <th style="text-align: center;">Current Stock</th>
-                                <th style="text-align: center;">Threshold</th>
-                            </tr>
-                        </thead>
-                        <tbody>
-                            {items_html}
-                        </tbody>
-                    </table>
-                    
-                    <p>Please restock these items soon to avoid stockouts.</p>
-                    <p><a href="#">Go to Admin Dashboard</a></p>
-                </div>
-                <div class="footer">
-                    <p>Wacka Accessories Admin Notification</p>
-                </div>
-            </div>
-        </body>
-        </html>
-        """
+        html = template_renderer.render(
+            "emails/low_stock_alert.html",
+            items=template_renderer.render_rows("partials/low_stock_row.html", products)
+        )
         
-        return self.send_email(ADMIN_EMAIL, "Low Stock Alert - Wacka Accessories", html)
+        # The digest is re-rendered as products join it; the queued copy is replaced, not added to
+        return await self.queue_email(
+            ADMIN_EMAIL, "Low Stock Alert - Wacka Accessories", html,
+            kind="low_stock_alert", coalesce_key=f"low_stock_alert:{ADMIN_EMAIL}:{digest_id}", delay=delay
+        )
 
 email_service = EmailService()
 
+class SendRateLimiter:
+    """Spaces sends evenly so that all callers in this process together stay under rate_per_minute"""
+    
+    def __init__(self, rate_per_minute: float):
+        self.rate_per_minute = rate_per_minute
+        self._lock = asyncio.Lock()
+        self._next_at = 0.0
+    
+    async def wait(self):
+        if self.rate_per_minute <= 0:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            delay = self._next_at - now
+            self._next_at = max(now, self._next_at) + 60.0 / self.rate_per_minute
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+class EmailOutbox:
+    """Durable outgoing email queue backed by the email_outbox collection.
+    
+    The workers in one process send at no more than EMAIL_RATE_PER_MINUTE between
+    them (each server process has its own limit), retry failures with exponential
+    backoff and dead-letter after EMAIL_MAX_ATTEMPTS. Messages with a coalesce_key
+    replace a still-pending message with the same key instead of queueing another one.
+    """
+    
+    def __init__(self, workers: int = EMAIL_OUTBOX_WORKERS):
+        self.workers = workers
+        self._tasks: List[asyncio.Task] = []
+        self._wakeup = asyncio.Event()
+        self._rate_limiter = SendRateLimiter(EMAIL_RATE_PER_MINUTE)
+        self.depth = 0
+    
+    async def enqueue(self, to_email: str, subject: str, html_content: str, kind: str, coalesce_key: Optional[str] = None, delay: float = 0) -> str:
+        now = datetime.now(timezone.utc)
+        if coalesce_key:
+            existing = await db.email_outbox.find_one_and_update(
+                {"coalesce_key": coalesce_key, "status": "pending"},
+                {"$set": {"to": to_email, "subject": subject, "html": html_content, "updated_at": now}, "$inc": {"coalesced": 1}},
+                projection={"_id": 0, "id": 1}
+            )
+            if existing:
+                metrics.inc("emails_coalesced_total", kind=kind)
+                return existing["id"]
+        
+        message_id = str(uuid.uuid4())
+        message = {
+            "id": message_id,
+            "to": to_email,
+            "subject": subject,
+            "html": html_content,
+            "kind": kind,
+            "status": "pending",
+            "attempts": 0,
+            "next_attempt_at": now + timedelta(seconds=delay),
+            "created_at": now
+        }
+        if coalesce_key:
+            message["coalesce_key"] = coalesce_key
+        try:
+            await db.email_outbox.insert_one(message)
+        except DuplicateKeyError:
+            # Lost a race with another enqueue for the same key; merge into its message
+            return await self.enqueue(to_email, subject, html_content, kind, coalesce_key, delay)
+        
+        metrics.inc("emails_queued_total", kind=kind)
+        self.depth += 1
+        if delay <= 0:
+            self._wakeup.set()
+        return message_id
+    
+    async def _claim(self) -> Optional[dict]:
+        now = datetime.now(timezone.utc)
+        return await db.email_outbox.find_one_and_update(
+            {
+                "$or": [
+                    {"status": "pending", "next_attempt_at": {"$lte": now}},
+                    {"status": "sending", "locked_until": {"$lt": now}}
+                ]
+            },
+            {
+                "$set": {"status": "sending", "locked_until": now + timedelta(seconds=EMAIL_LEASE_SECONDS)},
+                "$inc": {"attempts": 1}
+            },
+            sort=[("next_attempt_at", 1)],
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER
+        )
+    
+    async def _complete(self, message: dict):
+        now = datetime.now(timezone.utc)
+        await db.email_outbox.update_one(
+            {"id": message["id"]},
+            {"$set": {"status": "sent", "sent_at": now}, "$unset": {"locked_until": "", "html": ""}}
+        )
+        metrics.inc("emails_sent_total", kind=message["kind"])
+        metrics.observe("email_queue_latency_seconds", (now - message["created_at"]).total_seconds(), kind=message["kind"])
+    
+    async def _fail(self, message: dict, error: Exception):
+        now = datetime.now(timezone.utc)
+        if message["attempts"] >= EMAIL_MAX_ATTEMPTS:
+            logger.error(f"Dead-lettering email {message['id']} to {message['to']} after {message['attempts']} attempts: {error}")
+            update = {"status": "dead", "dead_at": now, "last_error": str(error)}
+            metrics.inc("emails_dead_total", kind=message["kind"])
+        else:
+            delay = EMAIL_RETRY_DELAY * (2 ** (message["attempts"] - 1))
+            logger.warning(f"Email {message['id']} to {message['to']} failed, retrying in {delay:.0f}s: {error}")
+            update = {"status": "pending", "next_attempt_at": now + timedelta(seconds=delay), "last_error": str(error)}
+            metrics.inc("emails_retried_total", kind=message["kind"])
+        await db.email_outbox.update_one({"id": message["id"]}, {"$set": update, "$unset": {"locked_until": ""}})
+    
+    async def _worker(self):
+        while True:
+            try:
+                message = await self._claim()
+            except Exception as e:
+                logger.error(f"Email outbox unavailable: {str(e)}")
+                message = None
+            
+            if not message:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=EMAIL_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                continue
+            
+            await self._rate_limiter.wait()
+            started = time.monotonic()
+            try:
+                await email_service.deliver(message["to"], message["subject"], message["html"])
+                metrics.observe("email_send_seconds", time.monotonic() - started)
+                await self._complete(message)
+            except Exception as e:
+                try:
+                    await self._fail(message, e)
+                except Exception as update_error:
+                    logger.error(f"Could not reschedule email {message['id']}: {update_error}")
+    
+    async def _monitor(self):
+        while True:
+            try:
+                self.depth = await db.email_outbox.count_documents({"status": {"$in": ["pending", "sending"]}})
+            except Exception as e:
+                logger.warning(f"Could not read email outbox depth: {str(e)}")
+            await asyncio.sleep(EMAIL_POLL_INTERVAL)
+    
+    def start(self):
+        if not self._tasks:
+            metrics.register_gauge("email_outbox_depth", lambda: self.depth)
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+            self._tasks.append(asyncio.create_task(self._monitor()))
+    
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+email_outbox = EmailOutbox()
+
 # ==================== MODELS ====================
 class UserCreate(BaseModel):
     email: EmailStr
@@ -589,6 +886,13 @@ class EnhancedDashboardStats(BaseModel):
     total_customers: int
     pending_orders: int
 
+class AnalyticsGranularity(str, Enum):
+    DAY = "day"
+    WEEK = "week"
+    MONTH = "month"
+    QUARTER = "quarter"
+    YEAR = "year"
+
 class NotificationCreate(BaseModel):
     type: NotificationType
     title: str
@@ -635,6 +939,17 @@ class CustomEmailRequest(BaseModel):
     subject: str
     html_content: str
 
+class CampaignSegment(str, Enum):
+    ALL_CUSTOMERS = "all_customers"
+    BUYERS = "buyers"
+    NON_BUYERS = "non_buyers"
+
+class EmailCampaignCreate(BaseModel):
+    subject: str
+    html_content: str
+    recipient_emails: Optional[List[EmailStr]] = None
+    segment: Optional[CampaignSegment] = None
+
 class UserCreateByAdmin(BaseModel):
     email: EmailStr
     password: str
@@ -797,11 +1112,44 @@ class ActivityLogResponse(BaseModel):
     created_at: datetime
 
 # ==================== AUTH HELPERS ====================
-def hash_password(password: str) -> str:
-    return bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
+_password_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="bcrypt")
+_password_jobs_pending = 0
+
+async def run_password_job(op: str, fn: Callable, *args):
+    """Run a bcrypt call on the password pool, shedding load once too many are queued"""
+    global _password_jobs_pending
+    if _password_jobs_pending >= PASSWORD_HASH_MAX_PENDING:
+        metrics.inc("password_jobs_rejected_total", op=op)
+        raise HTTPException(status_code=503, detail="Server busy, please try again", headers={"Retry-After": "1"})
+    
+    _password_jobs_pending += 1
+    started = time.monotonic()
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_password_executor, fn, *args)
+    finally:
+        _password_jobs_pending -= 1
+        metrics.observe("password_job_seconds", time.monotonic() - started, op=op)
 
-def verify_password(password: str, hashed: str) -> bool:
-    return bcrypt.checkpw(password.encode(), hashed.encode())
+async def hash_password(password: str) -> str:
+    hashed = await run_password_job("hash", bcrypt.hashpw, password.encode(), bcrypt.gensalt(rounds=BCRYPT_ROUNDS))
+    return hashed.decode()
+
+async def verify_password(password: str, hashed: str) -> bool:
+    return await run_password_job("verify", bcrypt.checkpw, password.encode(), hashed.encode())
+
+def password_needs_rehash(hashed: str) -> bool:
+    """True when a stored hash was made with a different BCRYPT_ROUNDS ($2b$<cost>$...)"""
+    try:
+        return int(hashed.split("$")[2]) != BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return False
+
+async def upgrade_password_hash(user_id: str, password: str, old_hash: str):
+    new_hash = await hash_password(password)
+    # Only replace the hash we verified against, in case the password changed meanwhile
+    await db.users.update_one({"id": user_id, "password": old_hash}, {"$set": {"password": new_hash}})
+    logger.info(f"Upgraded password hash for user {user_id} to cost {BCRYPT_ROUNDS}")
 
 def create_token(user_id: str, role: str) -> str:
     payload = {
@@ -811,48 +1159,564 @@ def create_token(user_id: str, role: str) -> str:
     }
     return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    if not credentials:
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    try:
-        payload = jwt.decode(credentials.credentials, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        user_id = payload.get("sub")
-        user = await db.users.find_one({"id": user_id}, {"_id": 0, "password": 0})
-        if not user:
-            raise HTTPException(status_code=401, detail="User not found")
+def create_stream_token(user_id: str) -> str:
+    """A token that only opens event streams; it is not accepted as a bearer token"""
+    payload = {
+        "sub": user_id,
+        "purpose": "stream",
+        "exp": datetime.now(timezone.utc) + timedelta(seconds=STREAM_TOKEN_TTL_SECONDS)
+    }
+    return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
+
+class UserCache:
+    """Short-TTL cache of user documents (without password) keyed by token sub; concurrent misses share one read"""
+    
+    def __init__(self, ttl: float, maxsize: int):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._loading: Dict[str, asyncio.Task] = {}
+    
+    async def get(self, user_id: str) -> Optional[dict]:
+        entry = self._entries.get(user_id)
+        if entry and entry[0] > time.monotonic():
+            self._entries.move_to_end(user_id)
+            metrics.inc("user_cache_hits_total")
+            return entry[1]
+        metrics.inc("user_cache_misses_total")
+        
+        task = self._loading.get(user_id)
+        if task is None:
+            task = asyncio.ensure_future(self._load(user_id))
+            self._loading[user_id] = task
+        # Shielded so that a cancelled request does not abort the read other requests are waiting on
+        return await asyncio.shield(task)
+    
+    async def _load(self, user_id: str) -> Optional[dict]:
+        try:
+            user = await db.users.find_one({"id": user_id}, {"_id": 0, "password": 0})
+        finally:
+            # invalidate() drops the in-flight load, since the read may predate the write
+            current = self._loading.get(user_id) is asyncio.current_task()
+            if current:
+                del self._loading[user_id]
+        if user and current and self.ttl > 0:
+            self._entries[user_id] = (time.monotonic() + self.ttl, user)
+            self._entries.move_to_end(user_id)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
         return user
+    
+    def invalidate(self, user_id: str):
+        self._entries.pop(user_id, None)
+        self._loading.pop(user_id, None)
+
+user_cache = UserCache(USER_CACHE_TTL, USER_CACHE_SIZE)
+
+def decode_token(token: str, purpose: Optional[str] = None) -> dict:
+    """Decode a token issued for purpose; None means a regular session token"""
+    try:
+        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token expired")
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid token")
+    if payload.get("purpose") != purpose:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    return payload
+
+async def load_token_user(payload: dict) -> dict:
+    user = await user_cache.get(payload.get("sub"))
+    if not user:
+        raise HTTPException(status_code=401, detail="User not found")
+    # Cached documents are shared between requests, so each caller gets its own copy
+    return dict(user)
+
+async def get_token_payload(credentials: HTTPAuthorizationCredentials = Depends(security)) -> dict:
+    if not credentials:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    return decode_token(credentials.credentials)
+
+async def get_current_user(payload: dict = Depends(get_token_payload)):
+    return await load_token_user(payload)
+
+async def get_stream_user(token: Optional[str] = None, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Like get_current_user, but also accepts ?token= since EventSource cannot send headers.
+    
+    Only a stream token from POST /auth/stream-token is accepted in the query string,
+    so session tokens never appear in URLs.
+    """
+    if credentials:
+        return await load_token_user(decode_token(credentials.credentials))
+    if token:
+        return await load_token_user(decode_token(token, purpose="stream"))
+    raise HTTPException(status_code=401, detail="Not authenticated")
+
+async def get_admin_stream_user(user: dict = Depends(get_stream_user)):
+    if user.get("role") != UserRole.ADMIN:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    return user
 
 async def get_admin_user(user: dict = Depends(get_current_user)):
+    # The stored role decides, not the token's role claim, so promotions and demotions
+    # take effect within USER_CACHE_TTL instead of when the token is renewed
     if user.get("role") != UserRole.ADMIN:
         raise HTTPException(status_code=403, detail="Admin access required")
     return user
 
+def parse_datetime(value) -> Optional[datetime]:
+    """Read a timestamp stored as a native date or as a legacy ISO string; naive values are UTC"""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+def date_range(field: str, start: Optional[datetime] = None, end: Optional[datetime] = None) -> dict:
+    """Filter for start <= field < end that matches native dates and legacy ISO strings alike.
+    
+    Legacy strings are all UTC isoformat(), so they compare correctly as strings. The
+    string branch can go once `manage.py migrate-dates` has run everywhere.
+    """
+    bounds = {}
+    if start:
+        bounds["$gte"] = start
+    if end:
+        bounds["$lt"] = end
+    legacy = {op: value.astimezone(timezone.utc).isoformat() for op, value in bounds.items()}
+    return {"$or": [{field: bounds}, {field: legacy}]}
+
 def generate_slug(name: str) -> str:
     slug = name.lower().strip()
     slug = re.sub(r'[^\w\s-]', '', slug)
     slug = re.sub(r'[-\s]+', '-', slug)
     return slug
 
+# ==================== RATE LIMITING ====================
+class RateLimitRule:
+    """Allows bursts of up to `capacity` requests per key, refilled evenly over `period` seconds"""
+    
+    def __init__(self, scope: str, capacity: int, period: float):
+        self.scope = scope  # "ip", "email", "ip_email" or "user"
+        self.capacity = capacity
+        self.period = period
+        self.refill_rate = capacity / period
+
+RATE_LIMIT_POLICIES: Dict[str, List[RateLimitRule]] = {
+    # Failed guesses are limited per (ip, email), not per email, so that nobody can lock
+    # a customer out of their account by spraying logins for their address
+    "login": [RateLimitRule("ip", 20, 60), RateLimitRule("ip_email", 10, 900)],
+    "register": [RateLimitRule("ip", 10, 3600)],
+    "forgot_password": [RateLimitRule("ip", 5, 900), RateLimitRule("email", 3, 3600)],
+    "reset_password": [RateLimitRule("ip", 10, 900)],
+    "seed": [RateLimitRule("ip", 3, 3600)],
+    "payment_initiate": [RateLimitRule("user", 5, 60)],
+}
+
+def client_ip(request: Request) -> str:
+    host = request.client.host if request.client else ""
+    if host in TRUSTED_PROXIES:
+        return request.headers.get("x-real-ip") or host
+    return host
+
+class RateLimiter:
+    """Per-route token buckets keyed by client IP, email and user.
+    
+    Buckets live in process memory (LRU-bounded by max_keys), so a rejected request
+    costs a dict lookup and never reaches bcrypt or MongoDB. With shared=True, requests
+    that pass the local bucket are also counted in a fixed window in the rate_limits
+    collection, so the limit holds across workers; keys the shared counter rejects are
+    remembered locally until their window ends. A request rejected by one rule gets back
+    the tokens the policy's other rules took for it.
+    """
+    
+    def __init__(self, policies: Dict[str, List[RateLimitRule]], max_keys: int, shared: bool = False):
+        self.policies = policies
+        self.max_keys = max_keys
+        self.shared = shared
+        # key -> [tokens, updated_at, blocked_until]
+        self._buckets: "OrderedDict[tuple, list]" = OrderedDict()
+    
+    def _take(self, key: tuple, rule: RateLimitRule, now: float) -> float:
+        """Take a token from the local bucket; returns 0 if allowed, else seconds until one is available"""
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = [float(rule.capacity), now, 0.0]
+            self._buckets[key] = bucket
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(rule.capacity, bucket[0] + (now - bucket[1]) * rule.refill_rate)
+            bucket[1] = now
+        
+        if bucket[2] > now:
+            return bucket[2] - now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return 0.0
+        return (1 - bucket[0]) / rule.refill_rate
+    
+    def _refund(self, taken: List[tuple]):
+        for key, rule in taken:
+            bucket = self._buckets.get(key)
+            if bucket:
+                bucket[0] = min(rule.capacity, bucket[0] + 1)
+    
+    async def _take_shared(self, key: tuple, rule: RateLimitRule) -> Tuple[float, Optional[str]]:
+        """Count the request in the shared window; returns (retry_after, counter id)"""
+        now = time.time()
+        window_end = (int(now // rule.period) + 1) * rule.period
+        counter_id = f"{':'.join(key)}:{int(window_end)}"
+        try:
+            counter = await db.rate_limits.find_one_and_update(
+                {"_id": counter_id},
+                {
+                    "$inc": {"count": 1},
+                    "$setOnInsert": {"expires_at": datetime.fromtimestamp(window_end, timezone.utc)}
+                },
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except Exception as e:
+            # Fail open: the local buckets still apply
+            logger.warning(f"Shared rate limit check failed: {str(e)}")
+            return 0.0, None
+        if counter["count"] > rule.capacity:
+            return window_end - now, counter_id
+        return 0.0, counter_id
+    
+    async def _refund_shared(self, counter_ids: List[str]):
+        if not counter_ids:
+            return
+        try:
+            await db.rate_limits.update_many({"_id": {"$in": counter_ids}}, {"$inc": {"count": -1}})
+        except Exception as e:
+            logger.warning(f"Shared rate limit refund failed: {str(e)}")
+    
+    def _reject(self, policy: str, rule: RateLimitRule, retry_after: float):
+        metrics.inc("rate_limited_total", policy=policy, scope=rule.scope)
+        raise HTTPException(
+            status_code=429,
+            detail="Too many requests, please try again later",
+            headers={"Retry-After": str(max(1, int(retry_after + 0.999)))}
+        )
+    
+    async def check(self, policy: str, request: Optional[Request] = None, email: Optional[str] = None, user_id: Optional[str] = None):
+        """Raise 429 if any rule of the policy is exhausted; rules whose key is missing are skipped"""
+        if not RATE_LIMIT_ENABLED:
+            return
+        ip = client_ip(request) if request else None
+        email = email.strip().lower() if email else None
+        values = {
+            "ip": ip,
+            "email": email,
+            "ip_email": f"{ip}|{email}" if ip and email else None,
+            "user": user_id
+        }
+        now = time.monotonic()
+        taken = []
+        for rule in self.policies[policy]:
+            if not values[rule.scope]:
+                continue
+            key = (policy, rule.scope, values[rule.scope])
+            retry_after = self._take(key, rule, now)
+            if retry_after > 0:
+                self._refund(taken)
+                self._reject(policy, rule, retry_after)
+            taken.append((key, rule))
+        
+        if not self.shared:
+            return
+        counted = []
+        for key, rule in taken:
+            retry_after, counter_id = await self._take_shared(key, rule)
+            if retry_after > 0:
+                bucket = self._buckets.get(key)
+                if bucket:
+                    bucket[2] = time.monotonic() + retry_after
+                self._refund(taken)
+                await self._refund_shared(counted)
+                self._reject(policy, rule, retry_after)
+            if counter_id:
+                counted.append(counter_id)
+
+rate_limiter = RateLimiter(RATE_LIMIT_POLICIES, RATE_LIMIT_MAX_KEYS, shared=RATE_LIMIT_BACKEND == "mongo")
+
+# ==================== METRICS ====================
+class MetricsRegistry:
+    """In-process counters, timings and gauges, exposed at /api/admin/metrics"""
+    
+    def __init__(self):
+        self.counters: Dict[str, float] = defaultdict(float)
+        self.timings: Dict[str, Dict[str, float]] = {}
+        self.gauges: Dict[str, Callable[[], Any]] = {}
+    
+    @staticmethod
+    def _key(name: str, labels: dict) -> str:
+        if not labels:
+            return name
+        return name + "{" + ",".join(f'{k}="{v}"' for k, v in sorted(labels.items())) + "}"
+    
+    def inc(self, name: str, value: float = 1, **labels):
+        self.counters[self._key(name, labels)] += value
+    
+    def observe(self, name: str, seconds: float, **labels):
+        timing = self.timings.setdefault(self._key(name, labels), {"count": 0, "sum": 0.0, "max": 0.0})
+        timing["count"] += 1
+        timing["sum"] += seconds
+        timing["max"] = max(timing["max"], seconds)
+    
+    def register_gauge(self, name: str, fn: Callable[[], Any]):
+        self.gauges[name] = fn
+    
+    def snapshot(self) -> dict:
+        return {
+            "counters": dict(self.counters),
+            "timings": {
+                key: {**t, "avg": t["sum"] / t["count"] if t["count"] else 0.0}
+                for key, t in self.timings.items()
+            },
+            "gauges": {name: fn() for name, fn in self.gauges.items()}
+        }
+
+metrics = MetricsRegistry()
+
 # ==================== M-PESA SERVICE ====================
+class PaymentProviderUnavailable(Exception):
+    """Raised without calling Daraja when the circuit is open or all call slots are busy"""
+    
+    def __init__(self, retry_after: float):
+        super().__init__("M-Pesa is temporarily unavailable")
+        self.retry_after = retry_after
+
+class CircuitBreaker:
+    """Opens after consecutive failures; once reset_timeout passes, a single half-open probe decides whether to close"""
+    
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+    
+    def retry_after(self) -> float:
+        if self.state == self.CLOSED:
+            return 0.0
+        return max(1.0, self.opened_at + self.reset_timeout - time.monotonic())
+    
+    def is_available(self) -> bool:
+        """Whether a call would currently be let through, without claiming the probe"""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            return time.monotonic() - self.opened_at >= self.reset_timeout
+        return not self._probe_in_flight
+    
+    def allow(self) -> bool:
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self._set_state(self.HALF_OPEN)
+        if self.state == self.HALF_OPEN and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        return False
+    
+    def release_probe(self):
+        """Give up the half-open probe when the call ended without a verdict (e.g. cancelled)"""
+        self._probe_in_flight = False
+    
+    def record_success(self):
+        self.failures = 0
+        self._probe_in_flight = False
+        if self.state != self.CLOSED:
+            self._set_state(self.CLOSED)
+    
+    def record_failure(self):
+        self.failures += 1
+        self._probe_in_flight = False
+        if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+            self.opened_at = time.monotonic()
+            self._set_state(self.OPEN)
+    
+    def _set_state(self, state: str):
+        logger.warning(f"Circuit breaker {self.name}: {self.state} -> {state}")
+        self.state = state
+        metrics.inc("circuit_breaker_transitions_total", breaker=self.name, state=state)
+
 class MpesaService:
-    def __init__(self):
-        self.base_url = "https://sandbox.safaricom.co.ke" if MPESA_ENVIRONMENT == "sandbox" else "https://api.safaricom.co.ke"
+    # Daraja answers STK queries with this error code while the customer has not completed the prompt
+    STILL_PROCESSING_CODE = "500.001.1001"
+    # Transport errors raised before the request reached Daraja, safe to retry even for STK push
+    UNSENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+    
+    def __init__(self, base_url: str = MPESA_BASE_URL):
+        self.base_url = base_url.rstrip("/") or ("https://sandbox.safaricom.co.ke" if MPESA_ENVIRONMENT == "sandbox" else "https://api.safaricom.co.ke")
+        self.client: Optional[httpx.AsyncClient] = None
+        self._access_token: Optional[str] = None
+        self._token_expires_at = 0.0
+        self._token_lock = asyncio.Lock()
+        self.breaker = CircuitBreaker("mpesa", MPESA_BREAKER_FAILURE_THRESHOLD, MPESA_BREAKER_RESET_TIMEOUT)
+        self._slots = asyncio.Semaphore(MPESA_MAX_IN_FLIGHT)
+        self._in_flight = 0
+        metrics.register_gauge("mpesa_circuit_state", lambda: self.breaker.state)
+        metrics.register_gauge("mpesa_in_flight", lambda: self._in_flight)
+    
+    async def start(self):
+        """Open the long-lived, keep-alive HTTP client shared by all Daraja calls"""
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                base_url=self.base_url,
+                limits=httpx.Limits(
+                    max_connections=MPESA_HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=MPESA_HTTP_MAX_KEEPALIVE,
+                    keepalive_expiry=MPESA_HTTP_KEEPALIVE_EXPIRY
+                ),
+                timeout=httpx.Timeout(MPESA_HTTP_TIMEOUT, connect=MPESA_HTTP_CONNECT_TIMEOUT)
+            )
+    
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+    
+    async def get_client(self) -> httpx.AsyncClient:
+        if self.client is None:
+            await self.start()
+        return self.client
+    
+    def is_provider_failure(self, response: httpx.Response) -> bool:
+        """5xx answers count against the breaker, except the STK query's 'still processing' reply"""
+        if response.status_code < 500:
+            return False
+        try:
+            return response.json().get("errorCode") != self.STILL_PROCESSING_CODE
+        except ValueError:
+            return True
+    
+    async def request(self, method: str, path: str, idempotent: bool, **kwargs) -> httpx.Response:
+        """Send a Daraja request through the circuit breaker and in-flight cap.
+        
+        Idempotent calls are retried with jittered exponential backoff; STK push is
+        only retried when the request never left this process.
+        """
+        client = await self.get_client()
+        for attempt in range(1, MPESA_RETRY_ATTEMPTS + 1):
+            if not self.breaker.allow():
+                metrics.inc("mpesa_requests_rejected_total", reason="circuit_open")
+                raise PaymentProviderUnavailable(self.breaker.retry_after())
+            try:
+                await asyncio.wait_for(self._slots.acquire(), MPESA_SLOT_TIMEOUT)
+            except asyncio.TimeoutError:
+                self.breaker.release_probe()
+                metrics.inc("mpesa_requests_rejected_total", reason="saturated")
+                raise PaymentProviderUnavailable(MPESA_SLOT_TIMEOUT)
+            
+            response, error = None, None
+            self._in_flight += 1
+            started = time.monotonic()
+            try:
+                response = await client.request(method, path, **kwargs)
+            except httpx.TransportError as e:
+                error = e
+            except BaseException:
+                self.breaker.release_probe()
+                raise
+            finally:
+                self._in_flight -= 1
+                self._slots.release()
+            
+            outcome = type(error).__name__ if error else str(response.status_code)
+            metrics.observe("mpesa_request_seconds", time.monotonic() - started, path=path)
+            metrics.inc("mpesa_requests_total", path=path, outcome=outcome)
+            
+            if response is not None and not self.is_provider_failure(response):
+                self.breaker.record_success()
+                return response
+            self.breaker.record_failure()
+            
+            retryable = idempotent or isinstance(error, self.UNSENT_ERRORS)
+            if not retryable or attempt == MPESA_RETRY_ATTEMPTS:
+                if error:
+                    raise error
+                return response
+            
+            delay = random.uniform(0, min(MPESA_RETRY_MAX_DELAY, MPESA_RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+            logger.info(f"Retrying M-Pesa {path} in {delay:.2f}s after {outcome}")
+            metrics.inc("mpesa_retries_total", path=path)
+            await asyncio.sleep(delay)
+        return response
     
     async def get_access_token(self) -> str:
-        auth_string = base64.b64encode(f"{MPESA_CONSUMER_KEY}:{MPESA_CONSUMER_SECRET}".encode()).decode()
-        headers = {"Authorization": f"Basic {auth_string}"}
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f"{self.base_url}/oauth/v1/generate?grant_type=client_credentials",
-                headers=headers,
-                timeout=30.0
+        """Return a cached OAuth token, refreshing it shortly before it expires.
+        
+        Concurrent callers share a single refresh request.
+        """
+        if self._access_token and time.monotonic() < self._token_expires_at - MPESA_TOKEN_REFRESH_MARGIN:
+            return self._access_token
+        
+        async with self._token_lock:
+            # Another coroutine may have refreshed the token while we waited
+            if self._access_token and time.monotonic() < self._token_expires_at - MPESA_TOKEN_REFRESH_MARGIN:
+                return self._access_token
+            
+            auth_string = base64.b64encode(f"{MPESA_CONSUMER_KEY}:{MPESA_CONSUMER_SECRET}".encode()).decode()
+            headers = {"Authorization": f"Basic {auth_string}"}
+            response = await self.request(
+                "GET",
+                "/oauth/v1/generate",
+                idempotent=True,
+                params={"grant_type": "client_credentials"},
+                headers=headers
             )
             response.raise_for_status()
-            return response.json()["access_token"]
+            data = response.json()
+            self._access_token = data["access_token"]
+            self._token_expires_at = time.monotonic() + float(data.get("expires_in", 3599))
+            return self._access_token
+    
+    def invalidate_access_token(self, token: Optional[str] = None):
+        """Drop the cached token, unless it has already been replaced by a newer one"""
+        if token is None or token == self._access_token:
+            self._access_token = None
+            self._token_expires_at = 0.0
+    
+    @staticmethod
+    def is_token_rejected(response: httpx.Response) -> bool:
+        if response.status_code == 401:
+            return True
+        # Daraja reports expired/invalid tokens as errorCode 404.001.03
+        try:
+            return response.json().get("errorCode") == "404.001.03"
+        except ValueError:
+            return False
+    
+    async def post_authorized(self, path: str, payload: dict, idempotent: bool = False) -> httpx.Response:
+        """POST to Daraja with the cached token, retrying once if the token is rejected"""
+        for attempt in range(2):
+            access_token = await self.get_access_token()
+            response = await self.request(
+                "POST",
+                path,
+                idempotent=idempotent,
+                json=payload,
+                headers={
+                    "Authorization": f"Bearer {access_token}",
+                    "Content-Type": "application/json"
+                }
+            )
+            if not self.is_token_rejected(response) or attempt == 1:
+                return response
+            logger.info("M-Pesa rejected the access token, refreshing")
+            self.invalidate_access_token(access_token)
+        return response
     
     def generate_password(self) -> tuple:
         timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
@@ -862,7 +1726,6 @@ class MpesaService:
     
     async def initiate_stk_push(self, phone: str, amount: float, reference: str, description: str) -> Dict:
         password, timestamp = self.generate_password()
-        access_token = await self.get_access_token()
         
         payload = {
             "BusinessShortCode": MPESA_SHORTCODE,
@@ -878,44 +1741,126 @@ class MpesaService:
             "TransactionDesc": description
         }
         
-        headers = {
-            "Authorization": f"Bearer {access_token}",
-            "Content-Type": "application/json"
+        response = await self.post_authorized("/mpesa/stkpush/v1/processrequest", payload)
+        return response.json()
+    
+    async def query_stk_status(self, checkout_request_id: str) -> Dict:
+        password, timestamp = self.generate_password()
+        
+        payload = {
+            "BusinessShortCode": MPESA_SHORTCODE,
+            "Password": password,
+            "Timestamp": timestamp,
+            "CheckoutRequestID": checkout_request_id
         }
         
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{self.base_url}/mpesa/stkpush/v1/processrequest",
-                json=payload,
-                headers=headers,
-                timeout=30.0
-            )
-            return response.json()
+        response = await self.post_authorized("/mpesa/stkpushquery/v1/query", payload, idempotent=True)
+        return response.json()
 
 mpesa_service = MpesaService()
 
 # ==================== BACKGROUND TASKS ====================
-async def check_low_stock_and_notify():
-    """Check for low stock items and send email notification"""
-    low_stock_items = await db.inventory.find({
-        "$expr": {"$lte": ["$quantity", "$low_stock_threshold"]}
-    }, {"_id": 0}).to_list(100)
+# Update pipeline stage that keeps inventory.is_low_stock in step with quantity, the
+# threshold and the forecast reorder point. A $expr comparing fields cannot use an
+# index; the stored flag can.
+LOW_STOCK_FLAG_STAGE = {"$set": {"is_low_stock": {"$lte": [
+    "$quantity", {"$max": ["$low_stock_threshold", {"$ifNull": ["$reorder_point", -1]}]}
+]}}}
+
+def low_stock_level(inventory: dict) -> int:
+    """Quantity at or below which a row is low on stock: its threshold or reorder point, whichever is higher"""
+    reorder_point = inventory.get("reorder_point")
+    return max(inventory.get("low_stock_threshold", 0), reorder_point if reorder_point is not None else -1)
+
+def crossed_low_stock(inventory: dict, change: int) -> bool:
+    """Whether a stock change just took the row from above its low-stock level to at or below it"""
+    return inventory["is_low_stock"] and inventory["quantity"] - change > low_stock_level(inventory)
+
+async def check_low_stock_and_notify(product_ids: List[str]):
+    """Alert on products that have just crossed their low-stock threshold.
+    
+    Each product alerts at most once per LOW_STOCK_ALERT_COOLDOWN; the cooldown is
+    claimed atomically, so concurrent orders for the same product alert once.
+    """
+    if not product_ids:
+        return
     
-    if not low_stock_items:
+    now = datetime.now(timezone.utc)
+    claim = str(uuid.uuid4())
+    await db.inventory.update_many(
+        {
+            "product_id": {"$in": product_ids},
+            "is_low_stock": True,
+            "$or": [
+                {"low_stock_alerted_at": {"$exists": False}},
+                {"low_stock_alerted_at": {"$lte": now - timedelta(seconds=LOW_STOCK_ALERT_COOLDOWN)}}
+            ]
+        },
+        {"$set": {"low_stock_alerted_at": now, "low_stock_alert_claim": claim}}
+    )
+    claimed = await db.inventory.find(
+        {"product_id": {"$in": product_ids}, "low_stock_alert_claim": claim},
+        {"_id": 0, "product_id": 1, "quantity": 1, "low_stock_threshold": 1, "reorder_point": 1}
+    ).to_list(None)
+    metrics.inc("low_stock_alerts_suppressed_total", len(set(product_ids)) - len(claimed))
+    if not claimed:
         return
     
-    products_info = []
-    for inv in low_stock_items:
-        product = await db.products.find_one({"id": inv["product_id"]}, {"_id": 0})
-        if product:
-            products_info.append({
-                "product_name": product["name"],
-                "quantity": inv["quantity"],
-                "threshold": inv["low_stock_threshold"]
-            })
+    products = await db.products.find(
+        {"id": {"$in": [inv["product_id"] for inv in claimed]}}, {"_id": 0, "id": 1, "name": 1}
+    ).to_list(None)
+    names = {p["id"]: p["name"] for p in products}
+    items = {
+        inv["product_id"]: {
+            "product_name": names.get(inv["product_id"], inv["product_id"]),
+            "quantity": inv["quantity"],
+            "threshold": low_stock_level(inv)
+        }
+        for inv in claimed
+    }
+    metrics.inc("low_stock_alerts_total", len(items))
     
-    if products_info:
-        email_service.send_low_stock_alert(products_info)
+    await create_notification(
+        NotificationType.LOW_STOCK,
+        "Low Stock",
+        "Running low: " + ", ".join(f"{i['product_name']} ({i['quantity']} left)" for i in items.values()),
+        claimed[0]["product_id"] if len(claimed) == 1 else None
+    )
+    await queue_low_stock_digest(items, now)
+
+async def queue_low_stock_digest(items: Dict[str, dict], now: datetime):
+    """Add items to the digest for the current LOW_STOCK_DIGEST_WINDOW, emailed when the window closes"""
+    window = int(now.timestamp() // LOW_STOCK_DIGEST_WINDOW)
+    send_in = (window + 1) * LOW_STOCK_DIGEST_WINDOW - now.timestamp()
+    digest = await db.low_stock_digests.find_one_and_update(
+        {"_id": window},
+        {"$set": {f"items.{product_id}": item for product_id, item in items.items()}, "$setOnInsert": {"created_at": now}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    # Concurrent alerts each queue the digest as they read it. Whoever queues last
+    # re-reads and finds every item, so an older copy can never be the one that is sent.
+    while True:
+        await email_service.send_low_stock_alert(list(digest["items"].values()), str(window), send_in)
+        latest = await db.low_stock_digests.find_one({"_id": window})
+        if latest["items"] == digest["items"]:
+            return
+        digest = latest
+
+_background_tasks = set()
+
+def spawn_background(coro):
+    """Run a coroutine detached from the caller, logging any failure"""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    
+    def _done(t):
+        _background_tasks.discard(t)
+        if not t.cancelled() and t.exception():
+            logger.error(f"Background task failed: {t.exception()}")
+    
+    task.add_done_callback(_done)
+    return task
 
 # ==================== NOTIFICATION HELPERS ====================
 async def create_notification(
@@ -933,14 +1878,16 @@ async def create_notification(
         "message": message,
         "related_id": related_id,
         "is_read": False,
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": datetime.now(timezone.utc)
     }
     await db.notifications.insert_one(notification)
+    admin_events.publish("notification", {k: v for k, v in notification.items() if k != "_id"})
     return notification_id
 
 # ==================== AUTH ROUTES ====================
 @api_router.post("/auth/register", response_model=dict)
-async def register(user_data: UserCreate):
+async def register(user_data: UserCreate, request: Request):
+    await rate_limiter.check("register", request)
     existing = await db.users.find_one({"email": user_data.email})
     if existing:
         raise HTTPException(status_code=400, detail="Email already registered")
@@ -949,13 +1896,13 @@ async def register(user_data: UserCreate):
     user = {
         "id": user_id,
         "email": user_data.email,
-        "password": hash_password(user_data.password),
+        "password": await hash_password(user_data.password),
         "first_name": user_data.first_name,
         "last_name": user_data.last_name,
         "phone_number": user_data.phone_number,
         "role": UserRole.CUSTOMER,
         "is_active": True,
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": datetime.now(timezone.utc)
     }
     await db.users.insert_one(user)
     
@@ -964,18 +1911,22 @@ async def register(user_data: UserCreate):
         "user_id": user_id,
         "items": [],
         "is_active": True,
-        "updated_at": datetime.now(timezone.utc).isoformat()
+        "updated_at": datetime.now(timezone.utc)
     })
     
     token = create_token(user_id, UserRole.CUSTOMER)
     return {"token": token, "user": {"id": user_id, "email": user_data.email, "role": UserRole.CUSTOMER}}
 
 @api_router.post("/auth/login", response_model=dict)
-async def login(credentials: UserLogin):
+async def login(credentials: UserLogin, request: Request):
+    await rate_limiter.check("login", request, email=credentials.email)
     user = await db.users.find_one({"email": credentials.email})
-    if not user or not verify_password(credentials.password, user["password"]):
+    if not user or not await verify_password(credentials.password, user["password"]):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
+    if password_needs_rehash(user["password"]):
+        spawn_background(upgrade_password_hash(user["id"], credentials.password, user["password"]))
+    
     token = create_token(user["id"], user["role"])
     return {
         "token": token,
@@ -1000,6 +1951,11 @@ async def get_me(user: dict = Depends(get_current_user)):
         created_at=datetime.fromisoformat(user["created_at"]) if isinstance(user["created_at"], str) else user["created_at"]
     )
 
+@api_router.post("/auth/stream-token", response_model=dict)
+async def issue_stream_token(user: dict = Depends(get_current_user)):
+    """Short-lived token for the ?token= parameter of the SSE endpoints"""
+    return {"token": create_stream_token(user["id"]), "expires_in": STREAM_TOKEN_TTL_SECONDS}
+
 # ==================== IMAGE UPLOAD ====================
 @api_router.post("/upload")
 async def upload_image(file: UploadFile = File(...), user: dict = Depends(get_current_user)):
@@ -1063,7 +2019,7 @@ async def create_category(category: CategoryCreate, user: dict = Depends(get_adm
         raise HTTPException(status_code=400, detail="Category with this slug already exists")
     
     cat_id = str(uuid.uuid4())
-    now = datetime.now(timezone.utc).isoformat()
+    now = datetime.now(timezone.utc)
     cat_doc = {
         "id": cat_id,
         "name": category.name,
@@ -1081,7 +2037,7 @@ async def create_category(category: CategoryCreate, user: dict = Depends(get_adm
         description=category.description,
         image=category.image,
         product_count=0,
-        created_at=datetime.fromisoformat(now)
+        created_at=now
     )
 
 @api_router.put("/admin/categories/{category_id}", response_model=CategoryResponse)
@@ -1225,7 +2181,7 @@ async def create_blog_post(post: BlogPostCreate, user: dict = Depends(get_admin_
         slug = f"{slug}-{uuid.uuid4().hex[:6]}"
     
     post_id = str(uuid.uuid4())
-    now = datetime.now(timezone.utc).isoformat()
+    now = datetime.now(timezone.utc)
     
     post_doc = {
         "id": post_id,
@@ -1255,8 +2211,8 @@ async def create_blog_post(post: BlogPostCreate, user: dict = Depends(get_admin_
         author_name=f"{user['first_name']} {user['last_name']}",
         is_published=post.is_published,
         views=0,
-        created_at=datetime.fromisoformat(now),
-        updated_at=datetime.fromisoformat(now)
+        created_at=now,
+        updated_at=now
     )
 
 @api_router.put("/admin/blog/{post_id}", response_model=BlogPostResponse)
@@ -1268,7 +2224,7 @@ async def update_blog_post(post_id: str, update: BlogPostUpdate, user: dict = De
     update_data = {k: v for k, v in update.model_dump().items() if v is not None}
     if "title" in update_data and not update.slug:
         update_data["slug"] = generate_slug(update_data["title"])
-    update_data["updated_at"] = datetime.now(timezone.utc).isoformat()
+    update_data["updated_at"] = datetime.now(timezone.utc)
     
     await db.blog_posts.update_one({"id": post_id}, {"$set": update_data})
     
@@ -1419,7 +2375,7 @@ async def add_to_cart(item: CartItemAdd, user: dict = Depends(get_current_user))
             "user_id": user["id"],
             "items": [],
             "is_active": True,
-            "updated_at": datetime.now(timezone.utc).isoformat()
+            "updated_at": datetime.now(timezone.utc)
         }
         await db.carts.insert_one(cart)
     
@@ -1446,7 +2402,7 @@ async def add_to_cart(item: CartItemAdd, user: dict = Depends(get_current_user))
     
     await db.carts.update_one(
         {"user_id": user["id"], "is_active": True},
-        {"$set": {"items": cart_items, "updated_at": datetime.now(timezone.utc).isoformat()}}
+        {"$set": {"items": cart_items, "updated_at": datetime.now(timezone.utc)}}
     )
     
     return await get_cart(user)
@@ -1477,7 +2433,7 @@ async def update_cart_item(product_id: str, update: CartItemUpdate, user: dict =
     
     await db.carts.update_one(
         {"user_id": user["id"], "is_active": True},
-        {"$set": {"items": cart_items, "updated_at": datetime.now(timezone.utc).isoformat()}}
+        {"$set": {"items": cart_items, "updated_at": datetime.now(timezone.utc)}}
     )
     
     return await get_cart(user)
@@ -1492,11 +2448,82 @@ async def remove_from_cart(product_id: str, user: dict = Depends(get_current_use
     
     await db.carts.update_one(
         {"user_id": user["id"], "is_active": True},
-        {"$set": {"items": cart_items, "updated_at": datetime.now(timezone.utc).isoformat()}}
+        {"$set": {"items": cart_items, "updated_at": datetime.now(timezone.utc)}}
     )
     
     return await get_cart(user)
 
+# ==================== SALES ROLLUP ====================
+def sales_day(created_at) -> str:
+    """UTC calendar day of an order, which is the _id of its sales_daily document"""
+    return parse_datetime(created_at).astimezone(timezone.utc).strftime("%Y-%m-%d")
+
+async def product_categories(product_ids) -> Dict[str, str]:
+    products = await db.products.find({"id": {"$in": list(product_ids)}}, {"_id": 0, "id": 1, "category": 1}).to_list(None)
+    return {p["id"]: p.get("category") for p in products}
+
+async def apply_order_to_rollup(order: dict, sign: int, categories: Optional[Dict[str, str]] = None):
+    """Add (sign=1) or remove (sign=-1) an order's totals in its day's sales_daily document"""
+    items = order.get("items", [])
+    missing = {i["product_id"] for i in items if "category" not in i}
+    if missing and categories is None:
+        # Orders placed before items carried their category
+        categories = await product_categories(missing)
+    
+    inc = {"orders": sign, "revenue": sign * order["total_amount"], "items": 0}
+    names = {}
+    for item in items:
+        quantity = item["quantity"]
+        amount = item["price"] * quantity
+        category = item["category"] if "category" in item else (categories or {}).get(item["product_id"])
+        # Categories are keyed by slug: a free-form name could contain "." or start with "$"
+        category_key = generate_slug(category) if category else None
+        inc["items"] += sign * quantity
+        prefixes = [f"products.{item['product_id']}"] + ([f"categories.{category_key}"] if category_key else [])
+        for prefix in prefixes:
+            inc[f"{prefix}.quantity"] = inc.get(f"{prefix}.quantity", 0) + sign * quantity
+            inc[f"{prefix}.revenue"] = inc.get(f"{prefix}.revenue", 0) + sign * amount
+        names[f"products.{item['product_id']}.name"] = item["product_name"]
+    
+    update = {"$inc": inc}
+    if names:
+        update["$set"] = names
+    await db.sales_daily.update_one({"_id": sales_day(order["created_at"])}, update, upsert=True)
+
+async def sync_order_rollup(order_id: str, categories: Optional[Dict[str, str]] = None) -> int:
+    """Count or uncount an order in sales_daily after its status may have changed.
+    
+    counted_in_rollup is flipped in the same atomic update that checks the status, so
+    concurrent writers cannot both add (or both remove) an order. The flip and the
+    sales_daily $inc are separate writes, though: the flip also records the pending
+    sign in rollup_pending, which is cleared once the $inc is done. If the process dies
+    in between, `manage.py backfill-sales` rebuilds the days of orders left pending.
+    Returns 1 if the order was added, -1 if removed and 0 if nothing changed.
+    """
+    fields = {"_id": 0, "created_at": 1, "total_amount": 1, "items": 1}
+    now = datetime.now(timezone.utc)
+    order = await db.orders.find_one_and_update(
+        {"id": order_id, "status": {"$in": PAID_ORDER_STATUSES}, "counted_in_rollup": {"$ne": True}},
+        {"$set": {"counted_in_rollup": True, "rollup_pending": 1, "rollup_pending_at": now}},
+        projection=fields
+    )
+    sign = 1
+    if not order:
+        order = await db.orders.find_one_and_update(
+            {"id": order_id, "status": {"$nin": PAID_ORDER_STATUSES}, "counted_in_rollup": True},
+            {"$set": {"counted_in_rollup": False, "rollup_pending": -1, "rollup_pending_at": now}},
+            projection=fields
+        )
+        sign = -1
+    if not order:
+        return 0
+    await apply_order_to_rollup(order, sign, categories)
+    await db.orders.update_one(
+        {"id": order_id, "rollup_pending": sign, "rollup_pending_at": now},
+        {"$unset": {"rollup_pending": "", "rollup_pending_at": ""}}
+    )
+    return sign
+
 # ==================== ORDER ROUTES ====================
 @api_router.post("/orders", response_model=OrderResponse)
 async def create_order(order_data: OrderCreate, background_tasks: BackgroundTasks, user: dict = Depends(get_current_user)):
@@ -1524,7 +2551,8 @@ async def create_order(order_data: OrderCreate, background_tasks: BackgroundTask
             "product_name": product["name"],
             "product_image": product["images"][0] if product.get("images") else "",
             "price": price,
-            "quantity": item["quantity"]
+            "quantity": item["quantity"],
+            "category": product.get("category")
         })
         total += price * item["quantity"]
     
@@ -1537,7 +2565,7 @@ async def create_order(order_data: OrderCreate, background_tasks: BackgroundTask
         address_snapshot = order_data.address.model_dump()
     
     order_id = str(uuid.uuid4())
-    now = datetime.now(timezone.utc).isoformat()
+    now = datetime.now(timezone.utc)
     
     # Determine initial status based on payment method
     initial_status = OrderStatus.PENDING_PAYMENT
@@ -1558,6 +2586,8 @@ async def create_order(order_data: OrderCreate, background_tasks: BackgroundTask
         "updated_at": now
     }
     await db.orders.insert_one(order)
+    rollup_change = await sync_order_rollup(order_id)
+    admin_events.publish("order", order_event(order, rollup_change=rollup_change))
     
     # Create notification for admin
     await create_notification(
@@ -1574,15 +2604,15 @@ async def create_order(order_data: OrderCreate, background_tasks: BackgroundTask
     )
     
     # Send order confirmation email
-    background_tasks.add_task(email_service.send_order_confirmation, order, user["email"])
+    await email_service.send_order_confirmation(order, user["email"])
     
     # For pay on delivery, deduct stock immediately
     if order_data.payment_method == PaymentMethod.PAY_ON_DELIVERY:
+        low_stock = []
         for item in order_items:
-            await db.inventory.update_one(
-                {"product_id": item["product_id"]},
-                {"$inc": {"quantity": -item["quantity"]}}
-            )
+            inventory = await change_stock(item["product_id"], -item["quantity"], now)
+            if inventory and crossed_low_stock(inventory, -item["quantity"]):
+                low_stock.append(item["product_id"])
             await db.inventory_logs.insert_one({
                 "id": str(uuid.uuid4()),
                 "product_id": item["product_id"],
@@ -1591,8 +2621,8 @@ async def create_order(order_data: OrderCreate, background_tasks: BackgroundTask
                 "reference_id": order_id,
                 "created_at": now
             })
-        # Check low stock
-        background_tasks.add_task(check_low_stock_and_notify)
+        if low_stock:
+            background_tasks.add_task(check_low_stock_and_notify, low_stock)
     
     return OrderResponse(
         id=order_id,
@@ -1604,8 +2634,8 @@ async def create_order(order_data: OrderCreate, background_tasks: BackgroundTask
         phone_number=order_data.phone_number,
         payment_method=order_data.payment_method,
         delivery_method=order_data.delivery_method,
-        created_at=datetime.fromisoformat(now),
-        updated_at=datetime.fromisoformat(now)
+        created_at=now,
+        updated_at=now
     )
 
 @api_router.get("/orders", response_model=List[OrderResponse])
@@ -1648,9 +2678,692 @@ async def get_order(order_id: str, user: dict = Depends(get_current_user)):
         updated_at=datetime.fromisoformat(order["updated_at"]) if isinstance(order["updated_at"], str) else order["updated_at"]
     )
 
+# ==================== PAYMENT EVENTS ====================
+class PaymentEventBus:
+    """In-process pub/sub for payment status changes, keyed by payment id.
+    
+    With PAYMENT_EVENTS_BACKEND=mongo, each worker tails a change stream on
+    payments instead, so a callback handled by one worker wakes subscribers
+    connected to any other.
+    """
+    
+    def __init__(self, backend: str = PAYMENT_EVENTS_BACKEND):
+        self.backend = backend
+        self._subscribers: Dict[str, set] = {}
+        self._watch_task: Optional[asyncio.Task] = None
+    
+    def subscribe(self, payment_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=10)
+        self._subscribers.setdefault(payment_id, set()).add(queue)
+        return queue
+    
+    def unsubscribe(self, payment_id: str, queue: asyncio.Queue):
+        subscribers = self._subscribers.get(payment_id)
+        if subscribers:
+            subscribers.discard(queue)
+            if not subscribers:
+                del self._subscribers[payment_id]
+    
+    def _deliver(self, payment_id: str, event: dict):
+        for queue in self._subscribers.get(payment_id, ()):
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(event)
+    
+    def publish(self, payment_id: str, event: dict):
+        if self.backend != "mongo":
+            self._deliver(payment_id, event)
+    
+    async def _watch(self):
+        pipeline = [{"$match": {
+            "operationType": "update",
+            "updateDescription.updatedFields.status": {"$exists": True}
+        }}]
+        while True:
+            try:
+                async with db.payments.watch(pipeline, full_document="updateLookup") as stream:
+                    async for change in stream:
+                        payment = change.get("fullDocument") or {}
+                        if payment.get("id") in self._subscribers:
+                            self._deliver(payment["id"], payment_event(payment))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Payment change stream failed, retrying: {str(e)}")
+                await asyncio.sleep(5)
+    
+    def start(self):
+        if self.backend == "mongo" and self._watch_task is None:
+            self._watch_task = asyncio.create_task(self._watch())
+    
+    async def stop(self):
+        if self._watch_task:
+            self._watch_task.cancel()
+            await asyncio.gather(self._watch_task, return_exceptions=True)
+            self._watch_task = None
+
+def payment_event(payment: dict, order_status: Optional[str] = None) -> dict:
+    if order_status is None:
+        if payment.get("status") == PaymentStatus.SUCCESS:
+            order_status = OrderStatus.PAID
+        elif payment.get("status") == PaymentStatus.FAILED:
+            order_status = OrderStatus.FAILED
+    return {
+        "payment_id": payment["id"],
+        "status": payment["status"],
+        "mpesa_receipt": payment.get("mpesa_receipt"),
+        "order_status": order_status
+    }
+
+payment_events = PaymentEventBus()
+
+# ==================== ADMIN EVENTS ====================
+# Event types that can change the dashboard counters or the unread notification count
+ADMIN_STATS_TRIGGERS = {"order", "payment", "stock", "notification", "notification_read"}
+
+class AdminEventHub:
+    """Fan-out of order, payment, stock and notification deltas to every open admin stream.
+    
+    Events are numbered and the latest ADMIN_EVENTS_BUFFER_SIZE are kept, so a stream
+    that starts from a cached snapshot can replay whatever was published after it.
+    With ADMIN_EVENTS_BACKEND=mongo, events are written once to admin_events and each
+    worker tails that collection, so every admin sees events from every worker.
+    
+    Counters are never derived from deltas, which can be replayed or missed. While
+    anyone is listening, events that may move them schedule a "stats" event with
+    freshly counted values, at most one computation at a time and no more often than
+    every ADMIN_STATS_DEBOUNCE seconds.
+    """
+    
+    def __init__(self, backend: str = ADMIN_EVENTS_BACKEND, buffer_size: int = ADMIN_EVENTS_BUFFER_SIZE):
+        self.backend = backend
+        self.sequence = 0
+        self._recent = deque(maxlen=buffer_size)
+        self._subscribers: set = set()
+        self._watch_task: Optional[asyncio.Task] = None
+        self._stats_task: Optional[asyncio.Task] = None
+        self._stats_stale = False
+        metrics.register_gauge("admin_event_streams", lambda: len(self._subscribers))
+    
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=ADMIN_EVENTS_QUEUE_SIZE)
+        self._subscribers.add(queue)
+        return queue
+    
+    def unsubscribe(self, queue: asyncio.Queue):
+        self._subscribers.discard(queue)
+    
+    def since(self, sequence: int) -> Optional[List[dict]]:
+        """Buffered events after sequence, or None if some of them were already evicted"""
+        if sequence >= self.sequence:
+            return []
+        if not self._recent or self._recent[0]["seq"] > sequence + 1:
+            return None
+        return [e for e in self._recent if e["seq"] > sequence]
+    
+    def _deliver(self, type: str, data: dict):
+        self.sequence += 1
+        event = {"seq": self.sequence, "type": type, "data": data}
+        self._recent.append(event)
+        for queue in self._subscribers:
+            if queue.full():
+                # Dropping a delta would leave the client wrong, so a lagging stream
+                # is told to start over from a snapshot instead
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+            else:
+                queue.put_nowait(event)
+        if type in ADMIN_STATS_TRIGGERS and self._subscribers:
+            self._stats_stale = True
+            if self._stats_task is None or self._stats_task.done():
+                self._stats_task = asyncio.create_task(self._refresh_stats())
+    
+    async def _refresh_stats(self):
+        # Events arriving during a computation make it stale, so go round again
+        while self._stats_stale and self._subscribers:
+            await asyncio.sleep(ADMIN_STATS_DEBOUNCE)
+            self._stats_stale = False
+            try:
+                stats = await compute_admin_stats()
+            except Exception as e:
+                logger.error(f"Admin stats refresh failed: {str(e)}")
+                return
+            metrics.inc("admin_stats_refreshes_total")
+            self._deliver("stats", stats)
+    
+    def publish(self, type: str, data: dict):
+        data = jsonable_encoder(data)
+        metrics.inc("admin_events_published_total", type=type)
+        if self.backend == "mongo":
+            spawn_background(db.admin_events.insert_one({
+                "type": type,
+                "data": data,
+                "created_at": datetime.now(timezone.utc)
+            }))
+        else:
+            self._deliver(type, data)
+    
+    async def _watch(self):
+        while True:
+            try:
+                async with db.admin_events.watch([{"$match": {"operationType": "insert"}}]) as stream:
+                    async for change in stream:
+                        event = change["fullDocument"]
+                        self._deliver(event["type"], event["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Admin event change stream failed, retrying: {str(e)}")
+                await asyncio.sleep(5)
+    
+    def start(self):
+        if self.backend == "mongo" and self._watch_task is None:
+            self._watch_task = asyncio.create_task(self._watch())
+    
+    async def stop(self):
+        for task in (self._watch_task, self._stats_task):
+            if task:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        self._watch_task = self._stats_task = None
+
+def order_event(order: dict, previous_status: Optional[str] = None, rollup_change: int = 0) -> dict:
+    """Delta for an order that was just placed (no previous_status) or changed status.
+    
+    rollup_change is what sync_order_rollup returned, so sales_change is exactly what
+    moved in that day's sales_daily document.
+    """
+    return {
+        "id": order["id"],
+        "status": order["status"],
+        "previous_status": previous_status,
+        "total_amount": order["total_amount"],
+        "payment_method": order.get("payment_method", "mpesa"),
+        "created_at": parse_datetime(order["created_at"]),
+        "sales_day": sales_day(order["created_at"]),
+        "sales_change": rollup_change * order["total_amount"]
+    }
+
+def stock_event(inventory: dict, change: int) -> dict:
+    level = low_stock_level(inventory)
+    return {
+        "product_id": inventory["product_id"],
+        "quantity": inventory["quantity"],
+        "change": change,
+        "low_stock": inventory["quantity"] <= level,
+        "was_low_stock": inventory["quantity"] - change <= level
+    }
+
+# Recent movement references kept per inventory row to make retried movements no-ops
+STOCK_REFS_KEPT = 100
+
+async def change_stock(
+    product_id: str,
+    change: int,
+    now: Optional[datetime] = None,
+    allow_negative: bool = True,
+    reference: Optional[str] = None
+) -> Optional[dict]:
+    """Move a product's stock by change and publish the new level.
+    
+    Returns the updated row, or None if there is none (or, with allow_negative=False,
+    if the change would take stock below zero). A movement with a reference is applied
+    at most once: repeating it returns None and leaves the stock alone.
+    """
+    query = {"product_id": product_id}
+    if not allow_negative and change < 0:
+        query["quantity"] = {"$gte": -change}
+    stages = [
+        {"$set": {"quantity": {"$add": ["$quantity", change]}, "updated_at": now or datetime.now(timezone.utc)}},
+        LOW_STOCK_FLAG_STAGE
+    ]
+    if reference:
+        query["stock_refs"] = {"$ne": reference}
+        stages.append({"$set": {"stock_refs": {"$slice": [
+            {"$concatArrays": [{"$ifNull": ["$stock_refs", []]}, [reference]]}, -STOCK_REFS_KEPT
+        ]}}})
+    inventory = await db.inventory.find_one_and_update(
+        query,
+        stages,
+        projection={"_id": 0, "product_id": 1, "quantity": 1, "low_stock_threshold": 1, "reorder_point": 1, "is_low_stock": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    if inventory:
+        admin_events.publish("stock", stock_event(inventory, change))
+    return inventory
+
+admin_events = AdminEventHub()
+
+# ==================== M-PESA CALLBACK PROCESSING ====================
+async def process_mpesa_callback(callback_data: dict, received_at: Optional[datetime] = None):
+    """Apply an STK callback to its payment, order and inventory"""
+    stk_callback = callback_data.get("Body", {}).get("stkCallback", {})
+    await apply_stk_result(
+        checkout_request_id=stk_callback.get("CheckoutRequestID"),
+        result_code=stk_callback.get("ResultCode"),
+        result_desc=stk_callback.get("ResultDesc"),
+        metadata=stk_callback.get("CallbackMetadata", {}).get("Item", []),
+        raw_payload=callback_data,
+        received_at=received_at
+    )
+
+class PaymentEffectsInProgress(Exception):
+    """Raised while another worker holds the lease on a settled payment's side effects"""
+
+def unapplied_payment_query(now: datetime) -> dict:
+    """Settled payments whose effects are unfinished and not leased by a live worker"""
+    return {
+        "effects_applied": False,
+        "$or": [{"applying_until": {"$lt": now}}, {"applying_until": {"$exists": False}}]
+    }
+
+async def apply_stk_result(
+    checkout_request_id: str,
+    result_code,
+    result_desc: Optional[str],
+    metadata: Optional[List[dict]] = None,
+    raw_payload: Optional[dict] = None,
+    received_at: Optional[datetime] = None,
+    source: str = "callback"
+):
+    """Settle a pending STK payment; shared by the callback workers and the reconciler.
+    
+    Settling is two steps: the payment leaves PENDING with effects_applied=False, then
+    the order, stock and email effects run under a lease and set effects_applied. If an
+    effect fails the lease is released and the exception propagates, so a retry of the
+    same callback (or a later duplicate) resumes the effects instead of skipping them.
+    """
+    try:
+        result_code = int(result_code)
+    except (TypeError, ValueError):
+        pass
+    
+    now = datetime.now(timezone.utc)
+    lease = {"effects_applied": False, "applying_until": now + timedelta(seconds=MPESA_CALLBACK_LEASE_SECONDS)}
+    
+    if result_code == 0:
+        mpesa_receipt = None
+        for item in metadata or []:
+            if item.get("Name") == "MpesaReceiptNumber":
+                mpesa_receipt = item.get("Value")
+        payment_update = {
+            "status": PaymentStatus.SUCCESS,
+            "mpesa_receipt": mpesa_receipt,
+            "result_description": result_desc,
+            "completed_at": now
+        }
+    else:
+        payment_update = {
+            "status": PaymentStatus.FAILED,
+            "result_code": result_code,
+            "result_description": result_desc,
+            "completed_at": now
+        }
+    
+    # Only one of several duplicate callbacks can move the payment out of PENDING
+    payment = await db.payments.find_one_and_update(
+        {"checkout_request_id": checkout_request_id, "status": PaymentStatus.PENDING},
+        {"$set": {**payment_update, **lease}},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+    if payment:
+        payment_events.publish(payment["id"], payment_event(payment))
+        admin_events.publish("payment", {
+            **payment_event(payment),
+            "order_id": payment["order_id"],
+            "amount": payment.get("amount")
+        })
+    else:
+        # Already settled; pick up its effects if an earlier attempt left them unfinished
+        payment = await db.payments.find_one_and_update(
+            {"checkout_request_id": checkout_request_id, **unapplied_payment_query(now)},
+            {"$set": lease},
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER
+        )
+        if not payment:
+            existing = await db.payments.find_one(
+                {"checkout_request_id": checkout_request_id}, {"_id": 0, "status": 1, "effects_applied": 1}
+            )
+            if not existing:
+                logger.warning(f"Payment not found for checkout: {checkout_request_id}")
+            elif existing.get("effects_applied") is False:
+                raise PaymentEffectsInProgress(f"Payment {checkout_request_id} is being applied elsewhere")
+            else:
+                logger.info(f"Payment already processed: {checkout_request_id}")
+            return
+        logger.info(f"Resuming payment effects for checkout: {checkout_request_id}")
+    
+    try:
+        await apply_payment_effects(payment, now)
+    except Exception:
+        await db.payments.update_one(
+            {"id": payment["id"], "effects_applied": False},
+            {"$unset": {"applying_until": ""}}
+        )
+        raise
+    await db.payments.update_one(
+        {"id": payment["id"]},
+        {"$set": {"effects_applied": True}, "$unset": {"applying_until": ""}}
+    )
+    
+    await db.mpesa_callback_logs.insert_one({
+        "id": str(uuid.uuid4()),
+        "checkout_request_id": checkout_request_id,
+        "source": source,
+        "payload": raw_payload,
+        "received_at": received_at or datetime.now(timezone.utc)
+    })
+
+async def apply_payment_effects(payment: dict, now: datetime):
+    """Apply a settled payment to its order, stock and customer.
+    
+    Every step is safe to repeat, because a failed attempt is resumed from the top.
+    """
+    if payment["status"] != PaymentStatus.SUCCESS:
+        order = await db.orders.find_one_and_update(
+            {"id": payment["order_id"]},
+            {"$set": {"status": OrderStatus.FAILED, "updated_at": now}},
+            projection={"_id": 0, "items": 0, "address_snapshot": 0}
+        )
+        rollup_change = await sync_order_rollup(payment["order_id"])
+        if order and order["status"] != OrderStatus.FAILED:
+            admin_events.publish("order", order_event({**order, "status": OrderStatus.FAILED}, order["status"], rollup_change))
+        return
+    
+    order = await db.orders.find_one({"id": payment["order_id"]}, {"_id": 0})
+    if not order:
+        return
+    
+    if order["status"] != OrderStatus.PAID:
+        await db.orders.update_one(
+            {"id": order["id"]},
+            {"$set": {"status": OrderStatus.PAID, "updated_at": now}}
+        )
+    rollup_change = await sync_order_rollup(order["id"])
+    if order["status"] != OrderStatus.PAID:
+        admin_events.publish("order", order_event({**order, "status": OrderStatus.PAID}, order["status"], rollup_change))
+    
+    low_stock = []
+    for item in order["items"]:
+        inventory = await change_stock(item["product_id"], -item["quantity"], now, reference=f"sale:{order['id']}")
+        if inventory and crossed_low_stock(inventory, -item["quantity"]):
+            low_stock.append(item["product_id"])
+        
+        await db.inventory_logs.update_one(
+            {"reference_id": order["id"], "product_id": item["product_id"], "reason": StockMovementReason.SALE},
+            {"$setOnInsert": {"id": str(uuid.uuid4()), "change": -item["quantity"], "created_at": now}},
+            upsert=True
+        )
+    
+    await db.order_status_history.update_one(
+        {"order_id": order["id"], "status": OrderStatus.PAID},
+        {"$setOnInsert": {"id": str(uuid.uuid4()), "timestamp": now}},
+        upsert=True
+    )
+    
+    # Alert on items this sale took below their low-stock level
+    if low_stock:
+        spawn_background(check_low_stock_and_notify(low_stock))
+    
+    # Last, so a failed step above cannot lead to a second receipt; the outbox write
+    # does not hold up the callback
+    user = await db.users.find_one({"id": order["user_id"]}, {"_id": 0})
+    if user:
+        spawn_background(email_service.send_payment_success(order, user["email"], payment.get("mpesa_receipt")))
+
+class MpesaCallbackQueue:
+    """Durable queue of raw STK callbacks backed by the mpesa_callback_queue collection.
+    
+    Jobs for the same checkout_request_id are processed one at a time in arrival
+    order. Failed jobs are retried with exponential backoff and dead-lettered after
+    MPESA_CALLBACK_MAX_ATTEMPTS. Claims are leased, so jobs held by a crashed
+    worker become claimable again once the lease runs out.
+    """
+    
+    def __init__(self, workers: int = MPESA_CALLBACK_WORKERS):
+        self.workers = workers
+        self._tasks: List[asyncio.Task] = []
+        self._wakeup = asyncio.Event()
+        self._claim_lock = asyncio.Lock()
+        self._in_flight = set()
+    
+    async def enqueue(self, callback_data: dict) -> str:
+        stk_callback = callback_data.get("Body", {}).get("stkCallback", {})
+        now = datetime.now(timezone.utc)
+        job_id = str(uuid.uuid4())
+        await db.mpesa_callback_queue.insert_one({
+            "id": job_id,
+            "checkout_request_id": stk_callback.get("CheckoutRequestID"),
+            "payload": callback_data,
+            "status": "pending",
+            "attempts": 0,
+            "next_attempt_at": now,
+            "received_at": now
+        })
+        self._wakeup.set()
+        return job_id
+    
+    async def _claim(self) -> Optional[dict]:
+        async with self._claim_lock:
+            now = datetime.now(timezone.utc)
+            job = await db.mpesa_callback_queue.find_one_and_update(
+                {
+                    "$or": [
+                        {"status": "pending", "next_attempt_at": {"$lte": now}},
+                        {"status": "processing", "locked_until": {"$lt": now}}
+                    ],
+                    "checkout_request_id": {"$nin": list(self._in_flight)}
+                },
+                {
+                    "$set": {"status": "processing", "locked_until": now + timedelta(seconds=MPESA_CALLBACK_LEASE_SECONDS)},
+                    "$inc": {"attempts": 1}
+                },
+                sort=[("received_at", 1)],
+                projection={"_id": 0},
+                return_document=ReturnDocument.AFTER
+            )
+            if not job:
+                return None
+            
+            # Keep per-checkout ordering: an older job for the same checkout that is
+            # waiting on a retry has to finish first
+            older = await db.mpesa_callback_queue.find_one({
+                "checkout_request_id": job["checkout_request_id"],
+                "status": {"$in": ["pending", "processing"]},
+                "received_at": {"$lt": job["received_at"]},
+                "id": {"$ne": job["id"]}
+            }, {"_id": 0, "next_attempt_at": 1})
+            if older:
+                await db.mpesa_callback_queue.update_one(
+                    {"id": job["id"]},
+                    {
+                        "$set": {"status": "pending", "next_attempt_at": max(older.get("next_attempt_at") or now, now + timedelta(seconds=1))},
+                        "$inc": {"attempts": -1}
+                    }
+                )
+                return None
+            
+            self._in_flight.add(job["checkout_request_id"])
+            return job
+    
+    async def _complete(self, job: dict):
+        await db.mpesa_callback_queue.update_one(
+            {"id": job["id"]},
+            {"$set": {"status": "done", "processed_at": datetime.now(timezone.utc)}, "$unset": {"locked_until": ""}}
+        )
+    
+    async def _fail(self, job: dict, error: Exception):
+        now = datetime.now(timezone.utc)
+        if job["attempts"] >= MPESA_CALLBACK_MAX_ATTEMPTS:
+            logger.error(f"Dead-lettering M-Pesa callback {job['id']} after {job['attempts']} attempts: {error}")
+            update = {"status": "dead", "dead_at": now, "last_error": str(error)}
+        else:
+            delay = MPESA_CALLBACK_RETRY_DELAY * (2 ** (job["attempts"] - 1))
+            logger.warning(f"M-Pesa callback {job['id']} failed, retrying in {delay:.0f}s: {error}")
+            update = {"status": "pending", "next_attempt_at": now + timedelta(seconds=delay), "last_error": str(error)}
+        await db.mpesa_callback_queue.update_one({"id": job["id"]}, {"$set": update, "$unset": {"locked_until": ""}})
+    
+    async def _worker(self):
+        while True:
+            try:
+                job = await self._claim()
+            except Exception as e:
+                logger.error(f"M-Pesa callback queue unavailable: {str(e)}")
+                job = None
+            
+            if not job:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=MPESA_CALLBACK_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                continue
+            
+            try:
+                await process_mpesa_callback(job["payload"], job.get("received_at"))
+                await self._complete(job)
+            except Exception as e:
+                try:
+                    await self._fail(job, e)
+                except Exception as update_error:
+                    logger.error(f"Could not reschedule M-Pesa callback {job['id']}: {update_error}")
+            finally:
+                self._in_flight.discard(job["checkout_request_id"])
+                # Jobs queued behind this checkout may be claimable now
+                self._wakeup.set()
+    
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+    
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+mpesa_callback_queue = MpesaCallbackQueue()
+
+class PaymentReconciler:
+    """Settles payments stuck in PENDING (e.g. lost callbacks) through the STK status query API"""
+    
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+        self._run_lock = asyncio.Lock()
+    
+    async def _reconcile_payment(self, payment: dict, semaphore: asyncio.Semaphore) -> Optional[str]:
+        async with semaphore:
+            try:
+                result = await mpesa_service.query_stk_status(payment["checkout_request_id"])
+            except Exception as e:
+                logger.warning(f"STK status query failed for {payment['checkout_request_id']}: {str(e)}")
+                return "error"
+        
+        if result.get("errorCode") == MpesaService.STILL_PROCESSING_CODE:
+            return "pending"
+        if result.get("ResultCode") is None:
+            logger.warning(f"Unexpected STK status response for {payment['checkout_request_id']}: {result}")
+            return "error"
+        
+        # One payment failing (e.g. a callback worker holds its effects lease) must not end the pass
+        try:
+            await apply_stk_result(
+                checkout_request_id=payment["checkout_request_id"],
+                result_code=result.get("ResultCode"),
+                result_desc=result.get("ResultDesc"),
+                raw_payload=result,
+                source="reconciler"
+            )
+        except Exception as e:
+            logger.warning(f"Could not settle payment {payment['checkout_request_id']}: {str(e)}")
+            return "error"
+        return "settled"
+    
+    async def run_once(self) -> Dict[str, int]:
+        """Page through pending payments older than MPESA_RECONCILE_AFTER_MINUTES and settle them"""
+        async with self._run_lock:
+            cutoff = datetime.now(timezone.utc) - timedelta(minutes=MPESA_RECONCILE_AFTER_MINUTES)
+            semaphore = asyncio.Semaphore(MPESA_RECONCILE_CONCURRENCY)
+            counts = {"checked": 0, "settled": 0, "pending": 0, "resumed": 0, "error": 0}
+            last = None
+            
+            while True:
+                query = {
+                    "status": PaymentStatus.PENDING,
+                    "checkout_request_id": {"$ne": None},
+                    **date_range("created_at", end=cutoff)
+                }
+                if last:
+                    # Keyset pagination; settled payments drop out of the filter as we go
+                    after_last = [
+                        {"created_at": {"$gt": last["created_at"]}},
+                        {"created_at": last["created_at"], "id": {"$gt": last["id"]}}
+                    ]
+                    if isinstance(last["created_at"], str):
+                        # Legacy string dates sort before native ones, and $gt does not compare across types
+                        after_last.append({"created_at": {"$type": "date"}})
+                    query = {"$and": [query, {"$or": after_last}]}
+                page = await db.payments.find(
+                    query, {"_id": 0, "id": 1, "checkout_request_id": 1, "created_at": 1}
+                ).sort([("created_at", 1), ("id", 1)]).limit(MPESA_RECONCILE_PAGE_SIZE).to_list(MPESA_RECONCILE_PAGE_SIZE)
+                if not page:
+                    break
+                
+                outcomes = await asyncio.gather(*[self._reconcile_payment(p, semaphore) for p in page])
+                counts["checked"] += len(page)
+                for outcome in outcomes:
+                    counts[outcome] += 1
+                last = page[-1]
+            
+            # Settled payments whose effects were interrupted and not retried (e.g. a dead-lettered callback)
+            stalled = await db.payments.find(
+                unapplied_payment_query(datetime.now(timezone.utc)),
+                {"_id": 0, "checkout_request_id": 1, "status": 1, "result_code": 1, "result_description": 1}
+            ).to_list(MPESA_RECONCILE_PAGE_SIZE)
+            for payment in stalled:
+                try:
+                    await apply_stk_result(
+                        checkout_request_id=payment["checkout_request_id"],
+                        result_code=0 if payment["status"] == PaymentStatus.SUCCESS else payment.get("result_code"),
+                        result_desc=payment.get("result_description"),
+                        source="reconciler"
+                    )
+                    counts["resumed"] += 1
+                except Exception as e:
+                    logger.warning(f"Could not resume payment {payment['checkout_request_id']}: {str(e)}")
+                    counts["error"] += 1
+            
+            if counts["checked"] or counts["resumed"]:
+                logger.info(f"Payment reconciliation: {counts}")
+            return counts
+    
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(MPESA_RECONCILE_INTERVAL)
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.error(f"Payment reconciliation failed: {str(e)}")
+    
+    def start(self):
+        if MPESA_RECONCILE_INTERVAL > 0 and self._task is None:
+            self._task = asyncio.create_task(self._loop())
+    
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+payment_reconciler = PaymentReconciler()
+
 # ==================== PAYMENT ROUTES ====================
 @api_router.post("/payments/mpesa/initiate", response_model=dict)
 async def initiate_mpesa_payment(payment_data: PaymentInitiate, user: dict = Depends(get_current_user)):
+    await rate_limiter.check("payment_initiate", user_id=user["id"])
     order = await db.orders.find_one({"id": payment_data.order_id, "user_id": user["id"]}, {"_id": 0})
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
@@ -1670,6 +3383,14 @@ async def initiate_mpesa_payment(payment_data: PaymentInitiate, user: dict = Dep
             "message": "Payment already initiated"
         }
     
+    if not mpesa_service.breaker.is_available():
+        # Fail fast instead of queueing checkouts behind a provider outage
+        raise HTTPException(
+            status_code=503,
+            detail="M-Pesa is temporarily unavailable, please try again shortly",
+            headers={"Retry-After": str(int(mpesa_service.breaker.retry_after()))}
+        )
+    
     phone = payment_data.phone_number.replace("+", "").replace(" ", "")
     if phone.startswith("0"):
         phone = "254" + phone[1:]
@@ -1684,7 +3405,7 @@ async def initiate_mpesa_payment(payment_data: PaymentInitiate, user: dict = Dep
         "phone": phone,
         "status": PaymentStatus.INITIATED,
         "method": "MPESA",
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": datetime.now(timezone.utc)
     }
     
     try:
@@ -1694,6 +3415,8 @@ async def initiate_mpesa_payment(payment_data: PaymentInitiate, user: dict = Dep
             reference=f"WA{order['id'][:8].upper()}",
             description="Wacka Accessories"
         )
+        if not mpesa_response.get("CheckoutRequestID"):
+            raise ValueError(mpesa_response.get("errorMessage") or mpesa_response.get("ResponseDescription") or "STK push rejected")
         
         payment["checkout_request_id"] = mpesa_response.get("CheckoutRequestID")
         payment["merchant_request_id"] = mpesa_response.get("MerchantRequestID")
@@ -1709,7 +3432,7 @@ async def initiate_mpesa_payment(payment_data: PaymentInitiate, user: dict = Dep
             "phone": phone,
             "response_code": mpesa_response.get("ResponseCode"),
             "response_description": mpesa_response.get("ResponseDescription"),
-            "created_at": datetime.now(timezone.utc).isoformat()
+            "created_at": datetime.now(timezone.utc)
         })
         
         return {
@@ -1720,6 +3443,13 @@ async def initiate_mpesa_payment(payment_data: PaymentInitiate, user: dict = Dep
             "message": "STK Push sent to your phone"
         }
         
+    except PaymentProviderUnavailable as e:
+        metrics.inc("payments_rejected_total", reason="provider_unavailable")
+        raise HTTPException(
+            status_code=503,
+            detail="M-Pesa is temporarily unavailable, please try again shortly",
+            headers={"Retry-After": str(int(e.retry_after))}
+        )
     except Exception as e:
         logger.error(f"M-Pesa initiation error: {str(e)}")
         payment["status"] = PaymentStatus.FAILED
@@ -1728,110 +3458,24 @@ async def initiate_mpesa_payment(payment_data: PaymentInitiate, user: dict = Dep
         raise HTTPException(status_code=500, detail="Failed to initiate payment")
 
 @api_router.post("/payments/mpesa/callback")
-async def mpesa_callback(request: Request, background_tasks: BackgroundTasks):
+async def mpesa_callback(request: Request):
+    """Persist the raw callback and acknowledge it; processing happens in the callback workers"""
     try:
         callback_data = await request.json()
-        logger.info(f"M-Pesa callback: {callback_data}")
-        
-        body = callback_data.get("Body", {})
-        stk_callback = body.get("stkCallback", {})
-        
-        checkout_request_id = stk_callback.get("CheckoutRequestID")
-        result_code = stk_callback.get("ResultCode")
-        result_desc = stk_callback.get("ResultDesc")
-        
-        payment = await db.payments.find_one({"checkout_request_id": checkout_request_id}, {"_id": 0})
-        if not payment:
-            logger.warning(f"Payment not found for checkout: {checkout_request_id}")
-            return {"ResultCode": 0, "ResultDesc": "Accepted"}
-        
-        if payment["status"] in [PaymentStatus.SUCCESS, PaymentStatus.FAILED]:
-            logger.info(f"Payment already processed: {checkout_request_id}")
-            return {"ResultCode": 0, "ResultDesc": "Accepted"}
-        
-        now = datetime.now(timezone.utc).isoformat()
-        
-        if result_code == 0:
-            metadata = stk_callback.get("CallbackMetadata", {}).get("Item", [])
-            mpesa_receipt = None
-            for item in metadata:
-                if item.get("Name") == "MpesaReceiptNumber":
-                    mpesa_receipt = item.get("Value")
-            
-            await db.payments.update_one(
-                {"id": payment["id"]},
-                {"$set": {
-                    "status": PaymentStatus.SUCCESS,
-                    "mpesa_receipt": mpesa_receipt,
-                    "result_description": result_desc,
-                    "completed_at": now
-                }}
-            )
-            
-            order = await db.orders.find_one({"id": payment["order_id"]}, {"_id": 0})
-            if order:
-                await db.orders.update_one(
-                    {"id": order["id"]},
-                    {"$set": {"status": OrderStatus.PAID, "updated_at": now}}
-                )
-                
-                for item in order["items"]:
-                    await db.inventory.update_one(
-                        {"product_id": item["product_id"]},
-                        {"$inc": {"quantity": -item["quantity"]}}
-                    )
-                    
-                    await db.inventory_logs.insert_one({
-                        "id": str(uuid.uuid4()),
-                        "product_id": item["product_id"],
-                        "change": -item["quantity"],
-                        "reason": StockMovementReason.SALE,
-                        "reference_id": order["id"],
-                        "created_at": now
-                    })
-                
-                await db.order_status_history.insert_one({
-                    "id": str(uuid.uuid4()),
-                    "order_id": order["id"],
-                    "status": OrderStatus.PAID,
-                    "timestamp": now
-                })
-                
-                # Send payment success email
-                user = await db.users.find_one({"id": order["user_id"]}, {"_id": 0})
-                if user:
-                    background_tasks.add_task(email_service.send_payment_success, order, user["email"], mpesa_receipt)
-                
-                # Check low stock and notify
-                background_tasks.add_task(check_low_stock_and_notify)
-        else:
-            await db.payments.update_one(
-                {"id": payment["id"]},
-                {"$set": {
-                    "status": PaymentStatus.FAILED,
-                    "result_code": result_code,
-                    "result_description": result_desc,
-                    "completed_at": now
-                }}
-            )
-            
-            await db.orders.update_one(
-                {"id": payment["order_id"]},
-                {"$set": {"status": OrderStatus.FAILED, "updated_at": now}}
-            )
-        
-        await db.mpesa_callback_logs.insert_one({
-            "id": str(uuid.uuid4()),
-            "checkout_request_id": checkout_request_id,
-            "payload": callback_data,
-            "received_at": now
-        })
-        
-        return {"ResultCode": 0, "ResultDesc": "Accepted"}
-        
+    except ValueError:
+        logger.error("Callback error: body is not JSON")
+        raise HTTPException(status_code=400, detail="Invalid callback payload")
+    logger.info(f"M-Pesa callback: {callback_data}")
+    
+    try:
+        await mpesa_callback_queue.enqueue(callback_data)
     except Exception as e:
-        logger.error(f"Callback error: {str(e)}")
-        return {"ResultCode": 0, "ResultDesc": "Accepted"}
+        # Only a stored callback is acknowledged; anything else makes Daraja deliver it again
+        logger.error(f"Could not queue M-Pesa callback: {str(e)}")
+        metrics.inc("mpesa_callbacks_rejected_total")
+        return JSONResponse(status_code=503, content={"ResultCode": 1, "ResultDesc": "Temporarily unavailable, please retry"})
+    
+    return {"ResultCode": 0, "ResultDesc": "Accepted"}
 
 @api_router.get("/payments/{payment_id}/status", response_model=dict)
 async def get_payment_status(payment_id: str, user: dict = Depends(get_current_user)):
@@ -1850,29 +3494,95 @@ async def get_payment_status(payment_id: str, user: dict = Depends(get_current_u
         "order_status": order["status"]
     }
 
+async def get_owned_payment(payment_id: str, user: dict) -> tuple:
+    payment = await db.payments.find_one({"id": payment_id}, {"_id": 0})
+    if not payment:
+        raise HTTPException(status_code=404, detail="Payment not found")
+    
+    order = await db.orders.find_one({"id": payment["order_id"], "user_id": user["id"]}, {"_id": 0, "status": 1})
+    if not order:
+        raise HTTPException(status_code=404, detail="Order not found")
+    return payment, order
+
+def is_payment_settled(status: str) -> bool:
+    return status in [PaymentStatus.SUCCESS, PaymentStatus.FAILED]
+
+@api_router.get("/payments/{payment_id}/events")
+async def stream_payment_events(payment_id: str, request: Request, user: dict = Depends(get_stream_user)):
+    """Server-Sent Events stream of a payment's status; closes once the payment settles"""
+    # Subscribe before reading so a callback landing in between is not missed
+    queue = payment_events.subscribe(payment_id)
+    try:
+        payment, order = await get_owned_payment(payment_id, user)
+    except HTTPException:
+        payment_events.unsubscribe(payment_id, queue)
+        raise
+    
+    async def event_stream():
+        try:
+            event = payment_event(payment, order["status"])
+            yield f"event: status\ndata: {json.dumps(event)}\n\n"
+            if is_payment_settled(event["status"]):
+                return
+            
+            deadline = time.monotonic() + PAYMENT_EVENTS_MAX_STREAM_SECONDS
+            while time.monotonic() < deadline:
+                if await request.is_disconnected():
+                    return
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=PAYMENT_EVENTS_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"event: status\ndata: {json.dumps(event)}\n\n"
+                if is_payment_settled(event["status"]):
+                    return
+        finally:
+            payment_events.unsubscribe(payment_id, queue)
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@api_router.get("/payments/{payment_id}/wait", response_model=dict)
+async def wait_for_payment_status(
+    payment_id: str,
+    known_status: Optional[str] = None,
+    timeout: float = 25,
+    user: dict = Depends(get_current_user)
+):
+    """Long-poll fallback: returns once the status differs from known_status or the timeout passes"""
+    queue = payment_events.subscribe(payment_id)
+    try:
+        payment, order = await get_owned_payment(payment_id, user)
+        event = payment_event(payment, order["status"])
+        if event["status"] == known_status and not is_payment_settled(event["status"]):
+            try:
+                event = await asyncio.wait_for(queue.get(), timeout=min(max(timeout, 0), PAYMENT_EVENTS_MAX_WAIT))
+            except asyncio.TimeoutError:
+                pass
+        return event
+    finally:
+        payment_events.unsubscribe(payment_id, queue)
+
 # ==================== ADMIN ROUTES ====================
 @api_router.get("/admin/dashboard", response_model=DashboardStats)
 async def get_dashboard_stats(user: dict = Depends(get_admin_user)):
     today_start = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
     
-    today_orders = await db.orders.find({
-        "status": {"$in": [OrderStatus.PAID, OrderStatus.PROCESSING, OrderStatus.COMPLETED]},
-        "created_at": {"$gte": today_start.isoformat()}
-    }, {"_id": 0}).to_list(1000)
-    today_sales = sum(o["total_amount"] for o in today_orders)
+    today_rollup = await db.sales_daily.find_one({"_id": sales_day(today_start)}, {"revenue": 1})
+    today_sales = today_rollup["revenue"] if today_rollup else 0
     
-    all_today_orders = await db.orders.count_documents({
-        "created_at": {"$gte": today_start.isoformat()}
-    })
+    all_today_orders = await db.orders.count_documents(date_range("created_at", today_start))
     
     failed_payments = await db.payments.count_documents({
         "status": PaymentStatus.FAILED,
-        "created_at": {"$gte": today_start.isoformat()}
+        **date_range("created_at", today_start)
     })
     
-    low_stock = await db.inventory.count_documents({
-        "$expr": {"$lte": ["$quantity", "$low_stock_threshold"]}
-    })
+    low_stock = await db.inventory.count_documents({"is_low_stock": True})
     
     return DashboardStats(
         today_sales=today_sales,
@@ -1917,8 +3627,10 @@ async def update_order_status(order_id: str, status_update: OrderStatusUpdate, b
         raise HTTPException(status_code=404, detail="Order not found")
     
     status = status_update.status
-    now = datetime.now(timezone.utc).isoformat()
+    now = datetime.now(timezone.utc)
     await db.orders.update_one({"id": order_id}, {"$set": {"status": status, "updated_at": now}})
+    rollup_change = await sync_order_rollup(order_id)
+    admin_events.publish("order", order_event({**order, "status": status}, order["status"], rollup_change))
     
     await db.order_status_history.insert_one({
         "id": str(uuid.uuid4()),
@@ -1969,7 +3681,7 @@ async def update_order_status(order_id: str, status_update: OrderStatusUpdate, b
         payment_method=order.get("payment_method", "mpesa"),
         delivery_method=order.get("delivery_method", "delivery"),
         created_at=datetime.fromisoformat(order["created_at"]) if isinstance(order["created_at"], str) else order["created_at"],
-        updated_at=datetime.fromisoformat(now)
+        updated_at=now
     )
 
 @api_router.get("/admin/products", response_model=List[ProductResponse])
@@ -2003,7 +3715,7 @@ async def create_product(product: ProductCreate, user: dict = Depends(get_admin_
         raise HTTPException(status_code=400, detail="SKU already exists")
     
     product_id = str(uuid.uuid4())
-    now = datetime.now(timezone.utc).isoformat()
+    now = datetime.now(timezone.utc)
     
     product_doc = {
         "id": product_id,
@@ -2025,6 +3737,7 @@ async def create_product(product: ProductCreate, user: dict = Depends(get_admin_
         "product_id": product_id,
         "quantity": 0,
         "low_stock_threshold": 5,
+        "is_low_stock": True,
         "updated_at": now
     })
     
@@ -2040,7 +3753,7 @@ async def create_product(product: ProductCreate, user: dict = Depends(get_admin_
         images=product.images,
         is_active=True,
         stock_quantity=0,
-        created_at=datetime.fromisoformat(now)
+        created_at=now
     )
 
 @api_router.put("/admin/products/{product_id}", response_model=ProductResponse)
@@ -2094,26 +3807,20 @@ async def get_inventory(user: dict = Depends(get_admin_user)):
                 "product_name": product["name"],
                 "quantity": inv["quantity"],
                 "low_stock_threshold": inv["low_stock_threshold"],
-                "is_low_stock": inv["quantity"] <= inv["low_stock_threshold"]
+                "is_low_stock": inv["is_low_stock"]
             })
     return result
 
 @api_router.post("/admin/inventory/adjust")
 async def adjust_inventory(adjustment: InventoryAdjust, background_tasks: BackgroundTasks, user: dict = Depends(get_admin_user)):
-    inventory = await db.inventory.find_one({"product_id": adjustment.product_id}, {"_id": 0})
+    now = datetime.now(timezone.utc)
+    # The below-zero check is part of the update, so concurrent adjustments cannot overdraw
+    inventory = await change_stock(adjustment.product_id, adjustment.change, now, allow_negative=False)
     if not inventory:
+        if await db.inventory.count_documents({"product_id": adjustment.product_id}, limit=1):
+            raise HTTPException(status_code=400, detail="Cannot reduce stock below 0")
         raise HTTPException(status_code=404, detail="Inventory not found")
     
-    new_quantity = inventory["quantity"] + adjustment.change
-    if new_quantity < 0:
-        raise HTTPException(status_code=400, detail="Cannot reduce stock below 0")
-    
-    now = datetime.now(timezone.utc).isoformat()
-    await db.inventory.update_one(
-        {"product_id": adjustment.product_id},
-        {"$set": {"quantity": new_quantity, "updated_at": now}}
-    )
-    
     await db.inventory_logs.insert_one({
         "id": str(uuid.uuid4()),
         "product_id": adjustment.product_id,
@@ -2123,10 +3830,10 @@ async def adjust_inventory(adjustment: InventoryAdjust, background_tasks: Backgr
         "created_at": now
     })
     
-    # Check low stock after adjustment
-    background_tasks.add_task(check_low_stock_and_notify)
+    if crossed_low_stock(inventory, adjustment.change):
+        background_tasks.add_task(check_low_stock_and_notify, [adjustment.product_id])
     
-    return {"message": "Inventory adjusted", "new_quantity": new_quantity}
+    return {"message": "Inventory adjusted", "new_quantity": inventory["quantity"]}
 
 @api_router.get("/admin/payments")
 async def get_payments(
@@ -2142,23 +3849,208 @@ async def get_payments(
     payments = await db.payments.find(query, {"_id": 0}).sort("created_at", -1).skip(skip).limit(limit).to_list(limit)
     return payments
 
+@api_router.get("/admin/payments/callbacks/dead-letter")
+async def get_dead_letter_callbacks(skip: int = 0, limit: int = 50, user: dict = Depends(get_admin_user)):
+    """List M-Pesa callbacks that exhausted their retries"""
+    jobs = await db.mpesa_callback_queue.find({"status": "dead"}, {"_id": 0}).sort("received_at", -1).skip(skip).limit(limit).to_list(limit)
+    return jobs
+
+@api_router.post("/admin/payments/callbacks/{job_id}/retry")
+async def retry_dead_letter_callback(job_id: str, user: dict = Depends(get_admin_user)):
+    """Put a dead-lettered M-Pesa callback back on the queue"""
+    result = await db.mpesa_callback_queue.update_one(
+        {"id": job_id, "status": "dead"},
+        {"$set": {"status": "pending", "attempts": 0, "next_attempt_at": datetime.now(timezone.utc)}}
+    )
+    if result.matched_count == 0:
+        raise HTTPException(status_code=404, detail="Dead-lettered callback not found")
+    return {"message": "Callback requeued"}
+
+PAID_ORDER_STATUSES = [OrderStatus.PAID, OrderStatus.PROCESSING, OrderStatus.SHIPPED, OrderStatus.COMPLETED]
+
+RECONCILIATION_COLUMNS = [
+    "issue", "payment_id", "order_id", "checkout_request_id", "mpesa_receipt",
+    "payment_status", "order_status", "payment_amount", "order_amount", "paid_amount",
+    "callback_count", "created_at", "detail"
+]
+
+def build_reconciliation_pipeline(start: datetime, end: datetime) -> List[dict]:
+    """Single aggregation over payments (joined to orders and callback logs) that emits one row per mismatch"""
+    created = date_range("created_at", start, end)
+    success = {"$eq": ["$status", PaymentStatus.SUCCESS]}
+    order_paid = {"$in": ["$order.status", PAID_ORDER_STATUSES]}
+    return [
+        {"$match": created},
+        {"$lookup": {"from": "orders", "localField": "order_id", "foreignField": "id", "as": "order"}},
+        {"$lookup": {"from": "mpesa_callback_logs", "localField": "checkout_request_id", "foreignField": "checkout_request_id", "as": "logs"}},
+        {"$set": {
+            "order": {"$arrayElemAt": ["$order", 0]},
+            "callback_count": {"$size": "$logs"},
+            # Amount actually paid, as reported in the callback metadata
+            "paid_amount": {"$let": {
+                "vars": {"item": {"$arrayElemAt": [{"$filter": {
+                    "input": {"$reduce": {
+                        "input": "$logs.payload.Body.stkCallback.CallbackMetadata.Item",
+                        "initialValue": [],
+                        "in": {"$concatArrays": ["$$value", {"$ifNull": ["$$this", []]}]}
+                    }},
+                    "cond": {"$eq": ["$$this.Name", "Amount"]}
+                }}, 0]}},
+                "in": "$$item.Value"
+            }}
+        }},
+        {"$set": {"issues": {"$concatArrays": [
+            {"$cond": [{"$and": [success, {"$not": [order_paid]}]}, ["success_without_paid_order"], []]},
+            {"$cond": [{"$and": [
+                success,
+                {"$ne": [{"$type": "$order"}, "missing"]},
+                {"$or": [
+                    {"$ne": ["$amount", "$order.total_amount"]},
+                    # STK push sends whole shillings, so allow for the truncated fraction
+                    {"$and": [{"$ne": ["$paid_amount", None]}, {"$gte": [{"$abs": {"$subtract": ["$paid_amount", "$order.total_amount"]}}, 1]}]}
+                ]}
+            ]}, ["amount_mismatch"], []]}
+        ]}}},
+        {"$match": {"issues.0": {"$exists": True}}},
+        {"$unwind": "$issues"},
+        {"$project": {
+            "_id": 0,
+            "issue": "$issues",
+            "payment_id": "$id",
+            "order_id": 1,
+            "checkout_request_id": 1,
+            "mpesa_receipt": 1,
+            "payment_status": "$status",
+            "order_status": "$order.status",
+            "payment_amount": "$amount",
+            "order_amount": "$order.total_amount",
+            "paid_amount": 1,
+            "callback_count": 1,
+            "created_at": 1
+        }},
+        {"$unionWith": {"coll": "payments", "pipeline": [
+            {"$match": {**created, "status": PaymentStatus.SUCCESS, "mpesa_receipt": {"$type": "string"}}},
+            {"$group": {
+                "_id": "$mpesa_receipt",
+                "count": {"$sum": 1},
+                "payment_ids": {"$push": "$id"},
+                "amount": {"$sum": "$amount"},
+                "created_at": {"$min": "$created_at"}
+            }},
+            {"$match": {"count": {"$gt": 1}}},
+            {"$project": {
+                "_id": 0,
+                "issue": {"$literal": "duplicate_receipt"},
+                "mpesa_receipt": "$_id",
+                "payment_status": {"$literal": PaymentStatus.SUCCESS},
+                "payment_amount": "$amount",
+                "created_at": 1,
+                "detail": {"$concat": [
+                    {"$toString": "$count"}, " payments: ",
+                    {"$reduce": {"input": "$payment_ids", "initialValue": "", "in": {"$concat": ["$$value", {"$cond": [{"$eq": ["$$value", ""]}, "", ","]}, "$$this"]}}}
+                ]}
+            }}
+        ]}},
+        {"$unionWith": {"coll": "orders", "pipeline": [
+            {"$match": {
+                **created,
+                "status": {"$in": PAID_ORDER_STATUSES},
+                "payment_method": {"$ne": "pay_on_delivery"}
+            }},
+            {"$lookup": {"from": "payments", "localField": "id", "foreignField": "order_id", "as": "payments"}},
+            {"$match": {"payments.status": {"$ne": PaymentStatus.SUCCESS}}},
+            {"$project": {
+                "_id": 0,
+                "issue": {"$literal": "paid_order_without_payment"},
+                "order_id": "$id",
+                "order_status": "$status",
+                "order_amount": "$total_amount",
+                "created_at": 1,
+                "detail": {"$concat": [{"$toString": {"$size": "$payments"}}, " unsuccessful payment(s)"]}
+            }}
+        ]}}
+    ]
+
+@api_router.get("/admin/payments/reconciliation")
+async def get_payment_reconciliation(
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    user: dict = Depends(get_admin_user)
+):
+    """Stream payment/order mismatches in [start, end) as CSV (defaults to the last 30 days)"""
+    end = end or datetime.now(timezone.utc)
+    start = start or end - timedelta(days=30)
+    start, end = [d if d.tzinfo else d.replace(tzinfo=timezone.utc) for d in (start, end)]
+    if start >= end:
+        raise HTTPException(status_code=400, detail="start must be before end")
+    
+    pipeline = build_reconciliation_pipeline(start, end)
+    cursor = db.payments.aggregate(pipeline, allowDiskUse=True, batchSize=500)
+    
+    async def csv_rows():
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=RECONCILIATION_COLUMNS, extrasaction="ignore")
+        writer.writeheader()
+        async for row in cursor:
+            writer.writerow(row)
+            if buffer.tell() > 64 * 1024:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+    
+    filename = f"reconciliation_{start.date().isoformat()}_{end.date().isoformat()}.csv"
+    return StreamingResponse(
+        csv_rows(),
+        media_type="text/csv",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+@api_router.post("/admin/payments/reconcile")
+async def reconcile_pending_payments(user: dict = Depends(get_admin_user)):
+    """Run the pending payment reconciler now"""
+    counts = await payment_reconciler.run_once()
+    return {"message": "Reconciliation complete", **counts}
+
+@api_router.get("/admin/metrics")
+async def get_metrics(user: dict = Depends(get_admin_user)):
+    """In-process counters, timings and gauges (circuit breaker state, in-flight calls)"""
+    return metrics.snapshot()
+
 @api_router.get("/admin/low-stock")
 async def get_low_stock_items(user: dict = Depends(get_admin_user)):
-    low_stock = await db.inventory.find({
-        "$expr": {"$lte": ["$quantity", "$low_stock_threshold"]}
-    }, {"_id": 0}).to_list(100)
+    """Items at or below their threshold or forecast reorder point, most urgent (fewest days of cover) first.
     
-    result = []
-    for inv in low_stock:
-        product = await db.products.find_one({"id": inv["product_id"]}, {"_id": 0})
-        if product:
-            result.append({
-                "product_id": inv["product_id"],
-                "product_name": product["name"],
-                "quantity": inv["quantity"],
-                "threshold": inv["low_stock_threshold"]
-            })
-    return result
+    velocity, days_of_cover and reorder_point are written by `manage.py forecast-stock`,
+    which also refreshes is_low_stock; the queries and sorts are served by one index.
+    Rows it has not reached yet (e.g. new products) have no days_of_cover, which would
+    sort first, so they are listed after the forecast ones, lowest quantity first.
+    """
+    low_stock = await db.inventory.find(
+        {"is_low_stock": True, "days_of_cover": {"$ne": None}}, {"_id": 0}
+    ).sort([("days_of_cover", 1), ("quantity", 1)]).to_list(100)
+    if len(low_stock) < 100:
+        low_stock += await db.inventory.find(
+            {"is_low_stock": True, "days_of_cover": None}, {"_id": 0}
+        ).sort("quantity", 1).to_list(100 - len(low_stock))
+    
+    products = await db.products.find(
+        {"id": {"$in": [inv["product_id"] for inv in low_stock]}}, {"_id": 0, "id": 1, "name": 1}
+    ).to_list(None)
+    names = {p["id"]: p["name"] for p in products}
+    
+    return [
+        {
+            "product_id": inv["product_id"],
+            "product_name": names[inv["product_id"]],
+            "quantity": inv["quantity"],
+            "threshold": inv["low_stock_threshold"],
+            "velocity": inv.get("velocity"),
+            "days_of_cover": inv.get("days_of_cover"),
+            "reorder_point": inv.get("reorder_point")
+        }
+        for inv in low_stock if inv["product_id"] in names
+    ]
 
 # ==================== SEO ROUTES ====================
 @api_router.get("/sitemap")
@@ -2236,19 +4128,20 @@ async def get_product_seo(product_id: str):
 
 # ==================== SEED DATA ====================
 @api_router.post("/seed")
-async def seed_data():
+async def seed_data(request: Request):
+    await rate_limiter.check("seed", request)
     existing_admin = await db.users.find_one({"role": UserRole.ADMIN})
     if existing_admin:
         return {"message": "Data already seeded"}
     
-    now = datetime.now(timezone.utc).isoformat()
+    now = datetime.now(timezone.utc)
     
     # Create admin user
     admin_id = str(uuid.uuid4())
     await db.users.insert_one({
         "id": admin_id,
         "email": "admin@wacka.co.ke",
-        "password": hash_password("admin123"),
+        "password": await hash_password("admin123"),
         "first_name": "Admin",
         "last_name": "User",
         "phone_number": "254712345678",
@@ -2352,6 +4245,7 @@ async def seed_data():
             "product_id": product["id"],
             "quantity": 20,
             "low_stock_threshold": 5,
+            "is_low_stock": False,
             "updated_at": now
         })
     
@@ -2420,6 +4314,8 @@ async def mark_notification_read(notification_id: str, user: dict = Depends(get_
     )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Notification not found")
+    if result.modified_count:
+        admin_events.publish("notification_read", {"id": notification_id})
     return {"message": "Notification marked as read"}
 
 @api_router.post("/admin/notifications/mark-all-read")
@@ -2429,134 +4325,758 @@ async def mark_all_notifications_read(user: dict = Depends(get_admin_user)):
         {"is_read": False},
         {"$set": {"is_read": True}}
     )
+    admin_events.publish("notification_read", {"all": True})
     return {"message": "All notifications marked as read"}
 
 # ==================== ENHANCED DASHBOARD STATS ====================
-@api_router.get("/admin/dashboard/stats", response_model=EnhancedDashboardStats)
-async def get_enhanced_dashboard_stats(user: dict = Depends(get_admin_user)):
-    """Get enhanced dashboard statistics"""
-    now = datetime.now(timezone.utc)
-    today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
-    
-    # Today's stats
-    today_orders = await db.orders.find({
-        "created_at": {"$gte": today_start.isoformat()}
-    }, {"_id": 0}).to_list(1000)
-    
-    today_sales = sum(o["total_amount"] for o in today_orders)
-    orders_today = len(today_orders)
+def dashboard_month_starts(now: datetime, months: int = 12) -> List[datetime]:
+    """Start of the current calendar month and of each of the previous months, newest first"""
+    starts = []
+    year, month = now.year, now.month
+    for _ in range(months):
+        starts.append(datetime(year, month, 1, tzinfo=timezone.utc))
+        year, month = (year, month - 1) if month > 1 else (year - 1, 12)
+    return starts
+
+def build_dashboard_pipeline(now: datetime) -> list:
+    """One pass over the last twelve months of sales_daily that returns only the dashboard totals.
+    
+    Day documents are keyed YYYY-MM-DD, so the first seven characters are the month
+    key and range filters compare as strings. The leading $match bounds the window on
+    both sides, so $facet only ever sees the twelve months it reports (days dated after
+    today, e.g. from clock skew, are left out) and the scan uses the _id index.
+    """
+    month_start = dashboard_month_starts(now)[-1]
+    quarter_start = now.replace(month=(now.month - 1) // 3 * 3 + 1, day=1)
+    year_start = now.replace(month=1, day=1)
+    
+    def total_since(start: datetime) -> list:
+        return [
+            {"$match": {"_id": {"$gte": sales_day(start)}}},
+            {"$group": {"_id": None, "total": {"$sum": "$revenue"}}}
+        ]
     
-    # Failed payments
-    failed_payments = await db.payments.count_documents({"status": PaymentStatus.FAILED})
+    return [
+        {"$match": {"_id": {"$gte": sales_day(month_start), "$lte": sales_day(now)}}},
+        {"$facet": {
+            "today": [
+                {"$match": {"_id": sales_day(now)}},
+                {"$project": {"_id": 0, "total": "$revenue"}}
+            ],
+            "monthly": [
+                {"$group": {"_id": {"$substrCP": ["$_id", 0, 7]}, "total": {"$sum": "$revenue"}}}
+            ],
+            "quarterly": total_since(quarter_start),
+            "yearly": total_since(year_start),
+            "top_products": [
+                {"$project": {"products": {"$objectToArray": "$products"}}},
+                {"$unwind": "$products"},
+                {"$group": {
+                    "_id": "$products.k",
+                    "name": {"$last": "$products.v.name"},
+                    "quantity_sold": {"$sum": "$products.v.quantity"},
+                    "revenue": {"$sum": "$products.v.revenue"}
+                }},
+                {"$sort": {"revenue": -1}},
+                {"$limit": 10}
+            ]
+        }}
+    ]
+
+async def compute_enhanced_dashboard_stats() -> EnhancedDashboardStats:
+    now = datetime.now(timezone.utc)
     
-    # Low stock count
-    low_stock_count = await db.inventory.count_documents({
-        "$expr": {"$lte": ["$quantity", "$low_stock_threshold"]}
-    })
+    today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
     
-    # Monthly sales (last 12 months)
-    monthly_sales = {}
-    for i in range(12):
-        month_date = now - timedelta(days=30 * i)
-        month_key = month_date.strftime("%Y-%m")
-        month_start = month_date.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-        
-        if i == 0:
-            month_end = now
-        else:
-            month_end = (month_date.replace(day=1) + timedelta(days=32)).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-        
-        month_orders = await db.orders.find({
-            "created_at": {"$gte": month_start.isoformat(), "$lt": month_end.isoformat()},
-            "status": {"$nin": [OrderStatus.CANCELLED, OrderStatus.FAILED]}
-        }, {"_id": 0}).to_list(10000)
-        
-        monthly_sales[month_key] = sum(o["total_amount"] for o in month_orders)
-    
-    # Yearly sales
-    year_start = now.replace(month=1, day=1, hour=0, minute=0, second=0, microsecond=0)
-    year_orders = await db.orders.find({
-        "created_at": {"$gte": year_start.isoformat()},
-        "status": {"$nin": [OrderStatus.CANCELLED, OrderStatus.FAILED]}
-    }, {"_id": 0}).to_list(10000)
-    yearly_sales = sum(o["total_amount"] for o in year_orders)
-    
-    # Quarterly sales (current quarter)
-    quarter = (now.month - 1) // 3
-    quarter_start_month = quarter * 3 + 1
-    quarter_start = now.replace(month=quarter_start_month, day=1, hour=0, minute=0, second=0, microsecond=0)
-    quarter_orders = await db.orders.find({
-        "created_at": {"$gte": quarter_start.isoformat()},
-        "status": {"$nin": [OrderStatus.CANCELLED, OrderStatus.FAILED]}
-    }, {"_id": 0}).to_list(10000)
-    quarterly_sales = sum(o["total_amount"] for o in quarter_orders)
-    
-    # Most viewed products
-    products = await db.blog_posts.find({}, {"_id": 0}).sort("views", -1).limit(10).to_list(10)
-    most_viewed_blog = [{"id": p["id"], "title": p["title"], "views": p.get("views", 0)} for p in products]
-    
-    # Also get top selling products by counting orders
-    product_sales = {}
-    all_orders = await db.orders.find({"status": {"$in": [OrderStatus.PAID, OrderStatus.PROCESSING, OrderStatus.SHIPPED, OrderStatus.COMPLETED]}}, {"_id": 0}).to_list(10000)
-    for order in all_orders:
-        for item in order.get("items", []):
-            pid = item["product_id"]
-            if pid not in product_sales:
-                product_sales[pid] = {"quantity": 0, "revenue": 0, "name": item["product_name"]}
-            product_sales[pid]["quantity"] += item["quantity"]
-            product_sales[pid]["revenue"] += item["price"] * item["quantity"]
-    
-    most_viewed_products = [
-        {"id": pid, "name": data["name"], "quantity_sold": data["quantity"], "revenue": data["revenue"]}
-        for pid, data in sorted(product_sales.items(), key=lambda x: x[1]["revenue"], reverse=True)[:10]
-    ]
+    facets, orders_today, failed_payments, low_stock_count, total_customers, pending_orders = await asyncio.gather(
+        db.sales_daily.aggregate(build_dashboard_pipeline(now)).to_list(1),
+        db.orders.count_documents(date_range("created_at", today_start)),
+        db.payments.count_documents({"status": PaymentStatus.FAILED}),
+        db.inventory.count_documents({"is_low_stock": True}),
+        db.users.count_documents({"role": UserRole.CUSTOMER}),
+        db.orders.count_documents({"status": {"$in": [OrderStatus.PENDING_PAYMENT, OrderStatus.PROCESSING]}})
+    )
+    facets = facets[0]
     
-    # Total customers
-    total_customers = await db.users.count_documents({"role": UserRole.CUSTOMER})
+    def first(facet: str) -> dict:
+        return facets[facet][0] if facets[facet] else {}
     
-    # Pending orders
-    pending_orders = await db.orders.count_documents({
-        "status": {"$in": [OrderStatus.PENDING_PAYMENT, OrderStatus.PROCESSING]}
-    })
+    month_totals = {m["_id"]: m["total"] for m in facets["monthly"]}
+    monthly_sales = {
+        start.strftime("%Y-%m"): month_totals.get(start.strftime("%Y-%m"), 0)
+        for start in dashboard_month_starts(now)
+    }
     
     return EnhancedDashboardStats(
-        today_sales=today_sales,
+        today_sales=first("today").get("total", 0),
         orders_today=orders_today,
         failed_payments=failed_payments,
         low_stock_count=low_stock_count,
         monthly_sales=monthly_sales,
-        yearly_sales=yearly_sales,
-        quarterly_sales=quarterly_sales,
-        most_viewed_products=most_viewed_products,
+        yearly_sales=first("yearly").get("total", 0),
+        quarterly_sales=first("quarterly").get("total", 0),
+        most_viewed_products=[
+            {"id": p["_id"], "name": p["name"], "quantity_sold": p["quantity_sold"], "revenue": p["revenue"]}
+            for p in facets["top_products"]
+        ],
         total_customers=total_customers,
         pending_orders=pending_orders
     )
 
-# ==================== CUSTOM EMAIL ROUTES ====================
-@api_router.post("/admin/send-custom-email")
-async def send_custom_email(email_request: CustomEmailRequest, user: dict = Depends(get_admin_user)):
-    """Send custom email to multiple recipients"""
-    success_count = 0
-    failed_emails = []
+@api_router.get("/admin/dashboard/stats", response_model=EnhancedDashboardStats)
+async def get_enhanced_dashboard_stats(user: dict = Depends(get_admin_user)):
+    """Get enhanced dashboard statistics"""
+    return await compute_enhanced_dashboard_stats()
+
+# ==================== SALES ANALYTICS ====================
+ANALYTICS_PERIODS = {
+    AnalyticsGranularity.DAY: "D",
+    AnalyticsGranularity.WEEK: "W-SUN",
+    AnalyticsGranularity.MONTH: "M",
+    AnalyticsGranularity.QUARTER: "Q",
+    AnalyticsGranularity.YEAR: "Y",
+}
+
+class AnalyticsCache:
+    """TTL + LRU cache of computed analytics; concurrent misses for the same key share one computation"""
+    
+    def __init__(self, ttl: float, maxsize: int):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._computing: Dict[tuple, asyncio.Task] = {}
+    
+    async def get_or_compute(self, key: tuple, compute: Callable[[], Any]):
+        entry = self._entries.get(key)
+        if entry and entry[0] > time.monotonic():
+            self._entries.move_to_end(key)
+            metrics.inc("analytics_cache_hits_total", metric=key[0])
+            return entry[1]
+        metrics.inc("analytics_cache_misses_total", metric=key[0])
+        
+        task = self._computing.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._compute(key, compute))
+            self._computing[key] = task
+        return await asyncio.shield(task)
+    
+    async def _compute(self, key: tuple, compute: Callable[[], Any]):
+        started = time.monotonic()
+        try:
+            result = await compute()
+        finally:
+            self._computing.pop(key, None)
+        metrics.observe("analytics_compute_seconds", time.monotonic() - started, metric=key[0])
+        self._entries[key] = (time.monotonic() + self.ttl, result)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return result
+
+analytics_cache = AnalyticsCache(ANALYTICS_CACHE_TTL, ANALYTICS_CACHE_SIZE)
+
+async def load_sales_frame(start: datetime, end: datetime) -> pd.DataFrame:
+    """Paid orders in [start, end) as columns, streamed from a projected aggregation cursor"""
+    pipeline = [
+        {"$match": {**date_range("created_at", start, end), "status": {"$in": PAID_ORDER_STATUSES}}},
+        {"$project": {
+            "_id": 0, "created_at": 1, "total_amount": 1, "payment_method": 1, "delivery_method": 1,
+            "units": {"$sum": "$items.quantity"}
+        }}
+    ]
+    created_at, amounts, units, payment_methods, delivery_methods = [], [], [], [], []
+    async for order in db.orders.aggregate(pipeline, batchSize=5000):
+        created = order["created_at"]
+        created_at.append(parse_datetime(created) if isinstance(created, str) else created)
+        amounts.append(order["total_amount"])
+        units.append(order.get("units") or 0)
+        payment_methods.append(order.get("payment_method") or "mpesa")
+        delivery_methods.append(order.get("delivery_method") or "delivery")
+    
+    return pd.DataFrame({
+        "created_at": pd.to_datetime(created_at, utc=True),
+        "total_amount": np.asarray(amounts, dtype="float64"),
+        "units": np.asarray(units, dtype="int64"),
+        "payment_method": pd.Categorical(payment_methods),
+        "delivery_method": pd.Categorical(delivery_methods),
+    })
+
+def _pct_change(current: float, previous: float) -> Optional[float]:
+    return round((current - previous) / previous * 100, 2) if previous else None
+
+def sales_totals(frame: pd.DataFrame) -> dict:
+    orders = len(frame)
+    revenue = float(frame["total_amount"].sum())
+    units = int(frame["units"].sum())
+    return {
+        "revenue": revenue,
+        "orders": orders,
+        "units": units,
+        "avg_order_value": revenue / orders if orders else 0.0,
+        "units_per_order": units / orders if orders else 0.0,
+    }
+
+def sales_split(frame: pd.DataFrame, column: str) -> List[dict]:
+    grouped = frame.groupby(column, observed=True)["total_amount"].agg(["sum", "size"]).sort_values("sum", ascending=False)
+    total = grouped["sum"].sum()
+    shares = grouped["sum"].to_numpy() / total * 100 if total else np.zeros(len(grouped))
+    return [
+        {"method": str(method), "revenue": float(revenue), "orders": int(orders), "revenue_share": round(float(share), 2)}
+        for method, revenue, orders, share in zip(grouped.index, grouped["sum"], grouped["size"], shares)
+    ]
+
+def sales_summary(frame: pd.DataFrame, start: datetime, end: datetime) -> dict:
+    """Totals for [start, end) compared with the equally long period just before it"""
+    current = frame[frame["created_at"] >= pd.Timestamp(start)]
+    previous = frame[frame["created_at"] < pd.Timestamp(start)]
+    totals, previous_totals = sales_totals(current), sales_totals(previous)
+    return {
+        "start": start,
+        "end": end,
+        "previous_start": start - (end - start),
+        "totals": totals,
+        "previous_totals": previous_totals,
+        "change_pct": {k: _pct_change(totals[k], previous_totals[k]) for k in totals},
+        "payment_methods": sales_split(current, "payment_method"),
+        "delivery_methods": sales_split(current, "delivery_method"),
+    }
+
+def sales_series(frame: pd.DataFrame, start: datetime, end: datetime, granularity: AnalyticsGranularity) -> List[dict]:
+    """Revenue, orders, units and AOV per period, including periods without sales"""
+    freq = ANALYTICS_PERIODS[granularity]
+    periods = frame["created_at"].dt.tz_convert(None).dt.to_period(freq)
+    grouped = frame.groupby(periods)[["total_amount", "units"]].agg({"total_amount": ["sum", "size"], "units": "sum"})
+    grouped.columns = ["revenue", "orders", "units"]
+    
+    last = pd.Timestamp(end).tz_convert(None) - pd.Timedelta(microseconds=1)
+    index = pd.period_range(pd.Timestamp(start).tz_convert(None), last, freq=freq)
+    grouped = grouped.reindex(index, fill_value=0)
+    
+    revenue = grouped["revenue"].to_numpy(dtype="float64")
+    orders = grouped["orders"].to_numpy(dtype="int64")
+    aov = np.divide(revenue, orders, out=np.zeros_like(revenue), where=orders > 0)
+    change = grouped["revenue"].pct_change().replace([np.inf, -np.inf], np.nan).mul(100).round(2)
+    return [
+        {
+            "period": str(period),
+            "start": period.start_time.tz_localize(timezone.utc).to_pydatetime(),
+            "revenue": float(revenue[i]),
+            "orders": int(orders[i]),
+            "units": int(grouped["units"].iat[i]),
+            "avg_order_value": float(aov[i]),
+            "revenue_change_pct": None if pd.isna(change.iat[i]) else float(change.iat[i]),
+        }
+        for i, period in enumerate(grouped.index)
+    ]
+
+def month_index(value: datetime) -> int:
+    """Months since year 0 of a UTC timestamp; consecutive months differ by one"""
+    value = value.astimezone(timezone.utc)
+    return value.year * 12 + value.month - 1
+
+def month_key(index: int) -> str:
+    return f"{index // 12:04d}-{index % 12 + 1:02d}"
+
+def analytics_range(start: Optional[datetime], end: Optional[datetime]) -> tuple:
+    """Default to the last 30 whole UTC days (including today), so default ranges share cache entries"""
+    if not end:
+        end = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+    start = start or end - timedelta(days=30)
+    start, end = [parse_datetime(d) for d in (start, end)]
+    if start >= end:
+        raise HTTPException(status_code=400, detail="start must be before end")
+    if end - start > timedelta(days=ANALYTICS_MAX_DAYS):
+        raise HTTPException(status_code=400, detail=f"Range is limited to {ANALYTICS_MAX_DAYS} days")
+    return start, end
+
+@api_router.get("/admin/analytics/summary")
+async def get_sales_summary(
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    user: dict = Depends(get_admin_user)
+):
+    """Revenue, orders, AOV, units per order and method splits, with change vs the previous period"""
+    start, end = analytics_range(start, end)
+    
+    async def compute():
+        frame = await load_sales_frame(start - (end - start), end)
+        return await asyncio.to_thread(sales_summary, frame, start, end)
+    
+    return await analytics_cache.get_or_compute(("summary", start, end), compute)
+
+@api_router.get("/admin/analytics/revenue")
+async def get_revenue_series(
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    granularity: AnalyticsGranularity = AnalyticsGranularity.DAY,
+    user: dict = Depends(get_admin_user)
+):
+    """Revenue time series at the requested granularity (UTC periods)"""
+    start, end = analytics_range(start, end)
+    
+    async def compute():
+        frame = await load_sales_frame(start, end)
+        series = await asyncio.to_thread(sales_series, frame, start, end, granularity)
+        return {"start": start, "end": end, "granularity": granularity, "series": series}
+    
+    return await analytics_cache.get_or_compute(("revenue", start, end, granularity), compute)
+
+@api_router.get("/admin/analytics/cohorts")
+async def get_customer_cohorts(months: int = 12, user: dict = Depends(get_admin_user)):
+    """Monthly acquisition cohorts with retention and revenue by month since first purchase.
+    
+    Built by `manage.py build-cohorts`; rows are padded with zeros up to the current month.
+    """
+    months = max(1, min(months, 120))
+    cohorts = await db.analytics_cohorts.find({}, {"_id": 0}).sort("cohort", -1).limit(months).to_list(months)
+    state = await db.analytics_jobs.find_one({"_id": "cohorts"}, {"_id": 0})
+    current = month_index(datetime.now(timezone.utc))
+    
+    rows = []
+    for cohort in reversed(cohorts):
+        year, month = map(int, cohort["cohort"].split("-"))
+        width = current - (year * 12 + month - 1) + 1
+        customers = np.zeros(width, dtype="int64")
+        revenue = np.zeros(width, dtype="float64")
+        customers[:len(cohort["customers"])] = cohort["customers"][:width]
+        revenue[:len(cohort["revenue"])] = cohort["revenue"][:width]
+        size = cohort["size"]
+        rows.append({
+            "cohort": cohort["cohort"],
+            "size": size,
+            "customers": customers.tolist(),
+            "retention_pct": np.round(customers / size * 100, 2).tolist() if size else [0.0] * width,
+            "revenue": revenue.tolist(),
+            "cumulative_revenue_per_customer": np.round(np.cumsum(revenue) / size, 2).tolist() if size else [0.0] * width,
+        })
+    return {"last_run_at": state.get("last_run_at") if state else None, "cohorts": rows}
+
+# ==================== LIVE ADMIN STREAM ====================
+ADMIN_SNAPSHOT_ORDERS = 10
+ADMIN_SNAPSHOT_NOTIFICATIONS = 10
+
+admin_snapshot_cache = AnalyticsCache(ADMIN_SNAPSHOT_TTL, 1)
+
+async def compute_admin_stats() -> dict:
+    """Dashboard stats and the unread notification count, as sent in snapshot and stats events"""
+    stats, unread = await asyncio.gather(
+        compute_enhanced_dashboard_stats(),
+        db.notifications.count_documents({"is_read": False})
+    )
+    return jsonable_encoder({"stats": stats, "unread_notifications": unread})
+
+async def build_admin_snapshot() -> dict:
+    """Dashboard stats, unread notifications and recent orders as of event number seq"""
+    # Taken before the reads, so events that land while they run are replayed on top.
+    # Clients ignore list entries they already have, and take counters only from
+    # snapshot and stats events, so a replayed event is never counted twice
+    sequence = admin_events.sequence
+    counts, notifications, orders = await asyncio.gather(
+        compute_admin_stats(),
+        db.notifications.find({}, {"_id": 0}).sort("created_at", -1).limit(ADMIN_SNAPSHOT_NOTIFICATIONS).to_list(ADMIN_SNAPSHOT_NOTIFICATIONS),
+        db.orders.find({}, {"_id": 0, "items": 0, "address_snapshot": 0}).sort("created_at", -1).limit(ADMIN_SNAPSHOT_ORDERS).to_list(ADMIN_SNAPSHOT_ORDERS)
+    )
+    return jsonable_encoder({
+        "seq": sequence,
+        "day": sales_day(datetime.now(timezone.utc)),
+        **counts,
+        "notifications": notifications,
+        "recent_orders": [order_event(o) for o in orders]
+    })
+
+def sse_message(event: str, data: dict, event_id: Optional[int] = None) -> str:
+    head = f"id: {event_id}\n" if event_id is not None else ""
+    return f"{head}event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@api_router.get("/admin/events")
+async def stream_admin_events(request: Request, user: dict = Depends(get_admin_stream_user)):
+    """Server-Sent Events stream for the admin shell: a snapshot, then order, payment,
+    stock and notification deltas as they happen, and recounted stats shortly after them.
     
-    for email in email_request.recipient_emails:
+    Snapshots are shared between streams for ADMIN_SNAPSHOT_TTL seconds, so opening
+    many admin tabs costs one set of dashboard queries rather than one per tab.
+    """
+    queue = admin_events.subscribe()
+    
+    async def snapshot_messages():
+        snapshot = await admin_snapshot_cache.get_or_compute(("admin_snapshot",), build_admin_snapshot)
+        replay = admin_events.since(snapshot["seq"])
+        if replay is None:
+            # The cached snapshot is older than the replay buffer reaches
+            snapshot = await build_admin_snapshot()
+            replay = admin_events.since(snapshot["seq"]) or []
+        messages = [sse_message("snapshot", snapshot, snapshot["seq"])]
+        messages += [sse_message(e["type"], e["data"], e["seq"]) for e in replay]
+        return messages, replay[-1]["seq"] if replay else snapshot["seq"]
+    
+    async def event_stream():
         try:
-            result = email_service.send_email(email, email_request.subject, email_request.html_content)
-            if result:
-                success_count += 1
-            else:
-                failed_emails.append(email)
-        except Exception as e:
-            logger.error(f"Failed to send email to {email}: {str(e)}")
-            failed_emails.append(email)
+            messages, last_seq = await snapshot_messages()
+            for message in messages:
+                yield message
+            
+            deadline = time.monotonic() + ADMIN_EVENTS_MAX_STREAM_SECONDS
+            while time.monotonic() < deadline:
+                if await request.is_disconnected():
+                    return
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=ADMIN_EVENTS_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                if event is None:
+                    metrics.inc("admin_event_resyncs_total")
+                    messages, last_seq = await snapshot_messages()
+                    for message in messages:
+                        yield message
+                elif event["seq"] > last_seq:
+                    last_seq = event["seq"]
+                    yield sse_message(event["type"], event["data"], event["seq"])
+        finally:
+            admin_events.unsubscribe(queue)
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# ==================== EMAIL CAMPAIGNS ====================
+class CampaignSender:
+    """Sends bulk email campaigns in the background.
+    
+    Recipients live in email_campaign_recipients, one document per address, so a
+    campaign resumes where it left off after a restart. Sends run with bounded
+    concurrency over the pooled SMTP transport, paced by EMAIL_CAMPAIGN_RATE_PER_MINUTE.
+    A campaign is claimed with an owner and a lease, so with several server processes
+    only one sends it, and another resumes it only if the owner stops renewing.
+    """
+    
+    def __init__(self, concurrency: int = EMAIL_CAMPAIGN_CONCURRENCY):
+        self.concurrency = concurrency
+        self.owner = str(uuid.uuid4())
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup = asyncio.Event()
+        self._rate_limiter = SendRateLimiter(EMAIL_CAMPAIGN_RATE_PER_MINUTE)
+    
+    async def add_recipients(self, campaign_id: str, emails) -> int:
+        """Insert recipients in chunks, skipping addresses already on the campaign"""
+        added = 0
+        chunk = []
+        
+        async def flush():
+            nonlocal added
+            if not chunk:
+                return
+            docs = [{"campaign_id": campaign_id, "email": e, "status": "pending", "attempts": 0} for e in chunk]
+            try:
+                result = await db.email_campaign_recipients.insert_many(docs, ordered=False)
+                added += len(result.inserted_ids)
+            except BulkWriteError as e:
+                added += e.details.get("nInserted", 0)
+            chunk.clear()
+        
+        async for email in emails:
+            chunk.append(email.lower())
+            if len(chunk) >= 1000:
+                await flush()
+        await flush()
+        return added
+    
+    async def segment_emails(self, segment: CampaignSegment):
+        query = {"role": UserRole.CUSTOMER}
+        if segment != CampaignSegment.ALL_CUSTOMERS:
+            buyer_ids = await db.orders.distinct("user_id", {"status": {"$in": PAID_ORDER_STATUSES}})
+            query["id"] = {"$in" if segment == CampaignSegment.BUYERS else "$nin": buyer_ids}
+        async for user in db.users.find(query, {"_id": 0, "email": 1}):
+            yield user["email"]
+    
+    async def create(self, data: EmailCampaignCreate, created_by: str) -> dict:
+        campaign = {
+            "id": str(uuid.uuid4()),
+            "subject": data.subject,
+            "html_content": data.html_content,
+            "segment": data.segment,
+            "status": "queued",
+            "total": 0,
+            "sent": 0,
+            "failed": 0,
+            "created_by": created_by,
+            "created_at": datetime.now(timezone.utc)
+        }
+        await db.email_campaigns.insert_one(campaign)
+        
+        if data.recipient_emails:
+            async def explicit():
+                for email in data.recipient_emails:
+                    yield email
+            total = await self.add_recipients(campaign["id"], explicit())
+            await db.email_campaigns.update_one({"id": campaign["id"]}, {"$set": {"total": total, "recipients_ready": True}})
+            campaign.update(total=total, recipients_ready=True)
+        
+        self._wakeup.set()
+        campaign.pop("_id", None)
+        return campaign
+    
+    @staticmethod
+    def is_permanent_failure(error: Exception) -> bool:
+        """5xx rejections (unknown mailbox, refused recipient) will not succeed on retry"""
+        if isinstance(error, smtplib.SMTPRecipientsRefused):
+            return True
+        return isinstance(error, smtplib.SMTPResponseException) and error.smtp_code >= 500
+    
+    async def _send_one(self, campaign: dict, recipient: dict, semaphore: asyncio.Semaphore):
+        async with semaphore:
+            await self._rate_limiter.wait()
+            started = time.monotonic()
+            try:
+                await email_service.deliver(recipient["email"], campaign["subject"], campaign["html_content"])
+                metrics.observe("email_send_seconds", time.monotonic() - started)
+                return recipient, None
+            except Exception as e:
+                return recipient, e
+    
+    async def _run(self, campaign: dict):
+        campaign_id = campaign["id"]
+        if not campaign.get("recipients_ready"):
+            # Segment campaigns resolve their audience here, off the request path
+            await self.add_recipients(campaign_id, self.segment_emails(campaign["segment"]))
+            total = await db.email_campaign_recipients.count_documents({"campaign_id": campaign_id})
+            await db.email_campaigns.update_one({"id": campaign_id}, {"$set": {"total": total, "recipients_ready": True}})
+        
+        semaphore = asyncio.Semaphore(self.concurrency)
+        while True:
+            # Stops on cancellation, and if the lease was lost to another process
+            if not await self._renew_lease(campaign_id):
+                return
+            
+            now = datetime.now(timezone.utc)
+            # Recipients not tried yet sort first (no next_attempt_at), then retries as they fall due
+            batch = await db.email_campaign_recipients.find(
+                {
+                    "campaign_id": campaign_id,
+                    "status": "pending",
+                    "$or": [{"next_attempt_at": {"$exists": False}}, {"next_attempt_at": {"$lte": now}}]
+                },
+                {"_id": 1, "email": 1, "attempts": 1}
+            ).sort("next_attempt_at", 1).limit(EMAIL_CAMPAIGN_BATCH_SIZE).to_list(EMAIL_CAMPAIGN_BATCH_SIZE)
+            if not batch:
+                waiting = await db.email_campaign_recipients.find_one(
+                    {"campaign_id": campaign_id, "status": "pending"}, {"_id": 0, "next_attempt_at": 1},
+                    sort=[("next_attempt_at", 1)]
+                )
+                if not waiting:
+                    break
+                await asyncio.sleep(min(max((waiting["next_attempt_at"] - now).total_seconds(), 0), EMAIL_POLL_INTERVAL))
+                continue
+            
+            results = await asyncio.gather(*[self._send_one(campaign, r, semaphore) for r in batch])
+            
+            updates = []
+            sent = failed = retried = 0
+            for recipient, error in results:
+                if error is None:
+                    sent += 1
+                    updates.append(UpdateOne({"_id": recipient["_id"]}, {"$set": {"status": "sent", "sent_at": datetime.now(timezone.utc)}}))
+                elif recipient["attempts"] + 1 >= EMAIL_CAMPAIGN_MAX_ATTEMPTS or self.is_permanent_failure(error):
+                    failed += 1
+                    updates.append(UpdateOne({"_id": recipient["_id"]}, {"$set": {"status": "failed", "error": str(error)}, "$inc": {"attempts": 1}}))
+                else:
+                    # Stays pending, and is picked up again once the backoff has passed
+                    retried += 1
+                    delay = EMAIL_RETRY_DELAY * (2 ** recipient["attempts"])
+                    updates.append(UpdateOne({"_id": recipient["_id"]}, {
+                        "$set": {"error": str(error), "next_attempt_at": datetime.now(timezone.utc) + timedelta(seconds=delay)},
+                        "$inc": {"attempts": 1}
+                    }))
+            await db.email_campaign_recipients.bulk_write(updates, ordered=False)
+            await db.email_campaigns.update_one({"id": campaign_id}, {"$inc": {"sent": sent, "failed": failed}})
+            metrics.inc("campaign_emails_sent_total", sent)
+            metrics.inc("campaign_emails_failed_total", failed)
+            if retried and not sent:
+                # Nothing got through and some of it may later; likely an SMTP outage, so
+                # back off rather than burn the rest of the recipients' attempts
+                await asyncio.sleep(EMAIL_RETRY_DELAY)
+        
+        await db.email_campaigns.update_one(
+            {"id": campaign_id, "status": "sending", "owner": self.owner},
+            {"$set": {"status": "completed", "completed_at": datetime.now(timezone.utc)}, "$unset": {"lease_until": ""}}
+        )
+        logger.info(f"Email campaign {campaign_id} completed")
+    
+    async def _claim(self) -> Optional[dict]:
+        now = datetime.now(timezone.utc)
+        # A "sending" campaign whose lease ran out was interrupted (restart, crash); resume it first
+        return await db.email_campaigns.find_one_and_update(
+            {"$or": [
+                {"status": "queued"},
+                {"status": "sending", "lease_until": {"$lt": now}},
+                {"status": "sending", "lease_until": {"$exists": False}}
+            ]},
+            {"$set": {
+                "status": "sending",
+                "owner": self.owner,
+                "lease_until": now + timedelta(seconds=EMAIL_CAMPAIGN_LEASE_SECONDS),
+                "started_at": now
+            }},
+            sort=[("status", -1), ("created_at", 1)],
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER
+        )
     
+    async def _renew_lease(self, campaign_id: str) -> bool:
+        result = await db.email_campaigns.update_one(
+            {"id": campaign_id, "status": "sending", "owner": self.owner},
+            {"$set": {"lease_until": datetime.now(timezone.utc) + timedelta(seconds=EMAIL_CAMPAIGN_LEASE_SECONDS)}}
+        )
+        return result.matched_count > 0
+    
+    async def _heartbeat(self, campaign_id: str):
+        """Keep the lease alive while a batch is sending, which can take longer than the lease"""
+        while True:
+            await asyncio.sleep(EMAIL_CAMPAIGN_LEASE_SECONDS / 3)
+            try:
+                if not await self._renew_lease(campaign_id):
+                    return
+            except Exception as e:
+                logger.warning(f"Could not renew lease on email campaign {campaign_id}: {str(e)}")
+    
+    async def _loop(self):
+        while True:
+            campaign = None
+            try:
+                campaign = await self._claim()
+                if campaign:
+                    heartbeat = asyncio.create_task(self._heartbeat(campaign["id"]))
+                    try:
+                        await self._run(campaign)
+                    finally:
+                        heartbeat.cancel()
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Email campaign {campaign['id'] if campaign else ''} failed: {str(e)}")
+                if campaign:
+                    await db.email_campaigns.update_one(
+                        {"id": campaign["id"], "owner": self.owner},
+                        {"$set": {"status": "failed", "error": str(e), "completed_at": datetime.now(timezone.utc)}, "$unset": {"lease_until": ""}}
+                    )
+                    continue
+            
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=EMAIL_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+    
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+    
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+campaign_sender = CampaignSender()
+
+@api_router.post("/admin/email-campaigns")
+async def create_email_campaign(data: EmailCampaignCreate, user: dict = Depends(get_admin_user)):
+    """Queue a bulk email to a list of addresses or a customer segment"""
+    if not data.recipient_emails and not data.segment:
+        raise HTTPException(status_code=400, detail="Provide recipient_emails or a segment")
+    if data.recipient_emails and data.segment:
+        raise HTTPException(status_code=400, detail="Provide either recipient_emails or a segment, not both")
+    if not email_service.is_configured:
+        raise HTTPException(status_code=503, detail="Email is not configured")
+    
+    campaign = await campaign_sender.create(data, user["id"])
     return {
-        "message": f"Sent {success_count} emails successfully",
-        "success_count": success_count,
-        "failed_count": len(failed_emails),
-        "failed_emails": failed_emails
+        "campaign_id": campaign["id"],
+        "status": campaign["status"],
+        "total": campaign["total"],
+        "message": "Campaign queued"
     }
 
+@api_router.get("/admin/email-campaigns")
+async def list_email_campaigns(skip: int = 0, limit: int = 20, user: dict = Depends(get_admin_user)):
+    campaigns = await db.email_campaigns.find({}, {"_id": 0, "html_content": 0}).sort("created_at", -1).skip(skip).limit(limit).to_list(limit)
+    return campaigns
+
+@api_router.get("/admin/email-campaigns/{campaign_id}")
+async def get_email_campaign(campaign_id: str, user: dict = Depends(get_admin_user)):
+    """Campaign progress, with the most recent failed addresses"""
+    campaign = await db.email_campaigns.find_one({"id": campaign_id}, {"_id": 0, "html_content": 0})
+    if not campaign:
+        raise HTTPException(status_code=404, detail="Campaign not found")
+    
+    failures = await db.email_campaign_recipients.find(
+        {"campaign_id": campaign_id, "status": "failed"}, {"_id": 0, "email": 1, "error": 1}
+    ).limit(100).to_list(100)
+    campaign["pending"] = max(campaign["total"] - campaign["sent"] - campaign["failed"], 0)
+    campaign["failures"] = failures
+    return campaign
+
+@api_router.post("/admin/email-campaigns/{campaign_id}/cancel")
+async def cancel_email_campaign(campaign_id: str, user: dict = Depends(get_admin_user)):
+    result = await db.email_campaigns.update_one(
+        {"id": campaign_id, "status": {"$in": ["queued", "sending"]}},
+        {"$set": {"status": "cancelled", "completed_at": datetime.now(timezone.utc)}}
+    )
+    if result.matched_count == 0:
+        raise HTTPException(status_code=400, detail="Campaign is not running")
+    return {"message": "Campaign cancelled"}
+
+@api_router.post("/admin/send-custom-email")
+async def send_custom_email(email_request: CustomEmailRequest, user: dict = Depends(get_admin_user)):
+    """Send custom email to multiple recipients (queued as a campaign)"""
+    return await create_email_campaign(
+        EmailCampaignCreate(
+            subject=email_request.subject,
+            html_content=email_request.html_content,
+            recipient_emails=email_request.recipient_emails
+        ),
+        user
+    )
+
+@api_router.get("/admin/emails/outbox")
+async def get_email_outbox(status: Optional[str] = None, skip: int = 0, limit: int = 50, user: dict = Depends(get_admin_user)):
+    """List queued, sent and dead-lettered outgoing emails"""
+    query = {"status": status} if status else {}
+    messages = await db.email_outbox.find(query, {"_id": 0, "html": 0}).sort("created_at", -1).skip(skip).limit(limit).to_list(limit)
+    return messages
+
+@api_router.post("/admin/emails/outbox/{message_id}/retry")
+async def retry_dead_email(message_id: str, user: dict = Depends(get_admin_user)):
+    """Put a dead-lettered email back on the outbox.
+    
+    A pending email with the same coalesce_key is newer (e.g. a later password reset) and
+    supersedes this one, so the dead copy is not sent as well.
+    """
+    message = await db.email_outbox.find_one({"id": message_id, "status": "dead"}, {"_id": 0, "coalesce_key": 1})
+    if not message:
+        raise HTTPException(status_code=404, detail="Dead-lettered email not found")
+    superseded = {"message": "A newer copy of this email is already queued"}
+    if message.get("coalesce_key") and await db.email_outbox.find_one(
+        {"coalesce_key": message["coalesce_key"], "status": "pending"}, {"_id": 0, "id": 1}
+    ):
+        return superseded
+    
+    try:
+        result = await db.email_outbox.update_one(
+            {"id": message_id, "status": "dead"},
+            {"$set": {"status": "pending", "attempts": 0, "next_attempt_at": datetime.now(timezone.utc)}}
+        )
+    except DuplicateKeyError:
+        # Its key was queued again in the meantime
+        return superseded
+    if result.matched_count == 0:
+        raise HTTPException(status_code=404, detail="Dead-lettered email not found")
+    email_outbox.depth += 1
+    return {"message": "Email requeued"}
+
 # ==================== USER MANAGEMENT ROUTES ====================
 @api_router.get("/admin/users", response_model=List[UserResponse])
 async def get_all_users(skip: int = 0, limit: int = 50, role: Optional[UserRole] = None, user: dict = Depends(get_admin_user)):
@@ -2587,11 +5107,11 @@ async def create_user_by_admin(user_data: UserCreateByAdmin, user: dict = Depend
         raise HTTPException(status_code=400, detail="Email already registered")
     
     user_id = str(uuid.uuid4())
-    now = datetime.now(timezone.utc).isoformat()
+    now = datetime.now(timezone.utc)
     new_user = {
         "id": user_id,
         "email": user_data.email,
-        "password": hash_password(user_data.password),
+        "password": await hash_password(user_data.password),
         "first_name": user_data.first_name,
         "last_name": user_data.last_name,
         "phone_number": user_data.phone_number,
@@ -2618,7 +5138,7 @@ async def create_user_by_admin(user_data: UserCreateByAdmin, user: dict = Depend
         last_name=user_data.last_name,
         phone_number=user_data.phone_number,
         role=user_data.role,
-        created_at=datetime.fromisoformat(now)
+        created_at=now
     )
 
 @api_router.patch("/admin/users/{user_id}/role")
@@ -2630,6 +5150,7 @@ async def update_user_role(user_id: str, role: UserRole, user: dict = Depends(ge
     )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="User not found")
+    user_cache.invalidate(user_id)
     return {"message": "User role updated successfully"}
 
 @api_router.delete("/admin/users/{user_id}")
@@ -2645,6 +5166,7 @@ async def delete_user(user_id: str, user: dict = Depends(get_admin_user)):
     
     # Delete user and associated data
     await db.users.delete_one({"id": user_id})
+    user_cache.invalidate(user_id)
     await db.carts.delete_many({"user_id": user_id})
     await db.addresses.delete_many({"user_id": user_id})
     
@@ -2691,7 +5213,7 @@ async def get_store_settings():
 async def update_store_settings(settings_update: StoreSettingsUpdate, user: dict = Depends(get_admin_user)):
     """Update store settings (admin only)"""
     existing = await db.store_settings.find_one({}, {"_id": 0})
-    now = datetime.now(timezone.utc).isoformat()
+    now = datetime.now(timezone.utc)
     
     if existing:
         # Update existing settings
@@ -2753,19 +5275,18 @@ async def request_order_cancellation(order_id: str, user: dict = Depends(get_cur
     if order["status"] == OrderStatus.CANCELLED:
         raise HTTPException(status_code=400, detail="Order is already cancelled")
     
-    now = datetime.now(timezone.utc).isoformat()
+    now = datetime.now(timezone.utc)
     await db.orders.update_one(
         {"id": order_id},
         {"$set": {"status": OrderStatus.CANCELLED, "updated_at": now}}
     )
+    rollup_change = await sync_order_rollup(order_id)
+    admin_events.publish("order", order_event({**order, "status": OrderStatus.CANCELLED}, order["status"], rollup_change))
     
     # Restore inventory if it was deducted
     if order.get("payment_method") == "pay_on_delivery" or order["status"] == OrderStatus.PAID:
         for item in order["items"]:
-            await db.inventory.update_one(
-                {"product_id": item["product_id"]},
-                {"$inc": {"quantity": item["quantity"]}}
-            )
+            await change_stock(item["product_id"], item["quantity"], now)
     
     # Create notification
     await create_notification(
@@ -2827,8 +5348,8 @@ async def get_all_coupons(user: dict = Depends(get_admin_user)):
             max_discount=c.get("max_discount"),
             usage_limit=c.get("usage_limit"),
             times_used=c.get("times_used", 0),
-            start_date=datetime.fromisoformat(c["start_date"]) if c.get("start_date") else None,
-            end_date=datetime.fromisoformat(c["end_date"]) if c.get("end_date") else None,
+            start_date=parse_datetime(c.get("start_date")),
+            end_date=parse_datetime(c.get("end_date")),
             is_active=c.get("is_active", True),
             created_at=datetime.fromisoformat(c["created_at"]) if isinstance(c["created_at"], str) else c["created_at"]
         )
@@ -2843,7 +5364,7 @@ async def create_coupon(coupon: CouponCreate, user: dict = Depends(get_admin_use
         raise HTTPException(status_code=400, detail="Coupon code already exists")
     
     coupon_id = str(uuid.uuid4())
-    now = datetime.now(timezone.utc).isoformat()
+    now = datetime.now(timezone.utc)
     
     coupon_doc = {
         "id": coupon_id,
@@ -2854,8 +5375,8 @@ async def create_coupon(coupon: CouponCreate, user: dict = Depends(get_admin_use
         "max_discount": coupon.max_discount,
         "usage_limit": coupon.usage_limit,
         "times_used": 0,
-        "start_date": coupon.start_date.isoformat() if coupon.start_date else None,
-        "end_date": coupon.end_date.isoformat() if coupon.end_date else None,
+        "start_date": parse_datetime(coupon.start_date),
+        "end_date": parse_datetime(coupon.end_date),
         "is_active": coupon.is_active,
         "created_at": now
     }
@@ -2873,7 +5394,7 @@ async def create_coupon(coupon: CouponCreate, user: dict = Depends(get_admin_use
         start_date=coupon.start_date,
         end_date=coupon.end_date,
         is_active=coupon.is_active,
-        created_at=datetime.fromisoformat(now)
+        created_at=now
     )
 
 @api_router.delete("/admin/coupons/{coupon_id}")
@@ -2895,12 +5416,12 @@ async def validate_coupon(validation: CouponValidation, user: dict = Depends(get
     
     # Check dates
     if coupon.get("start_date"):
-        start = datetime.fromisoformat(coupon["start_date"])
+        start = parse_datetime(coupon["start_date"])
         if now < start:
             raise HTTPException(status_code=400, detail="Coupon not yet active")
     
     if coupon.get("end_date"):
-        end = datetime.fromisoformat(coupon["end_date"])
+        end = parse_datetime(coupon["end_date"])
         if now > end:
             raise HTTPException(status_code=400, detail="Coupon has expired")
     
@@ -2952,7 +5473,7 @@ async def create_review(review: ReviewCreate, user: dict = Depends(get_current_u
         raise HTTPException(status_code=400, detail="You've already reviewed this product")
     
     review_id = str(uuid.uuid4())
-    now = datetime.now(timezone.utc).isoformat()
+    now = datetime.now(timezone.utc)
     
     review_doc = {
         "id": review_id,
@@ -2980,7 +5501,7 @@ async def create_review(review: ReviewCreate, user: dict = Depends(get_current_u
         title=review.title,
         comment=review.comment,
         is_approved=True,
-        created_at=datetime.fromisoformat(now)
+        created_at=now
     )
 
 @api_router.get("/products/{product_id}/reviews", response_model=List[ReviewResponse])
@@ -3078,7 +5599,7 @@ async def add_to_wishlist(product_id: str, user: dict = Depends(get_current_user
         raise HTTPException(status_code=400, detail="Product already in wishlist")
     
     wishlist_id = str(uuid.uuid4())
-    now = datetime.now(timezone.utc).isoformat()
+    now = datetime.now(timezone.utc)
     
     await db.wishlists.insert_one({
         "id": wishlist_id,
@@ -3133,7 +5654,7 @@ async def add_tracking_event(
         raise HTTPException(status_code=404, detail="Order not found")
     
     event_id = str(uuid.uuid4())
-    now = datetime.now(timezone.utc).isoformat()
+    now = datetime.now(timezone.utc)
     
     await db.order_tracking.insert_one({
         "id": event_id,
@@ -3172,7 +5693,7 @@ async def get_suppliers(user: dict = Depends(get_admin_user)):
 async def create_supplier(supplier: SupplierCreate, user: dict = Depends(get_admin_user)):
     """Create a supplier"""
     supplier_id = str(uuid.uuid4())
-    now = datetime.now(timezone.utc).isoformat()
+    now = datetime.now(timezone.utc)
     
     supplier_doc = {
         "id": supplier_id,
@@ -3195,7 +5716,7 @@ async def create_supplier(supplier: SupplierCreate, user: dict = Depends(get_adm
         contact_person=supplier.contact_person,
         notes=supplier.notes,
         products_count=0,
-        created_at=datetime.fromisoformat(now)
+        created_at=now
     )
 
 @api_router.put("/admin/suppliers/{supplier_id}", response_model=SupplierResponse)
@@ -3262,7 +5783,7 @@ async def get_shipping_zones():
 async def create_shipping_zone(zone: ShippingZoneCreate, user: dict = Depends(get_admin_user)):
     """Create a shipping zone"""
     zone_id = str(uuid.uuid4())
-    now = datetime.now(timezone.utc).isoformat()
+    now = datetime.now(timezone.utc)
     
     zone_doc = {
         "id": zone_id,
@@ -3284,7 +5805,7 @@ async def create_shipping_zone(zone: ShippingZoneCreate, user: dict = Depends(ge
         per_item_rate=zone.per_item_rate,
         free_shipping_threshold=zone.free_shipping_threshold,
         is_active=True,
-        created_at=datetime.fromisoformat(now)
+        created_at=now
     )
 
 @api_router.post("/calculate-shipping")
@@ -3328,10 +5849,15 @@ async def update_tax_config(config: TaxConfigUpdate, user: dict = Depends(get_ad
     return {"message": "Tax configuration updated"}
 
 # ==================== PASSWORD RESET ====================
+def hash_reset_token(token: str) -> str:
+    """Reset tokens are stored as SHA-256 digests, so a leaked collection cannot be used to reset passwords"""
+    return hashlib.sha256(token.encode()).hexdigest()
+
 @api_router.post("/auth/forgot-password")
-async def forgot_password(request: PasswordResetRequest, background_tasks: BackgroundTasks):
+async def forgot_password(data: PasswordResetRequest, request: Request):
     """Request password reset"""
-    user = await db.users.find_one({"email": request.email}, {"_id": 0})
+    await rate_limiter.check("forgot_password", request, email=data.email)
+    user = await db.users.find_one({"email": data.email}, {"_id": 0})
     if not user:
         # Don't reveal if user exists
         return {"message": "If an account exists with this email, a reset link will be sent"}
@@ -3342,50 +5868,49 @@ async def forgot_password(request: PasswordResetRequest, background_tasks: Backg
     
     await db.password_resets.insert_one({
         "user_id": user["id"],
-        "token": token,
-        "expires_at": expires.isoformat(),
+        "token_hash": hash_reset_token(token),
+        # Native date so the TTL index can expire it
+        "expires_at": expires,
         "used": False,
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": datetime.now(timezone.utc)
     })
     
     # Send email (if configured)
-    if SMTP_EMAIL and SMTP_PASSWORD:
-        reset_html = f"""
-        <html>
-        <body>
-            <h2>Password Reset Request</h2>
-            <p>You requested a password reset. Use this token to reset your password:</p>
-            <p style="font-size: 24px; font-weight: bold; color: #10B981;">{token}</p>
-            <p>This token expires in 1 hour.</p>
-            <p>If you didn't request this, please ignore this email.</p>
-        </body>
-        </html>
-        """
-        background_tasks.add_task(email_service.send_email, request.email, "Password Reset - Wacka Accessories", reset_html)
+    if email_service.is_configured:
+        reset_html = template_renderer.render("emails/password_reset.html", token=token)
+        # A newer reset request supersedes one that has not gone out yet
+        await email_service.queue_email(
+            data.email, "Password Reset - Wacka Accessories", reset_html,
+            kind="password_reset", coalesce_key=f"password_reset:{data.email}"
+        )
     
     return {"message": "If an account exists with this email, a reset link will be sent"}
 
 @api_router.post("/auth/reset-password")
-async def reset_password(data: PasswordResetConfirm):
+async def reset_password(data: PasswordResetConfirm, request: Request):
     """Reset password with token"""
-    reset = await db.password_resets.find_one({
-        "token": data.token,
-        "used": False
-    }, {"_id": 0})
-    
+    await rate_limiter.check("reset_password", request)
+    now = datetime.now(timezone.utc)
+    # Claiming the token in the lookup means two concurrent requests cannot both use it
+    reset = await db.password_resets.find_one_and_update(
+        {"token_hash": hash_reset_token(data.token), "used": False, "expires_at": {"$gt": now}},
+        {"$set": {"used": True, "used_at": now}},
+        projection={"_id": 0}
+    )
     if not reset:
         raise HTTPException(status_code=400, detail="Invalid or expired reset token")
     
-    expires = datetime.fromisoformat(reset["expires_at"])
-    if datetime.now(timezone.utc) > expires:
-        raise HTTPException(status_code=400, detail="Reset token has expired")
-    
-    # Update password
-    hashed = hash_password(data.new_password)
+    try:
+        hashed = await hash_password(data.new_password)
+    except Exception:
+        # Give the token back if the server was too busy to hash the new password
+        await db.password_resets.update_one(
+            {"token_hash": reset["token_hash"]},
+            {"$set": {"used": False}, "$unset": {"used_at": ""}}
+        )
+        raise
     await db.users.update_one({"id": reset["user_id"]}, {"$set": {"password": hashed}})
-    
-    # Mark token as used
-    await db.password_resets.update_one({"token": data.token}, {"$set": {"used": True}})
+    user_cache.invalidate(reset["user_id"])
     
     return {"message": "Password reset successfully"}
 
@@ -3397,7 +5922,7 @@ async def record_product_view(product_id: str, user: dict = Depends(get_current_
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
     
-    now = datetime.now(timezone.utc).isoformat()
+    now = datetime.now(timezone.utc)
     
     # Update or insert view record
     await db.recently_viewed.update_one(
@@ -3451,7 +5976,7 @@ async def log_activity(user_id: str, user_name: str, action: str, entity_type: s
         "entity_id": entity_id,
         "details": details,
         "ip_address": ip_address,
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": datetime.now(timezone.utc)
     })
 
 @api_router.get("/admin/activity-logs", response_model=List[ActivityLogResponse])
@@ -3486,83 +6011,33 @@ async def get_order_invoice(order_id: str, user: dict = Depends(get_current_user
     settings = await db.store_settings.find_one({}, {"_id": 0})
     store_name = settings.get("store_name", "Wacka Accessories") if settings else "Wacka Accessories"
     
-    # Generate HTML invoice
-    items_html = ""
-    for item in order["items"]:
-        subtotal = item["price"] * item["quantity"]
-        items_html += f"""
-        <tr>
-            <td style="padding: 8px; border-bottom: 1px solid #eee;">{item['product_name']}</td>
-            <td style="padding: 8px; border-bottom: 1px solid #eee; text-align: center;">{item['quantity']}</td>
-            <td style="padding: 8px; border-bottom: 1px solid #eee; text-align: right;">KES {item['price']:,.0f}</td>
-            <td style="padding: 8px; border-bottom: 1px solid #eee; text-align: right;">KES {subtotal:,.0f}</td>
-        </tr>
-        """
+    def render_invoice() -> str:
+        created_at = datetime.fromisoformat(order["created_at"]) if isinstance(order["created_at"], str) else order["created_at"]
+        address = order.get("address_snapshot", {})
+        items = template_renderer.render_rows("partials/invoice_item_row.html", [
+            {
+                "product_name": item["product_name"],
+                "quantity": item["quantity"],
+                "price": f"{item['price']:,.0f}",
+                "subtotal": f"{item['price'] * item['quantity']:,.0f}"
+            }
+            for item in order["items"]
+        ])
+        return template_renderer.render(
+            "invoices/invoice.html",
+            invoice_ref=order_id[:8].upper(),
+            store_name=store_name,
+            date=created_at.strftime('%B %d, %Y'),
+            status=order['status'].replace('_', ' ').title(),
+            phone=order.get('phone_number', 'N/A'),
+            address=f"{address.get('address_line', '')}, {address.get('city', '')}, {address.get('country', 'Kenya')}",
+            items=items,
+            total=f"{order['total_amount']:,.0f}"
+        )
     
-    address = order.get("address_snapshot", {})
-    address_text = f"{address.get('address_line', '')}, {address.get('city', '')}, {address.get('country', 'Kenya')}"
-    
-    html_content = f"""
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <meta charset="utf-8">
-        <title>Invoice #{order_id[:8].upper()}</title>
-        <style>
-            body {{ font-family: Arial, sans-serif; margin: 40px; color: #333; }}
-            .header {{ display: flex; justify-content: space-between; margin-bottom: 40px; }}
-            .company {{ font-size: 24px; font-weight: bold; color: #10B981; }}
-            .invoice-title {{ font-size: 28px; color: #333; }}
-            .invoice-info {{ margin-bottom: 30px; }}
-            .info-row {{ display: flex; margin-bottom: 5px; }}
-            .info-label {{ width: 120px; font-weight: bold; }}
-            table {{ width: 100%; border-collapse: collapse; margin: 20px 0; }}
-            th {{ background: #f3f4f6; padding: 10px; text-align: left; }}
-            .total-row {{ font-size: 18px; font-weight: bold; }}
-            .footer {{ margin-top: 40px; text-align: center; color: #666; font-size: 12px; }}
-        </style>
-    </head>
-    <body>
-        <div class="header">
-            <div class="company">{store_name}</div>
-            <div class="invoice-title">INVOICE</div>
-        </div>
-        
-        <div class="invoice-info">
-            <div class="info-row"><span class="info-label">Invoice #:</span> {order_id[:8].upper()}</div>
-            <div class="info-row"><span class="info-label">Date:</span> {datetime.fromisoformat(order['created_at']).strftime('%B %d, %Y')}</div>
-            <div class="info-row"><span class="info-label">Status:</span> {order['status'].replace('_', ' ').title()}</div>
-            <div class="info-row"><span class="info-label">Phone:</span> {order.get('phone_number', 'N/A')}</div>
-            <div class="info-row"><span class="info-label">Address:</span> {address_text}</div>
-        </div>
-        
-        <table>
-            <thead>
-                <tr>
-                    <th>Product</th>
-                    <th style="text-align: center;">Qty</th>
-                    <th style="text-align: right;">Price</th>
-                    <th style="text-align: right;">Subtotal</th>
-                </tr>
-            </thead>
-            <tbody>
-                {items_html}
-            </tbody>
-            <tfoot>
-                <tr class="total-row">
-                    <td colspan="3" style="padding: 15px 8px; text-align: right;">Total:</td>
-                    <td style="padding: 15px 8px; text-align: right;">KES {order['total_amount']:,.0f}</td>
-                </tr>
-            </tfoot>
-        </table>
-        
-        <div class="footer">
-            <p>Thank you for shopping with {store_name}!</p>
-            <p>This is a computer-generated invoice.</p>
-        </div>
-    </body>
-    </html>
-    """
+    # Any write to the order bumps updated_at, which retires the cached rendering
+    cache_key = ("invoices/invoice.html", order_id, str(order.get("updated_at") or order["created_at"]), store_name)
+    html_content = invoice_cache.get_or_render(cache_key, render_invoice)
     
     # Return HTML content (frontend can print/save as PDF)
     return {
@@ -3602,8 +6077,24 @@ async def startup():
     await db.products.create_index("category")
     await db.orders.create_index("user_id")
     await db.orders.create_index("status")
-    await db.payments.create_index("checkout_request_id")
+    await db.orders.create_index("id", unique=True)
+    await db.orders.create_index([("created_at", 1), ("status", 1)])
+    await db.orders.create_index("updated_at")
+    await db.orders.create_index("rollup_pending_at", sparse=True)
+    await db.payments.create_index([("checkout_request_id", 1), ("status", 1)])
+    await db.payments.create_index([("status", 1), ("created_at", 1)])
+    await db.payments.create_index("order_id")
+    await db.payments.create_index("created_at")
+    await db.payments.create_index("effects_applied", partialFilterExpression={"effects_applied": False})
+    await db.mpesa_callback_logs.create_index("checkout_request_id")
     await db.inventory.create_index("product_id", unique=True)
+    await db.inventory.create_index([("days_of_cover", 1), ("quantity", 1)])
+    await db.inventory.create_index([("is_low_stock", 1), ("days_of_cover", 1), ("quantity", 1)])
+    # Rows written before is_low_stock was stored; a no-op once they have it
+    await db.inventory.update_many({"is_low_stock": {"$exists": False}}, [LOW_STOCK_FLAG_STAGE])
+    await db.low_stock_digests.create_index("created_at", expireAfterSeconds=LOW_STOCK_DIGEST_RETENTION_DAYS * 86400)
+    await db.inventory_logs.create_index([("reason", 1), ("created_at", 1)])
+    await db.inventory_logs.create_index([("reference_id", 1), ("product_id", 1)])
     await db.categories.create_index("slug", unique=True)
     await db.blog_posts.create_index("slug", unique=True)
     await db.coupons.create_index("code", unique=True)
@@ -3613,8 +6104,48 @@ async def startup():
     await db.shipping_zones.create_index("id", unique=True)
     await db.recently_viewed.create_index([("user_id", 1), ("product_id", 1)], unique=True)
     await db.activity_logs.create_index("created_at")
+    await db.mpesa_callback_queue.create_index("id", unique=True)
+    await db.mpesa_callback_queue.create_index([("status", 1), ("next_attempt_at", 1)])
+    await db.mpesa_callback_queue.create_index([("checkout_request_id", 1), ("received_at", 1)])
+    await db.mpesa_callback_queue.create_index("processed_at", expireAfterSeconds=MPESA_CALLBACK_RETENTION_DAYS * 86400)
+    await db.email_outbox.create_index("id", unique=True)
+    await db.email_outbox.create_index([("status", 1), ("next_attempt_at", 1)])
+    await db.email_outbox.create_index(
+        "coalesce_key",
+        unique=True,
+        partialFilterExpression={"status": "pending", "coalesce_key": {"$exists": True}}
+    )
+    await db.email_outbox.create_index("sent_at", expireAfterSeconds=EMAIL_OUTBOX_RETENTION_DAYS * 86400)
+    await db.email_campaigns.create_index("id", unique=True)
+    await db.email_campaigns.create_index([("status", 1), ("created_at", 1)])
+    await db.email_campaign_recipients.create_index([("campaign_id", 1), ("email", 1)], unique=True)
+    await db.email_campaign_recipients.create_index([("campaign_id", 1), ("status", 1), ("next_attempt_at", 1)])
+    await db.rate_limits.create_index("expires_at", expireAfterSeconds=0)
+    await db.analytics_cohort_members.create_index("cohort")
+    await db.admin_events.create_index("created_at", expireAfterSeconds=ADMIN_EVENTS_RETENTION_SECONDS)
+    # Plaintext tokens from before tokens were hashed can no longer be looked up
+    await db.password_resets.delete_many({"token_hash": {"$exists": False}})
+    await db.password_resets.create_index("token_hash", unique=True)
+    await db.password_resets.create_index("expires_at", expireAfterSeconds=0)
     logger.info("Database indexes created")
+    
+    await mpesa_service.start()
+    email_outbox.start()
+    campaign_sender.start()
+    mpesa_callback_queue.start()
+    payment_reconciler.start()
+    payment_events.start()
+    admin_events.start()
 
 @app.on_event("shutdown")
 async def shutdown():
+    await admin_events.stop()
+    await payment_events.stop()
+    await payment_reconciler.stop()
+    await mpesa_callback_queue.stop()
+    await email_outbox.stop()
+    await campaign_sender.stop()
+    await mpesa_service.close()
+    await email_service.close()
+    _password_executor.shutdown(wait=False)
     client.close()
@@ -1,6 +1,8 @@
 import requests
 import sys
 import json
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 class WackaAccessoriesAPITester:
@@ -363,6 +365,68 @@ class WackaAccessoriesAPITester:
                 f"payments/{payment_id}/status",
                 200
             )
+            
+            if payment_response.get('checkout_request_id'):
+                self.test_duplicate_callbacks(order_id, payment_id, payment_response['checkout_request_id'])
+
+    def test_duplicate_callbacks(self, order_id, payment_id, checkout_request_id, copies=5):
+        """Fire duplicate success callbacks in parallel; stock must be deducted exactly once"""
+        print("\n🔁 Testing Duplicate M-Pesa Callbacks...")
+        
+        order = self.run_api_test("Get order before callbacks", "GET", f"orders/{order_id}", 200)
+        if not order:
+            return
+        
+        stock_before = {}
+        for item in order.get('items', []):
+            product = self.run_api_test("Get product stock", "GET", f"products/{item['product_id']}", 200)
+            stock_before[item['product_id']] = product.get('stock_quantity', 0)
+        
+        callback = {
+            "Body": {
+                "stkCallback": {
+                    "MerchantRequestID": "test-merchant",
+                    "CheckoutRequestID": checkout_request_id,
+                    "ResultCode": 0,
+                    "ResultDesc": "The service request is processed successfully.",
+                    "CallbackMetadata": {
+                        "Item": [
+                            {"Name": "Amount", "Value": order.get('total_amount')},
+                            {"Name": "MpesaReceiptNumber", "Value": f"TEST{int(time.time())}"},
+                            {"Name": "PhoneNumber", "Value": 254712345678}
+                        ]
+                    }
+                }
+            }
+        }
+        
+        def post_callback(_):
+            return requests.post(f"{self.base_url}/api/payments/mpesa/callback", json=callback, timeout=30)
+        
+        with ThreadPoolExecutor(max_workers=copies) as executor:
+            responses = list(executor.map(post_callback, range(copies)))
+        
+        all_accepted = all(r.status_code == 200 and r.json().get("ResultDesc") == "Accepted" for r in responses)
+        self.log_test("Duplicate callbacks acknowledged", all_accepted, f"Statuses: {[r.status_code for r in responses]}")
+        
+        # Callbacks are processed asynchronously; wait for the payment to settle
+        status = None
+        for _ in range(20):
+            status = self.run_api_test("Poll payment status", "GET", f"payments/{payment_id}/status", 200).get('status')
+            if status == 'success':
+                break
+            time.sleep(0.5)
+        self.log_test("Payment settled after duplicate callbacks", status == 'success', f"Status: {status}")
+        
+        for item in order.get('items', []):
+            product = self.run_api_test("Get product stock after callbacks", "GET", f"products/{item['product_id']}", 200)
+            expected = stock_before[item['product_id']] - item['quantity']
+            actual = product.get('stock_quantity')
+            self.log_test(
+                f"Stock deducted once for {item['product_name']}",
+                actual == expected,
+                f"Expected: {expected}, Actual: {actual}"
+            )
 
     def test_blog_api_crud(self):
         """Test Blog API CRUD operations"""
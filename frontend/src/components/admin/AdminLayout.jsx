@@ -1,4 +1,4 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import { Link, useLocation, useNavigate, Outlet } from 'react-router-dom';
 import { 
   LayoutDashboard, 
@@ -20,6 +20,7 @@ import {
 } from 'lucide-react';
 import { useAuth } from '../../context/AuthContext';
 import api from '../../lib/api';
+import { subscribeAdminEvents } from '../../lib/adminEvents';
 import {
   DropdownMenu,
   DropdownMenuContent,
@@ -51,11 +52,37 @@ export const AdminLayout = ({ children }) => {
   const { user, logout } = useAuth();
   const [notifications, setNotifications] = useState([]);
   const [unreadCount, setUnreadCount] = useState(0);
+  const [live, setLive] = useState(false);
+  // Notifications already listed, so one replayed around a snapshot is not listed twice
+  const seenNotifications = useRef(new Set());
 
   useEffect(() => {
+    const unsubscribe = subscribeAdminEvents((type, data) => {
+      if (type === 'snapshot') {
+        seenNotifications.current = new Set(data.notifications.map((n) => n.id));
+        setNotifications(data.notifications);
+        setUnreadCount(data.unread_notifications);
+        setLive(true);
+      } else if (type === 'stats') {
+        // The unread count is a total recounted by the server, never adjusted here
+        setUnreadCount(data.unread_notifications);
+      } else if (type === 'notification') {
+        if (seenNotifications.current.has(data.id)) return;
+        seenNotifications.current.add(data.id);
+        setNotifications((prev) => [data, ...prev].slice(0, 10));
+      } else if (type === 'notification_read') {
+        if (data.all) {
+          setNotifications((prev) => prev.map((n) => ({ ...n, is_read: true })));
+        } else {
+          setNotifications((prev) => prev.map((n) => (n.id === data.id ? { ...n, is_read: true } : n)));
+        }
+      }
+    });
+    if (unsubscribe) return unsubscribe;
+
     fetchNotifications();
     fetchUnreadCount();
-    // Poll for new notifications every 30 seconds
+    // No EventSource: poll for new notifications every 30 seconds
     const interval = setInterval(() => {
       fetchUnreadCount();
     }, 30000);
@@ -83,6 +110,8 @@ export const AdminLayout = ({ children }) => {
   const markAsRead = async (notificationId) => {
     try {
       await api.patch(`/admin/notifications/${notificationId}/read`);
+      // When live, the stream delivers the change
+      if (live) return;
       fetchNotifications();
       fetchUnreadCount();
     } catch (error) {
@@ -93,6 +122,7 @@ export const AdminLayout = ({ children }) => {
   const markAllAsRead = async () => {
     try {
       await api.post('/admin/notifications/mark-all-read');
+      if (live) return;
       fetchNotifications();
       fetchUnreadCount();
     } catch (error) {
@@ -0,0 +1,84 @@
+import { adminAPI } from './api';
+
+// One EventSource per tab, shared by every admin component that listens to it.
+// The server starts each stream with a snapshot and then sends deltas, plus a
+// 'stats' event with recounted totals shortly after any that move them; EventSource
+// reconnects on its own, and each reconnect starts again from a fresh snapshot.
+// Reconnects reuse the URL, whose stream token is only valid for a minute, so once
+// the browser gives up the stream is reopened with a new token.
+const EVENT_TYPES = ['snapshot', 'stats', 'order', 'payment', 'stock', 'notification', 'notification_read'];
+// Admin pages each render their own AdminLayout, so keep the stream open across navigation
+const CLOSE_DELAY_MS = 2000;
+const REOPEN_DELAY_MS = 3000;
+
+const listeners = new Set();
+let source = null;
+let active = false;
+let closeTimer = null;
+let reopenTimer = null;
+// The latest snapshot and every event since, replayed to listeners that join late
+let history = [];
+
+const dispatch = (type, data) => {
+  if (type === 'snapshot') history = [];
+  history.push([type, data]);
+  listeners.forEach((listener) => listener(type, data));
+};
+
+const open = async () => {
+  let next = null;
+  try {
+    next = await adminAPI.openEvents();
+  } catch (error) {
+    console.error('Error opening admin event stream:', error);
+  }
+  if (!active) {
+    if (next) next.close();
+    return;
+  }
+  if (!next) {
+    reopenTimer = setTimeout(open, REOPEN_DELAY_MS);
+    return;
+  }
+
+  source = next;
+  EVENT_TYPES.forEach((type) => {
+    next.addEventListener(type, (event) => dispatch(type, JSON.parse(event.data)));
+  });
+  next.onerror = () => {
+    if (next.readyState === EventSource.CLOSED && source === next) {
+      source = null;
+      reopenTimer = setTimeout(open, REOPEN_DELAY_MS);
+    }
+  };
+};
+
+const close = () => {
+  active = false;
+  clearTimeout(reopenTimer);
+  if (source) source.close();
+  source = null;
+  history = [];
+};
+
+// Returns an unsubscribe function, or null when the browser has no EventSource
+// and the caller should fall back to polling
+export const subscribeAdminEvents = (listener) => {
+  if (!window.EventSource) return null;
+
+  clearTimeout(closeTimer);
+  listeners.add(listener);
+  if (active) {
+    history.forEach(([type, data]) => listener(type, data));
+  } else {
+    active = true;
+    open();
+  }
+
+  return () => {
+    listeners.delete(listener);
+    if (listeners.size === 0) {
+      closeTimer = setTimeout(close, CLOSE_DELAY_MS);
+    }
+  };
+};
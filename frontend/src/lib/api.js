@@ -39,6 +39,14 @@ export const authAPI = {
   register: (data) => api.post('/auth/register', data),
   login: (data) => api.post('/auth/login', data),
   getMe: () => api.get('/auth/me'),
+  streamToken: () => api.post('/auth/stream-token'),
+};
+
+// EventSource cannot send headers, so streams are opened with a short-lived token in
+// the query string that is only good for connecting to a stream, never the session token
+const openEventStream = async (path) => {
+  const response = await authAPI.streamToken();
+  return new EventSource(`${API_URL}/api${path}?token=${encodeURIComponent(response.data.token)}`);
 };
 
 // Product APIs
@@ -74,6 +82,8 @@ export const orderAPI = {
 export const paymentAPI = {
   initiate: (orderId, phoneNumber) => api.post('/payments/mpesa/initiate', { order_id: orderId, phone_number: phoneNumber }),
   getStatus: (paymentId) => api.get(`/payments/${paymentId}/status`),
+  openEvents: (paymentId) => openEventStream(`/payments/${paymentId}/events`),
+  waitForStatus: (paymentId, knownStatus) => api.get(`/payments/${paymentId}/wait`, { params: { known_status: knownStatus, timeout: 25 }, timeout: 35000 }),
 };
 
 // Blog APIs
@@ -113,6 +123,8 @@ export const adminAPI = {
   adjustInventory: (data) => api.post('/admin/inventory/adjust', data),
   getPayments: (params) => api.get('/admin/payments', { params }),
   getLowStock: () => api.get('/admin/low-stock'),
+  // Live dashboard updates (SSE)
+  openEvents: () => openEventStream('/admin/events'),
   // Categories
   getCategories: () => api.get('/categories'),
   createCategory: (data) => api.post('/admin/categories', data),
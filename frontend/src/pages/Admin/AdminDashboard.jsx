@@ -1,4 +1,4 @@
-import React, { useEffect, useState } from 'react';
+import React, { useEffect, useRef, useState } from 'react';
 import { Link } from 'react-router-dom';
 import { 
   DollarSign, 
@@ -9,6 +9,7 @@ import {
   TrendingUp
 } from 'lucide-react';
 import { adminAPI } from '../../lib/api';
+import { subscribeAdminEvents } from '../../lib/adminEvents';
 import { AdminLayout } from '../../components/admin/AdminLayout';
 
 export default function AdminDashboard() {
@@ -16,18 +17,49 @@ export default function AdminDashboard() {
   const [recentOrders, setRecentOrders] = useState([]);
   const [lowStock, setLowStock] = useState([]);
   const [loading, setLoading] = useState(true);
+  // Orders already listed, so one replayed around a snapshot is not listed twice
+  const seenOrders = useRef(new Set());
 
   useEffect(() => {
+    adminAPI.getLowStock()
+      .then((response) => setLowStock(response.data))
+      .catch((error) => console.error('Error fetching low stock:', error));
+
+    const unsubscribe = subscribeAdminEvents((type, data) => {
+      // Counters only ever come from snapshot and stats events, which carry totals
+      if (type === 'snapshot') {
+        seenOrders.current = new Set(data.recent_orders.map((o) => o.id));
+        setStats(data.stats);
+        setRecentOrders(data.recent_orders.slice(0, 5));
+        setLoading(false);
+      } else if (type === 'stats') {
+        setStats(data.stats);
+      } else if (type === 'order') {
+        if (!data.previous_status) {
+          if (seenOrders.current.has(data.id)) return;
+          seenOrders.current.add(data.id);
+          setRecentOrders((prev) => [data, ...prev].slice(0, 5));
+        } else {
+          setRecentOrders((prev) => prev.map((o) => (o.id === data.id ? { ...o, status: data.status } : o)));
+        }
+      } else if (type === 'stock' && !data.low_stock) {
+        setLowStock((prev) => prev.filter((item) => item.product_id !== data.product_id));
+      } else if (type === 'stock') {
+        setLowStock((prev) => prev.map((item) => (
+          item.product_id === data.product_id ? { ...item, quantity: data.quantity } : item
+        )));
+      }
+    });
+    if (unsubscribe) return unsubscribe;
+
     const fetchData = async () => {
       try {
-        const [statsRes, ordersRes, lowStockRes] = await Promise.all([
+        const [statsRes, ordersRes] = await Promise.all([
           adminAPI.getDashboard(),
           adminAPI.getOrders({ limit: 5 }),
-          adminAPI.getLowStock(),
         ]);
         setStats(statsRes.data);
         setRecentOrders(ordersRes.data);
-        setLowStock(lowStockRes.data);
       } catch (error) {
         console.error('Error fetching dashboard:', error);
       } finally {
@@ -1,4 +1,4 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import { AdminLayout } from '../../components/admin/AdminLayout';
 import { Button } from '../../components/ui/button';
 import { Input } from '../../components/ui/input';
@@ -22,11 +22,37 @@ export default function AdminEmailComposer() {
   const [htmlContent, setHtmlContent] = useState('');
   const [sending, setSending] = useState(false);
   const [recipientType, setRecipientType] = useState('custom');
+  const [campaign, setCampaign] = useState(null);
+  const pollRef = useRef(null);
 
   useEffect(() => {
     fetchCustomers();
+    return () => clearTimeout(pollRef.current);
   }, []);
 
+  const pollCampaign = async (campaignId) => {
+    try {
+      const response = await api.get(`/admin/email-campaigns/${campaignId}`);
+      const data = response.data;
+      setCampaign(data);
+
+      if (['completed', 'failed', 'cancelled'].includes(data.status)) {
+        if (data.status === 'completed') {
+          toast.success(`Email sent to ${data.sent} recipients`);
+        } else {
+          toast.error(`Campaign ${data.status}`);
+        }
+        if (data.failed > 0) {
+          toast.warning(`${data.failed} emails failed to send`);
+        }
+        return;
+      }
+    } catch (error) {
+      console.error('Error fetching campaign status:', error);
+    }
+    pollRef.current = setTimeout(() => pollCampaign(campaignId), 2000);
+  };
+
   const fetchCustomers = async () => {
     try {
       const response = await api.get('/admin/users', { params: { role: 'customer' } });
@@ -55,17 +81,14 @@ export default function AdminEmailComposer() {
 
     try {
       setSending(true);
-      const response = await api.post('/admin/send-custom-email', {
-        recipient_emails: selectedEmails,
-        subject,
-        html_content: htmlContent,
-      });
-      
-      toast.success(`Email sent to ${response.data.success_count} recipients`);
+      const payload = recipientType === 'all'
+        ? { segment: 'all_customers', subject, html_content: htmlContent }
+        : { recipient_emails: selectedEmails, subject, html_content: htmlContent };
+      const response = await api.post('/admin/email-campaigns', payload);
       
-      if (response.data.failed_count > 0) {
-        toast.warning(`${response.data.failed_count} emails failed to send`);
-      }
+      toast.success('Campaign queued, sending in the background');
+      clearTimeout(pollRef.current);
+      pollCampaign(response.data.campaign_id);
       
       // Reset form
       setSubject('');
@@ -174,6 +197,15 @@ export default function AdminEmailComposer() {
                 {selectedEmails.length} recipient(s) selected
               </p>
             </div>
+
+            {campaign && (
+              <div className="bg-gray-50 border rounded-lg p-3" data-testid="campaign-progress">
+                <p className="text-sm text-gray-800">
+                  Last campaign: {campaign.status} — {campaign.sent} of {campaign.total} sent
+                  {campaign.failed > 0 && `, ${campaign.failed} failed`}
+                </p>
+              </div>
+            )}
           </div>
 
           {/* Email Content */}
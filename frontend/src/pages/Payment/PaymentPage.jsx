@@ -43,42 +43,81 @@ export default function PaymentPage() {
     fetchOrder();
   }, [orderId, navigate]);
 
-  const pollPaymentStatus = useCallback(async (pId) => {
-    if (!pId) return;
-    
-    try {
-      const response = await paymentAPI.getStatus(pId);
-      
-      if (response.data.status === 'success') {
-        setPaymentStatus('success');
-        setPolling(false);
-        clearCart();
-        fetchCart();
-        toast.success('Payment successful!');
-      } else if (response.data.status === 'failed') {
-        setPaymentStatus('failed');
-        setPolling(false);
-        toast.error('Payment failed. Please try again.');
-      }
-      // If still pending, continue polling
-    } catch (error) {
-      console.error('Error polling status:', error);
+  // Returns true once the payment has settled
+  const applyPaymentStatus = useCallback((data) => {
+    if (data.status === 'success') {
+      setPaymentStatus('success');
+      setPolling(false);
+      clearCart();
+      fetchCart();
+      toast.success('Payment successful!');
+      return true;
+    }
+    if (data.status === 'failed') {
+      setPaymentStatus('failed');
+      setPolling(false);
+      toast.error('Payment failed. Please try again.');
+      return true;
     }
+    // Still pending, keep waiting
+    return false;
   }, [clearCart, fetchCart]);
 
   useEffect(() => {
-    let interval;
+    if (!polling || !paymentId) return undefined;
     
-    if (polling && paymentId) {
-      interval = setInterval(() => {
-        pollPaymentStatus(paymentId);
-      }, 5000); // Poll every 5 seconds
+    let cancelled = false;
+    let source;
+    
+    if (window.EventSource) {
+      // The server pushes status changes. EventSource reconnects on its own if the stream
+      // drops, but with the same short-lived stream token; once that is refused, reopen
+      const connect = async () => {
+        let next;
+        try {
+          next = await paymentAPI.openEvents(paymentId);
+        } catch (error) {
+          console.error('Error opening payment stream:', error);
+          if (!cancelled) setTimeout(connect, 5000);
+          return;
+        }
+        if (cancelled) {
+          next.close();
+          return;
+        }
+        source = next;
+        next.addEventListener('status', (event) => {
+          if (applyPaymentStatus(JSON.parse(event.data))) {
+            cancelled = true;
+            next.close();
+          }
+        });
+        next.onerror = () => {
+          if (next.readyState === EventSource.CLOSED && !cancelled) setTimeout(connect, 3000);
+        };
+      };
+      connect();
+    } else {
+      // Long-poll fallback: each request is held open until the status changes
+      const longPoll = async () => {
+        while (!cancelled) {
+          try {
+            const response = await paymentAPI.waitForStatus(paymentId, 'pending');
+            if (applyPaymentStatus(response.data)) return;
+          } catch (error) {
+            console.error('Error waiting for payment status:', error);
+            await new Promise((resolve) => setTimeout(resolve, 5000));
+          }
+        }
+      };
+      longPoll();
     }
     
     return () => {
-      if (interval) clearInterval(interval);
+      cancelled = true;
+      if (source) source.close();
     };
-  }, [polling, paymentId, pollPaymentStatus]);
+  }, [polling, paymentId, applyPaymentStatus]);
 
   const initiatePayment = async () => {
     // Format phone number
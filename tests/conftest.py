@@ -0,0 +1,55 @@
+"""Shared fixtures for the backend unit tests.
+
+These run against an in-memory MongoDB (mongomock-motor), without a server:
+
+    python -m pytest tests
+
+backend_test.py remains the end-to-end suite against a live deployment.
+"""
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test_store")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import mongomock  # noqa: E402
+from mongomock_motor import AsyncMongoMockClient  # noqa: E402
+
+import server  # noqa: E402
+
+_find_and_modify = mongomock.Collection._find_and_modify
+
+
+def _find_and_modify_keeping_id(self, query, projection=None, *args, **kwargs):
+    # mongomock re-reads the returned document by the original filter when the
+    # projection drops _id, so find_one_and_update(..., projection={"_id": 0})
+    # comes back empty whenever the update moves the document out of the filter
+    if not projection or projection.get("_id", 1):
+        return _find_and_modify(self, query, projection, *args, **kwargs)
+    document = _find_and_modify(self, query, {k: v for k, v in projection.items() if k != "_id"} or None, *args, **kwargs)
+    if document:
+        document.pop("_id", None)
+    return document
+
+
+mongomock.Collection._find_and_modify = _find_and_modify_keeping_id
+
+
+@pytest.fixture(scope="session")
+def run():
+    """Run a coroutine to completion; one loop for the session, like a worker process"""
+    loop = asyncio.new_event_loop()
+    yield loop.run_until_complete
+    loop.close()
+
+
+@pytest.fixture
+def db(monkeypatch):
+    database = AsyncMongoMockClient(tz_aware=True)[os.environ["DB_NAME"]]
+    monkeypatch.setattr(server, "db", database)
+    return database
@@ -0,0 +1,81 @@
+import asyncio
+
+import server
+
+
+def hub(buffer_size=500):
+    return server.AdminEventHub(backend="memory", buffer_size=buffer_size)
+
+
+def drain(queue):
+    events = []
+    while not queue.empty():
+        events.append(queue.get_nowait())
+    return events
+
+
+def test_since_replays_events_after_a_snapshot():
+    events = hub()
+    for i in range(3):
+        events.publish("payment", {"payment_id": f"pay-{i}"})
+
+    assert [e["seq"] for e in events.since(1)] == [2, 3]
+    assert events.since(3) == []
+
+
+def test_since_is_none_once_the_events_were_evicted():
+    events = hub(buffer_size=2)
+    for i in range(3):
+        events.publish("payment", {"payment_id": f"pay-{i}"})
+
+    assert events.since(0) is None
+    assert [e["seq"] for e in events.since(1)] == [2, 3]
+
+
+def test_lagging_stream_is_told_to_resync(run, monkeypatch):
+    monkeypatch.setattr(server, "ADMIN_EVENTS_QUEUE_SIZE", 2)
+    events = hub()
+    queue = events.subscribe()
+
+    async def publish():
+        for i in range(3):
+            events.publish("notification_read", {"id": f"n-{i}"})
+        await events.stop()
+    run(publish())
+
+    assert drain(queue) == [None]
+
+
+def test_bursts_of_events_are_followed_by_one_recounted_stats_event(run, monkeypatch):
+    counted = []
+
+    async def compute_admin_stats():
+        counted.append(len(counted))
+        return {"stats": {"pending_orders": 7}, "unread_notifications": 2}
+    monkeypatch.setattr(server, "compute_admin_stats", compute_admin_stats)
+    monkeypatch.setattr(server, "ADMIN_STATS_DEBOUNCE", 0.01)
+    events = hub()
+    queue = events.subscribe()
+
+    async def publish():
+        for i in range(3):
+            events.publish("order", {"id": f"order-{i}"})
+        await asyncio.sleep(0.05)
+    run(publish())
+
+    delivered = drain(queue)
+    assert [e["type"] for e in delivered] == ["order", "order", "order", "stats"]
+    assert delivered[3]["data"] == {"stats": {"pending_orders": 7}, "unread_notifications": 2}
+    assert counted == [0]
+
+
+def test_no_recount_without_listeners(run, monkeypatch):
+    monkeypatch.setattr(server, "ADMIN_STATS_DEBOUNCE", 0)
+    events = hub()
+
+    async def publish():
+        events.publish("order", {"id": "order-1"})
+        await asyncio.sleep(0.01)
+    run(publish())
+
+    assert events.sequence == 1
@@ -0,0 +1,96 @@
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import server
+from server import AnalyticsGranularity
+
+
+def utc(*args):
+    return datetime(*args, tzinfo=timezone.utc)
+
+
+def sales_frame(orders):
+    """Frame in the shape load_sales_frame builds, from (created_at, total_amount, units)"""
+    return pd.DataFrame({
+        "created_at": pd.to_datetime([o[0] for o in orders], utc=True),
+        "total_amount": np.asarray([o[1] for o in orders], dtype="float64"),
+        "units": np.asarray([o[2] for o in orders], dtype="int64"),
+        "payment_method": pd.Categorical(["mpesa"] * len(orders)),
+        "delivery_method": pd.Categorical(["delivery"] * len(orders)),
+    })
+
+
+ORDERS = sales_frame([
+    (utc(2026, 1, 5, 8), 100.0, 1),
+    (utc(2026, 1, 6, 23, 59), 200.0, 2),
+    (utc(2026, 3, 15, 12), 300.0, 3),
+])
+
+
+def series(granularity, start, end, frame=ORDERS):
+    return {p["period"]: p for p in server.sales_series(frame, start, end, granularity)}
+
+
+def test_daily_series_fills_gaps_with_zeros():
+    points = series(AnalyticsGranularity.DAY, utc(2026, 1, 1), utc(2026, 4, 1))
+
+    assert len(points) == 90
+    assert points["2026-01-01"]["revenue"] == 0 and points["2026-01-01"]["revenue_change_pct"] is None
+    assert points["2026-01-05"]["orders"] == 1
+    assert points["2026-01-06"]["revenue"] == 200.0 and points["2026-01-06"]["revenue_change_pct"] == 100.0
+    assert points["2026-01-07"]["revenue"] == 0 and points["2026-01-07"]["revenue_change_pct"] == -100.0
+    assert points["2026-01-05"]["start"] == utc(2026, 1, 5)
+
+
+def test_weekly_series_uses_monday_to_sunday_weeks():
+    points = series(AnalyticsGranularity.WEEK, utc(2026, 1, 1), utc(2026, 4, 1))
+
+    assert len(points) == 14
+    assert list(points)[0] == "2025-12-29/2026-01-04"
+    week = points["2026-01-05/2026-01-11"]
+    assert (week["revenue"], week["orders"], week["units"], week["avg_order_value"]) == (300.0, 2, 3, 150.0)
+
+
+def test_monthly_series():
+    points = series(AnalyticsGranularity.MONTH, utc(2026, 1, 1), utc(2026, 4, 1))
+
+    assert [(p, v["revenue"], v["orders"]) for p, v in points.items()] == [
+        ("2026-01", 300.0, 2), ("2026-02", 0.0, 0), ("2026-03", 300.0, 1)
+    ]
+    assert points["2026-02"]["avg_order_value"] == 0.0
+    assert points["2026-02"]["revenue_change_pct"] == -100.0
+    # Growth from zero has no percentage
+    assert points["2026-03"]["revenue_change_pct"] is None
+
+
+def test_quarterly_series():
+    points = series(AnalyticsGranularity.QUARTER, utc(2025, 10, 1), utc(2026, 7, 1))
+
+    assert {p: v["revenue"] for p, v in points.items()} == {"2025Q4": 0.0, "2026Q1": 600.0, "2026Q2": 0.0}
+    assert points["2026Q1"]["start"] == utc(2026, 1, 1)
+
+
+def test_yearly_series():
+    points = series(AnalyticsGranularity.YEAR, utc(2025, 1, 1), utc(2027, 1, 1))
+
+    assert {p: (v["revenue"], v["units"]) for p, v in points.items()} == {"2025": (0.0, 0), "2026": (600.0, 6)}
+
+
+@pytest.mark.parametrize("granularity", list(AnalyticsGranularity))
+def test_series_without_sales_is_all_zeros(granularity):
+    points = server.sales_series(sales_frame([]), utc(2026, 1, 1), utc(2026, 1, 2), granularity)
+
+    assert len(points) == 1
+    assert points[0]["revenue"] == 0 and points[0]["orders"] == 0
+
+
+def test_summary_compares_with_the_previous_period():
+    summary = server.sales_summary(ORDERS, utc(2026, 3, 1), utc(2026, 5, 29))
+
+    assert summary["totals"]["revenue"] == 300.0
+    assert summary["previous_totals"]["revenue"] == 300.0
+    assert summary["change_pct"]["revenue"] == 0.0
+    assert summary["payment_methods"] == [{"method": "mpesa", "revenue": 300.0, "orders": 1, "revenue_share": 100.0}]
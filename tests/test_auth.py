@@ -0,0 +1,52 @@
+import pytest
+from fastapi import HTTPException
+from fastapi.security import HTTPAuthorizationCredentials
+
+import server
+
+
+@pytest.fixture
+def customer(run, db):
+    server.user_cache.invalidate("user-1")
+    run(db.users.insert_one({"id": "user-1", "email": "buyer@example.com", "role": server.UserRole.CUSTOMER}))
+    yield "user-1"
+    server.user_cache.invalidate("user-1")
+
+
+def bearer(token):
+    return HTTPAuthorizationCredentials(scheme="Bearer", credentials=token)
+
+
+def test_stream_token_opens_streams(run, customer):
+    user = run(server.get_stream_user(token=server.create_stream_token(customer), credentials=None))
+    assert user["id"] == customer
+
+
+def test_session_token_is_refused_in_the_query_string(run, customer):
+    with pytest.raises(HTTPException) as error:
+        run(server.get_stream_user(token=server.create_token(customer, server.UserRole.CUSTOMER), credentials=None))
+    assert error.value.status_code == 401
+
+
+def test_stream_token_is_not_a_bearer_token(run, customer):
+    with pytest.raises(HTTPException) as error:
+        run(server.get_token_payload(bearer(server.create_stream_token(customer))))
+    assert error.value.status_code == 401
+
+
+def test_promotion_takes_effect_without_a_new_token(run, db, customer):
+    token = server.create_token(customer, server.UserRole.CUSTOMER)
+    run(db.users.update_one({"id": customer}, {"$set": {"role": server.UserRole.ADMIN}}))
+    server.user_cache.invalidate(customer)
+
+    user = run(server.get_admin_user(run(server.get_current_user(run(server.get_token_payload(bearer(token)))))))
+    assert user["role"] == server.UserRole.ADMIN
+
+
+def test_demoted_admin_is_refused_despite_the_role_claim(run, db, customer):
+    token = server.create_token(customer, server.UserRole.ADMIN)
+    user = run(server.get_current_user(run(server.get_token_payload(bearer(token)))))
+
+    with pytest.raises(HTTPException) as error:
+        run(server.get_admin_user(user))
+    assert error.value.status_code == 403
@@ -0,0 +1,91 @@
+from datetime import datetime, timedelta, timezone
+
+import httpx
+
+import server
+
+
+def stk_callback(checkout_request_id, result_code=0):
+    return {"Body": {"stkCallback": {
+        "MerchantRequestID": "m-1",
+        "CheckoutRequestID": checkout_request_id,
+        "ResultCode": result_code,
+        "ResultDesc": "ok",
+    }}}
+
+
+async def post_callback(payload):
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        return await client.post("/api/payments/mpesa/callback", json=payload)
+
+
+def test_callback_is_acknowledged_once_stored(run, db):
+    response = run(post_callback(stk_callback("ws_CO_1")))
+
+    assert response.status_code == 200
+    assert response.json() == {"ResultCode": 0, "ResultDesc": "Accepted"}
+    job = run(db.mpesa_callback_queue.find_one({"checkout_request_id": "ws_CO_1"}))
+    assert job["status"] == "pending"
+
+
+def test_callback_is_not_acknowledged_when_it_cannot_be_stored(run, db, monkeypatch):
+    async def unavailable(callback_data):
+        raise ConnectionError("no primary")
+    monkeypatch.setattr(server.mpesa_callback_queue, "enqueue", unavailable)
+
+    response = run(post_callback(stk_callback("ws_CO_1")))
+
+    assert response.status_code == 503
+    assert response.json()["ResultCode"] != 0
+
+
+def test_claim_is_leased_and_taken_over_after_the_lease_expires(run, db):
+    crashed, other = server.MpesaCallbackQueue(), server.MpesaCallbackQueue()
+    run(crashed.enqueue(stk_callback("ws_CO_1")))
+
+    job = run(crashed._claim())
+    assert job["status"] == "processing" and job["attempts"] == 1
+    assert run(other._claim()) is None
+
+    run(db.mpesa_callback_queue.update_one(
+        {"id": job["id"]}, {"$set": {"locked_until": datetime.now(timezone.utc) - timedelta(seconds=1)}}
+    ))
+    retaken = run(other._claim())
+    assert retaken["id"] == job["id"]
+    assert retaken["attempts"] == 2
+
+
+def test_jobs_for_one_checkout_are_processed_in_arrival_order(run, db):
+    first_worker, second_worker = server.MpesaCallbackQueue(), server.MpesaCallbackQueue()
+    first_id = run(first_worker.enqueue(stk_callback("ws_CO_1")))
+    second_id = run(first_worker.enqueue(stk_callback("ws_CO_1", result_code=1032)))
+    run(db.mpesa_callback_queue.update_one(
+        {"id": second_id}, {"$set": {"received_at": datetime.now(timezone.utc) + timedelta(seconds=1)}}
+    ))
+
+    assert run(first_worker._claim())["id"] == first_id
+    # The later callback waits while the earlier one is being processed elsewhere
+    assert run(second_worker._claim()) is None
+    deferred = run(db.mpesa_callback_queue.find_one({"id": second_id}))
+    assert deferred["status"] == "pending" and deferred["attempts"] == 0
+
+
+def test_failed_jobs_back_off_and_are_dead_lettered(run, db, monkeypatch):
+    monkeypatch.setattr(server, "MPESA_CALLBACK_MAX_ATTEMPTS", 2)
+    queue = server.MpesaCallbackQueue()
+    job_id = run(queue.enqueue(stk_callback("ws_CO_1")))
+
+    job = run(queue._claim())
+    queue._in_flight.clear()
+    run(queue._fail(job, RuntimeError("boom")))
+    retry = run(db.mpesa_callback_queue.find_one({"id": job_id}))
+    assert retry["status"] == "pending"
+    assert retry["next_attempt_at"] > datetime.now(timezone.utc)
+    assert run(queue._claim()) is None
+
+    run(db.mpesa_callback_queue.update_one({"id": job_id}, {"$set": {"next_attempt_at": datetime.now(timezone.utc)}}))
+    job = run(queue._claim())
+    run(queue._fail(job, RuntimeError("boom")))
+    dead = run(db.mpesa_callback_queue.find_one({"id": job_id}))
+    assert dead["status"] == "dead" and dead["last_error"] == "boom"
@@ -0,0 +1,41 @@
+from datetime import datetime, timezone
+
+import numpy as np
+
+import manage
+from server import month_index
+
+JAN, FEB, MAR = (month_index(datetime(2026, m, 1, tzinfo=timezone.utc)) for m in (1, 2, 3))
+
+
+def matrices(orders):
+    users, months, amounts = zip(*orders)
+    return manage.cohort_matrices(
+        np.asarray(users, dtype=object), np.asarray(months, dtype=np.int64), np.asarray(amounts, dtype=np.float64)
+    )
+
+
+def test_customers_are_grouped_by_their_first_paid_month():
+    # Listed out of order: "a" is acquired in January even though a March order comes first
+    members, cohorts = matrices([
+        ("a", MAR, 30.0), ("c", FEB, 40.0), ("a", JAN, 100.0), ("b", JAN, 200.0), ("a", JAN, 50.0), ("c", FEB, 60.0)
+    ])
+
+    assert members == {"a": "2026-01", "b": "2026-01", "c": "2026-02"}
+    assert sorted(cohorts) == ["2026-01", "2026-02"]
+
+
+def test_cohort_rows_count_customers_once_per_month_and_sum_revenue():
+    _, cohorts = matrices([
+        ("a", JAN, 100.0), ("a", JAN, 50.0), ("b", JAN, 200.0), ("a", MAR, 30.0), ("c", FEB, 40.0), ("c", FEB, 60.0)
+    ])
+
+    january, february = cohorts["2026-01"], cohorts["2026-02"]
+    assert (january["size"], january["customers"], january["revenue"]) == (2, [2, 0, 1], [350.0, 0.0, 30.0])
+    # Rows stop at the latest month in the data
+    assert (february["size"], february["customers"], february["revenue"]) == (1, [1, 0], [100.0, 0.0])
+
+
+def test_no_orders_gives_no_cohorts():
+    empty = np.asarray([], dtype=object)
+    assert manage.cohort_matrices(empty, np.asarray([], dtype=np.int64), np.asarray([], dtype=np.float64)) == ({}, {})
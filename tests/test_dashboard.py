@@ -0,0 +1,12 @@
+from datetime import datetime, timezone
+
+import server
+
+
+def test_dashboard_pipeline_matches_the_twelve_month_window_before_faceting():
+    now = datetime(2026, 10, 19, 9, 30, tzinfo=timezone.utc)
+
+    pipeline = server.build_dashboard_pipeline(now)
+
+    assert pipeline[0] == {"$match": {"_id": {"$gte": "2025-11-01", "$lte": "2026-10-19"}}}
+    assert list(pipeline[1]) == ["$facet"]
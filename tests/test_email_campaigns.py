@@ -0,0 +1,92 @@
+import asyncio
+import smtplib
+from datetime import datetime, timedelta, timezone
+
+import server
+
+
+def queue_campaign(run, db, recipients=("a@example.com",)):
+    sender = server.CampaignSender()
+    campaign = run(sender.create(server.EmailCampaignCreate(
+        subject="Sale", html_content="<p>20% off</p>", recipient_emails=list(recipients)
+    ), "admin-1"))
+    return campaign["id"]
+
+
+def expire_lease(run, db, campaign_id):
+    run(db.email_campaigns.update_one(
+        {"id": campaign_id}, {"$set": {"lease_until": datetime.now(timezone.utc) - timedelta(seconds=1)}}
+    ))
+
+
+def test_sending_campaign_is_only_taken_over_after_its_lease_expires(run, db):
+    campaign_id = queue_campaign(run, db)
+    first, second = server.CampaignSender(), server.CampaignSender()
+
+    claimed = run(first._claim())
+    assert claimed["id"] == campaign_id and claimed["owner"] == first.owner
+    assert run(second._claim()) is None
+
+    expire_lease(run, db, campaign_id)
+    taken_over = run(second._claim())
+    assert taken_over["id"] == campaign_id and taken_over["owner"] == second.owner
+    assert run(first._renew_lease(campaign_id)) is False
+    assert run(second._renew_lease(campaign_id)) is True
+
+
+def test_previous_owner_stops_sending_once_taken_over(run, db, monkeypatch):
+    delivered = []
+
+    async def deliver(to_email, subject, html_content):
+        delivered.append(to_email)
+    monkeypatch.setattr(server.email_service, "deliver", deliver)
+    campaign_id = queue_campaign(run, db)
+    first, second = server.CampaignSender(), server.CampaignSender()
+    stalled = run(first._claim())
+    expire_lease(run, db, campaign_id)
+    run(second._claim())
+
+    run(first._run(stalled))
+    assert delivered == []
+
+    run(second._run(run(db.email_campaigns.find_one({"id": campaign_id}, {"_id": 0}))))
+    assert delivered == ["a@example.com"]
+    assert run(db.email_campaigns.find_one({"id": campaign_id}))["status"] == "completed"
+
+
+def test_permanent_failures_do_not_back_off(run, db, monkeypatch):
+    async def deliver(to_email, subject, html_content):
+        raise smtplib.SMTPRecipientsRefused({to_email: (550, b"No such mailbox")})
+    monkeypatch.setattr(server.email_service, "deliver", deliver)
+    monkeypatch.setattr(server, "EMAIL_RETRY_DELAY", 3600)
+    campaign_id = queue_campaign(run, db, ("gone@example.com", "typo@exmaple.com"))
+    sender = server.CampaignSender()
+    sender._rate_limiter = server.SendRateLimiter(0)
+
+    run(asyncio.wait_for(sender._run(run(sender._claim())), timeout=5))
+
+    campaign = run(db.email_campaigns.find_one({"id": campaign_id}))
+    assert (campaign["status"], campaign["sent"], campaign["failed"]) == ("completed", 0, 2)
+
+
+def test_retried_recipients_wait_behind_the_rest(run, db, monkeypatch):
+    attempts = []
+
+    async def deliver(to_email, subject, html_content):
+        attempts.append(to_email)
+        if to_email == "flaky@example.com":
+            raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+    monkeypatch.setattr(server.email_service, "deliver", deliver)
+    monkeypatch.setattr(server, "EMAIL_RETRY_DELAY", 0.01)
+    monkeypatch.setattr(server, "EMAIL_CAMPAIGN_BATCH_SIZE", 2)
+    campaign_id = queue_campaign(run, db, ("flaky@example.com", "b@example.com", "c@example.com", "d@example.com"))
+    sender = server.CampaignSender()
+    sender._rate_limiter = server.SendRateLimiter(0)
+
+    run(asyncio.wait_for(sender._run(run(sender._claim())), timeout=5))
+
+    assert set(attempts[:2]) == {"flaky@example.com", "b@example.com"}
+    assert set(attempts[2:4]) == {"c@example.com", "d@example.com"}
+    assert attempts[4:] == ["flaky@example.com"] * (server.EMAIL_CAMPAIGN_MAX_ATTEMPTS - 1)
+    campaign = run(db.email_campaigns.find_one({"id": campaign_id}))
+    assert (campaign["status"], campaign["sent"], campaign["failed"]) == ("completed", 3, 1)
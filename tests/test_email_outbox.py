@@ -0,0 +1,31 @@
+import server
+
+ADMIN = {"id": "admin-1", "role": "admin"}
+
+
+def queue_and_kill(run, db, coalesce_key):
+    outbox = server.EmailOutbox()
+    message_id = run(outbox.enqueue("buyer@example.com", "Reset your password", "<p>old link</p>", "password_reset", coalesce_key))
+    run(db.email_outbox.update_one({"id": message_id}, {"$set": {"status": "dead", "attempts": server.EMAIL_MAX_ATTEMPTS}}))
+    return outbox, message_id
+
+
+def test_dead_email_is_requeued(run, db):
+    _, message_id = queue_and_kill(run, db, "password_reset:buyer@example.com")
+
+    assert run(server.retry_dead_email(message_id, ADMIN)) == {"message": "Email requeued"}
+
+    message = run(db.email_outbox.find_one({"id": message_id}))
+    assert message["status"] == "pending" and message["attempts"] == 0
+
+
+def test_dead_email_superseded_by_a_newer_one_is_not_requeued(run, db):
+    outbox, message_id = queue_and_kill(run, db, "password_reset:buyer@example.com")
+    newer_id = run(outbox.enqueue("buyer@example.com", "Reset your password", "<p>new link</p>", "password_reset", "password_reset:buyer@example.com"))
+
+    response = run(server.retry_dead_email(message_id, ADMIN))
+
+    assert response["message"] == "A newer copy of this email is already queued"
+    assert run(db.email_outbox.find_one({"id": message_id}))["status"] == "dead"
+    assert run(db.email_outbox.count_documents({"status": "pending"})) == 1
+    assert run(db.email_outbox.find_one({"status": "pending"}))["id"] == newer_id
@@ -0,0 +1,50 @@
+import argparse
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pytest
+
+import manage
+import server
+
+
+def test_steady_demand_has_no_safety_stock():
+    # Two units a day, one of them recorded as two movements
+    velocity, std, reorder_point = manage.demand_forecast(
+        np.asarray([0, 0, 0, 0, 0]), np.asarray([0, 1, 2, 3, 3]), np.asarray([2.0, 2.0, 2.0, 1.0, 1.0]),
+        n_products=1, n_days=4, span=3, lead_time_days=3, service_z=1.65
+    )
+    assert velocity.tolist() == pytest.approx([2.0])
+    assert std.tolist() == [0.0]
+    assert reorder_point.tolist() == [6.0]
+
+
+def test_recent_spike_is_weighted_up_and_adds_safety_stock():
+    velocity, std, reorder_point = manage.demand_forecast(
+        np.asarray([1]), np.asarray([3]), np.asarray([4.0]),
+        n_products=2, n_days=4, span=3, lead_time_days=2, service_z=1.0
+    )
+    # Weights 1/8, 1/4, 1/2, 1 over the four days
+    assert velocity.tolist() == pytest.approx([0.0, 4 / 1.875])
+    assert std.tolist() == pytest.approx([0.0, np.sqrt(3)])
+    assert reorder_point.tolist() == [0.0, 7.0]
+
+
+def test_forecast_leaves_out_todays_partial_day(run, db, monkeypatch):
+    monkeypatch.setattr(manage, "db", db)
+    today = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    run(db.inventory.insert_one({"product_id": "prod-1", "quantity": 10}))
+    sales = [(today - timedelta(days=d, hours=-12), 2) for d in (1, 2, 3)]
+    # Older than the window, and today's sales so far
+    sales += [(today - timedelta(days=4), 40), (today + timedelta(minutes=1), 50)]
+    run(db.inventory_logs.insert_many([
+        {"product_id": "prod-1", "reason": server.StockMovementReason.SALE, "change": -units, "created_at": at}
+        for at, units in sales
+    ]))
+
+    run(manage.forecast_stock(argparse.Namespace(
+        window_days=3, span_days=3, lead_time_days=1, service_z=0.0, max_cover_days=90
+    )))
+
+    inventory = run(db.inventory.find_one({"product_id": "prod-1"}))
+    assert (inventory["velocity"], inventory["days_of_cover"], inventory["reorder_point"]) == (2.0, 5.0, 2)
@@ -0,0 +1,88 @@
+import argparse
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import manage
+import server
+
+
+@pytest.fixture
+def watch(run, db):
+    """A product above both its threshold (5) and its forecast reorder point (10)"""
+    run(db.products.insert_one({"id": "prod-1", "name": "Watch"}))
+    run(db.inventory.insert_one({
+        "product_id": "prod-1", "quantity": 12, "low_stock_threshold": 5, "reorder_point": 10, "is_low_stock": False
+    }))
+    return "prod-1"
+
+
+def sell(run, product_id, quantity=1):
+    inventory = run(server.change_stock(product_id, -quantity))
+    return inventory["quantity"], inventory["is_low_stock"], server.crossed_low_stock(inventory, -quantity)
+
+
+def alerts(run, db):
+    return run(db.notifications.count_documents({"type": server.NotificationType.LOW_STOCK.value}))
+
+
+def test_crossing_the_reorder_point_flags_the_row_once(run, watch):
+    assert sell(run, watch) == (11, False, False)
+    assert sell(run, watch) == (10, True, True)
+    assert sell(run, watch) == (9, True, False)
+
+
+def test_low_stock_list_reads_the_flag(run, db, watch):
+    run(db.inventory.insert_one({"product_id": "prod-2", "quantity": 50, "low_stock_threshold": 5, "is_low_stock": False}))
+    sell(run, watch, 2)
+
+    items = run(server.get_low_stock_items(user={}))
+    assert [(i["product_id"], i["quantity"], i["reorder_point"]) for i in items] == [(watch, 10, 10)]
+
+
+def test_forecast_rows_rank_ahead_of_rows_not_yet_forecast(run, db, watch):
+    run(db.inventory.insert_many([
+        # A product just created through the admin, never forecast
+        {"product_id": "prod-new", "quantity": 0, "low_stock_threshold": 5, "is_low_stock": True},
+        {"product_id": "prod-unforecast", "quantity": 3, "low_stock_threshold": 5, "is_low_stock": True},
+        {"product_id": "prod-urgent", "quantity": 4, "low_stock_threshold": 5, "days_of_cover": 0.5, "is_low_stock": True}
+    ]))
+    run(db.products.insert_many([{"id": p, "name": p} for p in ("prod-new", "prod-unforecast", "prod-urgent")]))
+    run(db.inventory.update_one({"product_id": watch}, {"$set": {"days_of_cover": 4.0}}))
+    sell(run, watch, 2)
+
+    items = run(server.get_low_stock_items(user={}))
+    assert [i["product_id"] for i in items] == ["prod-urgent", watch, "prod-new", "prod-unforecast"]
+
+
+def test_forecast_refreshes_the_flag(run, db, watch, monkeypatch):
+    monkeypatch.setattr(manage, "db", db)
+    yesterday = datetime.now(timezone.utc).replace(hour=12, minute=0, second=0, microsecond=0) - timedelta(days=1)
+    run(db.inventory_logs.insert_one({
+        "product_id": watch, "reason": server.StockMovementReason.SALE, "change": -13, "created_at": yesterday
+    }))
+
+    run(manage.forecast_stock(argparse.Namespace(
+        window_days=1, span_days=1, lead_time_days=1, service_z=0.0, max_cover_days=90
+    )))
+
+    inventory = run(db.inventory.find_one({"product_id": watch}))
+    assert (inventory["reorder_point"], inventory["is_low_stock"]) == (13, True)
+
+
+def test_alerts_are_held_back_for_the_cooldown(run, db, watch):
+    sell(run, watch, 2)
+
+    run(server.check_low_stock_and_notify([watch]))
+    run(server.check_low_stock_and_notify([watch]))
+    assert alerts(run, db) == 1
+
+    past_cooldown = datetime.now(timezone.utc) - timedelta(seconds=server.LOW_STOCK_ALERT_COOLDOWN + 1)
+    run(db.inventory.update_one({"product_id": watch}, {"$set": {"low_stock_alerted_at": past_cooldown}}))
+    run(server.check_low_stock_and_notify([watch]))
+    assert alerts(run, db) == 2
+
+
+def test_rows_above_their_level_do_not_alert(run, db, watch):
+    run(server.check_low_stock_and_notify([watch]))
+    assert alerts(run, db) == 0
@@ -0,0 +1,58 @@
+import hashlib
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+
+import server
+
+REQUEST = Request({"type": "http", "client": ("10.0.0.1", 52000), "headers": []})
+
+
+@pytest.fixture
+def reset_token(run, db, monkeypatch):
+    """Request a reset for a known user and return the token from the email"""
+    monkeypatch.setattr(server, "RATE_LIMIT_ENABLED", False)
+    monkeypatch.setattr(server, "BCRYPT_ROUNDS", 4)
+    monkeypatch.setattr(server.EmailService, "is_configured", True)
+    rendered = {}
+    render = server.template_renderer.render
+
+    def capture(name, **context):
+        rendered.update(context)
+        return render(name, **context)
+    monkeypatch.setattr(server.template_renderer, "render", capture)
+
+    run(db.users.insert_one({"id": "user-1", "email": "buyer@example.com", "password": "old-hash", "role": "customer"}))
+    run(server.forgot_password(server.PasswordResetRequest(email="buyer@example.com"), REQUEST))
+    return rendered["token"]
+
+
+def reset(run, token, password="n3w-passw0rd"):
+    return run(server.reset_password(server.PasswordResetConfirm(token=token, new_password=password), REQUEST))
+
+
+def test_only_the_token_digest_is_stored(run, db, reset_token):
+    stored = run(db.password_resets.find_one({}, {"_id": 0}))
+
+    assert stored["token_hash"] == hashlib.sha256(reset_token.encode()).hexdigest()
+    assert reset_token not in str(stored)
+
+
+def test_token_resets_the_password_once(run, db, reset_token):
+    assert reset(run, reset_token) == {"message": "Password reset successfully"}
+    assert run(db.users.find_one({"id": "user-1"}))["password"].startswith("$2b$04$")
+
+    with pytest.raises(HTTPException) as error:
+        reset(run, reset_token, "an0ther-passw0rd")
+    assert error.value.status_code == 400
+
+
+def test_expired_or_unknown_tokens_are_refused(run, db, reset_token):
+    run(db.password_resets.update_many({}, {"$set": {"expires_at": datetime.now(timezone.utc) - timedelta(seconds=1)}}))
+
+    for token in (reset_token, hashlib.sha256(reset_token.encode()).hexdigest()):
+        with pytest.raises(HTTPException):
+            reset(run, token)
+    assert run(db.users.find_one({"id": "user-1"}))["password"] == "old-hash"
@@ -0,0 +1,176 @@
+from datetime import datetime, timedelta, timezone
+
+import httpx
+import pytest
+
+import mpesa_simulator
+import server
+
+RECEIPT = [{"Name": "MpesaReceiptNumber", "Value": "QKJ81ABCDE"}]
+
+
+def seed_pending_payment(run, db, checkout_request_id="ws_CO_1", quantity=2, created_at=None):
+    created_at = created_at or datetime.now(timezone.utc)
+
+    async def seed():
+        await db.users.insert_one({"id": "user-1", "email": "buyer@example.com", "role": "customer"})
+        await db.inventory.insert_many([
+            {"product_id": product_id, "quantity": 10, "low_stock_threshold": 1, "is_low_stock": False}
+            for product_id in ("prod-1", "prod-2")
+        ])
+        await db.orders.insert_one({
+            "id": "order-1",
+            "user_id": "user-1",
+            "status": server.OrderStatus.PENDING_PAYMENT,
+            "payment_method": "mpesa",
+            "total_amount": 4000.0,
+            "items": [
+                {"product_id": "prod-1", "product_name": "Case", "price": 1500.0, "quantity": quantity, "category": "cases"},
+                {"product_id": "prod-2", "product_name": "Cable", "price": 1000.0, "quantity": 1, "category": "cables"}
+            ],
+            "created_at": created_at
+        })
+        await db.payments.insert_one({
+            "id": "payment-1",
+            "order_id": "order-1",
+            "checkout_request_id": checkout_request_id,
+            "amount": 4000.0,
+            "status": server.PaymentStatus.PENDING,
+            "created_at": created_at
+        })
+    run(seed())
+
+
+def assert_paid_once(run, db, quantity=2):
+    order = run(db.orders.find_one({"id": "order-1"}))
+    assert order["status"] == server.OrderStatus.PAID
+    assert run(db.inventory.find_one({"product_id": "prod-1"}))["quantity"] == 10 - quantity
+    assert run(db.inventory.find_one({"product_id": "prod-2"}))["quantity"] == 9
+    assert run(db.inventory_logs.count_documents({"reference_id": "order-1"})) == 2
+    assert run(db.order_status_history.count_documents({"order_id": "order-1", "status": server.OrderStatus.PAID})) == 1
+    assert run(db.sales_daily.find_one({}))["revenue"] == order["total_amount"]
+    payment = run(db.payments.find_one({"id": "payment-1"}))
+    assert payment["status"] == server.PaymentStatus.SUCCESS and payment["effects_applied"] is True
+
+
+def test_failed_effect_is_resumed_by_the_retry(run, db, monkeypatch):
+    seed_pending_payment(run, db)
+    change_stock = server.change_stock
+    failed = []
+
+    async def flaky_change_stock(product_id, change, *args, **kwargs):
+        # The first item's stock has moved by the time the second one fails
+        if product_id == "prod-2" and not failed:
+            failed.append(product_id)
+            raise ConnectionError("primary stepped down")
+        return await change_stock(product_id, change, *args, **kwargs)
+    monkeypatch.setattr(server, "change_stock", flaky_change_stock)
+
+    with pytest.raises(ConnectionError):
+        run(server.apply_stk_result("ws_CO_1", 0, "ok", RECEIPT))
+    assert run(db.payments.find_one({"id": "payment-1"}))["effects_applied"] is False
+
+    # The queue retries the same callback, and Daraja sends a duplicate for good measure
+    run(server.apply_stk_result("ws_CO_1", 0, "ok", RECEIPT))
+    run(server.apply_stk_result("ws_CO_1", 0, "ok", RECEIPT))
+
+    assert_paid_once(run, db)
+
+
+def test_effects_held_by_another_worker_are_retried_later(run, db):
+    seed_pending_payment(run, db)
+    run(db.payments.update_one({"id": "payment-1"}, {"$set": {
+        "status": server.PaymentStatus.SUCCESS,
+        "effects_applied": False,
+        "applying_until": datetime.now(timezone.utc) + timedelta(minutes=1)
+    }}))
+
+    with pytest.raises(server.PaymentEffectsInProgress):
+        run(server.apply_stk_result("ws_CO_1", 0, "ok", RECEIPT))
+    assert run(db.orders.find_one({"id": "order-1"}))["status"] == server.OrderStatus.PENDING_PAYMENT
+
+
+@pytest.fixture
+def simulator(run, monkeypatch):
+    """MpesaService talking to the Daraja simulator in-process"""
+    monkeypatch.setitem(mpesa_simulator.config, "latency_ms", 0.0)
+    monkeypatch.setitem(mpesa_simulator.config, "error_rate", 0.0)
+    monkeypatch.setattr(mpesa_simulator, "transactions", {})
+    service = server.MpesaService("http://simulator")
+    service.client = httpx.AsyncClient(transport=httpx.ASGITransport(app=mpesa_simulator.app), base_url="http://simulator")
+    monkeypatch.setattr(server, "mpesa_service", service)
+    yield mpesa_simulator.transactions
+    run(service.close())
+
+
+def simulated_transaction(checkout_request_id, status="completed", result_code=0):
+    return {
+        "checkout_request_id": checkout_request_id,
+        "merchant_request_id": "12345-1234567-1",
+        "amount": 3000,
+        "phone": "254712345678",
+        "callback_url": "http://127.0.0.1:9/unused",
+        "status": status,
+        "result_code": result_code,
+        "result_desc": "The service request is processed successfully."
+    }
+
+
+def test_reconciler_settles_a_stale_payment_once(run, db, simulator):
+    # The callback for this payment was lost; Daraja knows it succeeded
+    seed_pending_payment(run, db, created_at=datetime.now(timezone.utc) - timedelta(minutes=30))
+    simulator["ws_CO_1"] = simulated_transaction("ws_CO_1")
+
+    reconciler = server.PaymentReconciler()
+    assert run(reconciler.run_once())["settled"] == 1
+    assert run(reconciler.run_once())["checked"] == 0
+    # A callback that turns up late is a no-op
+    run(server.apply_stk_result("ws_CO_1", 0, "ok", RECEIPT))
+
+    assert_paid_once(run, db)
+    assert run(db.mpesa_callback_logs.count_documents({"source": "reconciler"})) == 1
+
+
+def test_reconciler_leaves_payments_still_processing_at_daraja(run, db, simulator):
+    seed_pending_payment(run, db, created_at=datetime.now(timezone.utc) - timedelta(minutes=30))
+    simulator["ws_CO_1"] = simulated_transaction("ws_CO_1", status="pending")
+
+    counts = run(server.PaymentReconciler().run_once())
+
+    assert counts["checked"] == 1 and counts["pending"] == 1 and counts["settled"] == 0
+    assert run(db.payments.find_one({"id": "payment-1"}))["status"] == server.PaymentStatus.PENDING
+
+
+def test_reconciler_finishes_effects_left_by_a_dead_callback(run, db, simulator):
+    seed_pending_payment(run, db)
+    run(db.payments.update_one({"id": "payment-1"}, {"$set": {
+        "status": server.PaymentStatus.SUCCESS, "mpesa_receipt": "QKJ81ABCDE", "effects_applied": False
+    }}))
+
+    assert run(server.PaymentReconciler().run_once())["resumed"] == 1
+
+    assert_paid_once(run, db)
+
+
+def test_reconciler_carries_on_past_a_payment_it_cannot_settle(run, db, simulator, monkeypatch):
+    stale = datetime.now(timezone.utc) - timedelta(minutes=30)
+    seed_pending_payment(run, db, created_at=stale)
+    # Earlier in the page: a callback worker is applying this one's effects
+    run(db.payments.insert_one({
+        "id": "payment-0", "order_id": "order-0", "checkout_request_id": "ws_CO_0", "amount": 1000.0,
+        "status": server.PaymentStatus.PENDING, "created_at": stale - timedelta(minutes=1)
+    }))
+    simulator["ws_CO_0"] = simulated_transaction("ws_CO_0")
+    simulator["ws_CO_1"] = simulated_transaction("ws_CO_1")
+    apply_stk_result = server.apply_stk_result
+
+    async def busy_apply_stk_result(checkout_request_id, *args, **kwargs):
+        if checkout_request_id == "ws_CO_0":
+            raise server.PaymentEffectsInProgress(checkout_request_id)
+        return await apply_stk_result(checkout_request_id, *args, **kwargs)
+    monkeypatch.setattr(server, "apply_stk_result", busy_apply_stk_result)
+
+    counts = run(server.PaymentReconciler().run_once())
+
+    assert (counts["checked"], counts["settled"], counts["error"]) == (2, 1, 1)
+    assert_paid_once(run, db)
@@ -0,0 +1,66 @@
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+
+import server
+from server import RateLimiter, RateLimitRule
+
+
+def request_from(ip):
+    return Request({"type": "http", "client": (ip, 52000), "headers": []})
+
+
+def test_bucket_allows_a_burst_then_refills():
+    rule = RateLimitRule("ip", 3, 60)
+    limiter = RateLimiter({"p": [rule]}, max_keys=100)
+    key = ("p", "ip", "10.0.0.1")
+
+    assert [limiter._take(key, rule, 0.0) for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert limiter._take(key, rule, 0.0) == pytest.approx(20.0)
+    # One token comes back every period / capacity seconds
+    assert limiter._take(key, rule, 20.0) == 0.0
+
+
+def test_rejection_sets_retry_after(run):
+    limiter = RateLimiter({"p": [RateLimitRule("ip", 1, 60)]}, max_keys=100)
+    run(limiter.check("p", request_from("10.0.0.1")))
+
+    with pytest.raises(HTTPException) as error:
+        run(limiter.check("p", request_from("10.0.0.1")))
+    assert error.value.status_code == 429
+    assert error.value.headers["Retry-After"] == "60"
+
+
+def test_login_spray_does_not_lock_the_owner_out(run):
+    limiter = RateLimiter(server.RATE_LIMIT_POLICIES, max_keys=100)
+    for _ in range(10):
+        run(limiter.check("login", request_from("203.0.113.7"), email="victim@example.com"))
+    with pytest.raises(HTTPException):
+        run(limiter.check("login", request_from("203.0.113.7"), email="Victim@example.com"))
+
+    run(limiter.check("login", request_from("198.51.100.2"), email="victim@example.com"))
+
+
+def test_tokens_taken_by_earlier_rules_are_refunded_on_rejection(run):
+    ip_rule = RateLimitRule("ip", 5, 60)
+    limiter = RateLimiter({"p": [ip_rule, RateLimitRule("user", 1, 60)]}, max_keys=100)
+    run(limiter.check("p", request_from("10.0.0.1"), user_id="user-1"))
+
+    for _ in range(3):
+        with pytest.raises(HTTPException):
+            run(limiter.check("p", request_from("10.0.0.1"), user_id="user-1"))
+
+    assert limiter._buckets[("p", "ip", "10.0.0.1")][0] == pytest.approx(4, abs=0.01)
+
+
+def test_shared_counters_are_refunded_on_rejection(run, db):
+    limiter = RateLimiter({"p": [RateLimitRule("ip", 5, 86400), RateLimitRule("user", 1, 86400)]}, max_keys=100, shared=True)
+    run(limiter.check("p", request_from("10.0.0.1"), user_id="user-1"))
+    # Another worker has already used up this user's shared allowance
+    limiter._buckets.clear()
+
+    with pytest.raises(HTTPException):
+        run(limiter.check("p", request_from("10.0.0.1"), user_id="user-1"))
+
+    counters = {c["_id"].rsplit(":", 1)[0]: c["count"] for c in run(db.rate_limits.find().to_list(10))}
+    assert counters == {"p:ip:10.0.0.1": 1, "p:user:user-1": 2}
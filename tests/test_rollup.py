@@ -0,0 +1,67 @@
+from datetime import datetime, timezone
+
+import pytest
+
+import manage
+import server
+
+CREATED_AT = datetime(2026, 10, 18, 14, 5, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def order(run, db, monkeypatch):
+    monkeypatch.setattr(manage, "db", db)
+    run(db.orders.insert_one({
+        "id": "order-1",
+        "status": server.OrderStatus.PAID,
+        "total_amount": 2500.0,
+        "created_at": CREATED_AT,
+        "items": [
+            {"product_id": "prod-1", "product_name": "Watch", "price": 2000.0, "quantity": 1, "category": "Men's Watches"},
+            {"product_id": "prod-2", "product_name": "Strap", "price": 250.0, "quantity": 2, "category": "straps.leather"}
+        ]
+    }))
+    return "order-1"
+
+
+def day(run, db):
+    return run(db.sales_daily.find_one({"_id": "2026-10-18"})) or {}
+
+
+def test_order_is_added_and_removed_once(run, db, order):
+    assert run(server.sync_order_rollup(order)) == 1
+    assert run(server.sync_order_rollup(order)) == 0
+    assert day(run, db)["revenue"] == 2500.0 and day(run, db)["orders"] == 1
+
+    run(db.orders.update_one({"id": order}, {"$set": {"status": server.OrderStatus.CANCELLED}}))
+    assert run(server.sync_order_rollup(order)) == -1
+    assert run(server.sync_order_rollup(order)) == 0
+    assert day(run, db)["revenue"] == 0 and day(run, db)["orders"] == 0
+
+    assert "rollup_pending" not in run(db.orders.find_one({"id": order}))
+
+
+def test_categories_are_keyed_by_slug(run, db, order):
+    run(server.sync_order_rollup(order))
+
+    assert day(run, db)["categories"] == {
+        "mens-watches": {"quantity": 1, "revenue": 2000.0},
+        "strapsleather": {"quantity": 2, "revenue": 500.0}
+    }
+
+
+def test_backfill_repairs_an_interrupted_rollup_update(run, db, order, monkeypatch):
+    async def crash(*args, **kwargs):
+        raise ConnectionError("process killed")
+    with monkeypatch.context() as patch:
+        patch.setattr(server, "apply_order_to_rollup", crash)
+        with pytest.raises(ConnectionError):
+            run(server.sync_order_rollup(order))
+    # Counted, but sales_daily never saw it
+    assert run(db.orders.find_one({"id": order}))["rollup_pending"] == 1
+    assert day(run, db) == {}
+
+    assert run(manage.repair_pending_days({}, grace_minutes=-1)) == ["2026-10-18"]
+    assert day(run, db)["revenue"] == 2500.0 and day(run, db)["orders"] == 1
+    assert "rollup_pending" not in run(db.orders.find_one({"id": order}))
+    assert run(manage.repair_pending_days({}, grace_minutes=-1)) == []